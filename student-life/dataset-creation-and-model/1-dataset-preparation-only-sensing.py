@@ -1,8 +1,17 @@
 import pandas as pd
 import numpy as np
 import os
+import argparse
 import scipy.stats as stats
 
+from timeline_utils import paint_intervals, aggregate_scans, mode_by_timestamp, read_mode_per_second
+from timeline_utils import BLUETOOTH_BANDS, BLUETOOTH_MAX_LEVEL, WIFI_BANDS, WIFI_MAX_LEVEL
+from user_runner import run_users
+from feature_schema import apply_schema, column_dtype
+from source_cache import cached_reader, configure_cache
+from dataset_manifest import load_dataset_manifest, schedule_users
+from label_table import load_label_table, user_labels, attach_labels
+
 
 def get_user_list(loc):
     # Collecting all student codes from activity folder (which represents all students)
@@ -14,28 +23,46 @@ def get_user_list(loc):
 
 
 ### DATA READ FUNCTIONS BEGIN ###
-
-def get_activity(user, loc):
+# Outputs of readers are saved to an on-disk cache if it is enabled (see source_cache.py).
+
+@cached_reader('sensing/activity/activity_{user}.csv')
+def get_activity(user, loc, chunksize=None):
+    if chunksize is not None:
+        # Reads the raw rows in chunks of chunksize rows, so the raw file is never in memory at once.
+        # The per-second result still covers the whole time span of the file (see read_mode_per_second).
+        # Result is same with the code below.
+        return read_mode_per_second(loc + 'sensing/activity/activity_' + user + '.csv',
+                                    ['timestamp', 'activity_inference'], chunksize=chunksize,
+                                    dtype=column_dtype('activity_inference')[0])
     activity = pd.read_csv(loc + 'sensing/activity/activity_' + user + '.csv')
     activity.columns = ['timestamp', 'activity_inference']
     # make timestamp unique and take the mode for different values of activity inference
-    activity = activity.groupby("timestamp")['activity_inference'].apply(lambda x: x.mode()[0]).reset_index()
+    activity = mode_by_timestamp(activity, 'timestamp', 'activity_inference')
     activity.timestamp = pd.to_datetime(activity.timestamp, unit='s')
     activity = activity.set_index('timestamp')
     activity = activity.asfreq('s', method='bfill')
-    return activity
-
-
-def get_audio(user, loc):
+    return apply_schema(activity)
+
+
+@cached_reader('sensing/audio/audio_{user}.csv')
+def get_audio(user, loc, chunksize=None):
+    if chunksize is not None:
+        # Reads the raw rows in chunks of chunksize rows, so the raw file is never in memory at once.
+        # The per-second result still covers the whole time span of the file (see read_mode_per_second).
+        # Result is same with the code below.
+        return read_mode_per_second(loc + 'sensing/audio/audio_' + user + '.csv',
+                                    ['timestamp', 'audio_inference'], chunksize=chunksize,
+                                    dtype=column_dtype('audio_inference')[0])
     audio = pd.read_csv(loc + 'sensing/audio/audio_' + user + '.csv')
     audio.columns = ['timestamp', 'audio_inference']
     # make timestamp unique and take the mode for different values of audio inference
-    audio = audio.groupby("timestamp")['audio_inference'].apply(lambda x: x.mode()[0]).reset_index()
+    audio = mode_by_timestamp(audio, 'timestamp', 'audio_inference')
     audio.timestamp = pd.to_datetime(audio.timestamp, unit='s')
     audio = audio.set_index('timestamp')
     audio = audio.asfreq('s', method='bfill')
-    return audio
+    return apply_schema(audio)
 
+@cached_reader('sensing/conversation/conversation_{user}.csv')
 def get_conversation(user, loc):
     conversation = pd.read_csv(loc + 'sensing/conversation/conversation_' + user + '.csv')
     conversation.columns = ['start_timestamp', 'end_timestamp']
@@ -43,33 +70,39 @@ def get_conversation(user, loc):
     conversation.end_timestamp = pd.to_datetime(conversation.end_timestamp, unit='s')
     return conversation
 
+@cached_reader('sensing/bluetooth/bt_{user}.csv')
 def get_bluetooth(user, loc):
     bluetooth = pd.read_csv(loc + 'sensing/bluetooth/bt_' + user + '.csv', index_col=False)
     bluetooth.time = pd.to_datetime(bluetooth.time, unit='s')
-    return bluetooth
+    return apply_schema(bluetooth)
 
+@cached_reader('sensing/wifi/wifi_{user}.csv')
 def get_wifi(user, loc):
     wifi = pd.read_csv(loc + 'sensing/wifi/wifi_' + user + '.csv', index_col=False)
     wifi.time = pd.to_datetime(wifi.time, unit='s')
-    return wifi
+    return apply_schema(wifi)
 
+@cached_reader('sensing/wifi_location/wifi_location_{user}.csv')
 def get_wifi_loc(user, loc):
     wifi_loc = pd.read_csv(loc + 'sensing/wifi_location/wifi_location_' + user + '.csv', index_col=False)
     wifi_loc.time = pd.to_datetime(wifi_loc.time, unit='s')
     return wifi_loc
 
+@cached_reader('sensing/dark/dark_{user}.csv')
 def get_dark(user, loc):
     dark = pd.read_csv(loc + 'sensing/dark/dark_' + user + '.csv', index_col=False)
     dark.start = pd.to_datetime(dark.start, unit='s')
     dark.end = pd.to_datetime(dark.end, unit='s')
     return dark
 
+@cached_reader('sensing/phonecharge/phonecharge_{user}.csv')
 def get_phone_charge(user, loc):
     phonecharge = pd.read_csv(loc + 'sensing/phonecharge/phonecharge_' + user + '.csv', index_col=False)
     phonecharge.start = pd.to_datetime(phonecharge.start, unit='s')
     phonecharge.end = pd.to_datetime(phonecharge.end, unit='s')
     return phonecharge
 
+@cached_reader('sensing/phonelock/phonelock_{user}.csv')
 def get_phone_lock(user, loc):
     phonelock = pd.read_csv(loc + 'sensing/phonelock/phonelock_' + user + '.csv', index_col=False)
     phonelock.start = pd.to_datetime(phonelock.start, unit='s')
@@ -86,99 +119,40 @@ def merge_sensing_data(activity, audio, conversation, bluetooth, wifi, wifi_loc,
     df = df.reset_index()
 
     # add conversation
-    df['conversation'] = np.nan
-    for i in range(conversation.shape[0]):
-        start = conversation.iloc[i, 0]
-        end = conversation.iloc[i, 1]
-        df.loc[(df['timestamp'] >= start) & (df['timestamp'] <= end), 'conversation'] = 1
+    df['conversation'] = paint_intervals(df['timestamp'], conversation.iloc[:, 0], conversation.iloc[:, 1])
 
     # add bluetooth
-    bluetooth_new = pd.DataFrame()
-    for time in bluetooth.time.unique():
-        data = {'timestamp': time}
-        item = bluetooth[bluetooth.time == time]
-        data['total_devices_around'] = item.shape[0]
-        data['total_nearer'] = item[(item.level >= -65) & (item.level <= 0)].shape[0]
-        data['total_near'] = item[(item.level >= -80) & (item.level < -65)].shape[0]
-        data['total_far'] = item[(item.level >= -90) & (item.level < -80)].shape[0]
-        data['total_farther'] = item[(item.level >= -125) & (item.level < -90)].shape[0] # Normally -100 is max but for one anomaly.
-        data['level_avg'] = round(item.level.mean())
-        data['level_std'] = item.level.std()
-        bluetooth_new = bluetooth_new.append(data, ignore_index=True)
+    # Values are calculated as float64 and stored as float32 (RSSI statistics, and counts because
+    # the merge below creates missing values).
+    bluetooth_new = aggregate_scans(bluetooth, BLUETOOTH_BANDS, max_level=BLUETOOTH_MAX_LEVEL)
+    bluetooth_new = apply_schema(bluetooth_new, missing=True)
 
     bluetooth_new.columns = ['bt_' + i for i in bluetooth_new.columns]
     df = pd.merge(df, bluetooth_new, left_on='timestamp', right_on='bt_timestamp', how='outer')
     df.drop(columns=['bt_timestamp'], inplace=True)
 
     # add wifi
-    wifi_new = pd.DataFrame()
-    for time in wifi.time.unique():
-        data = {'timestamp': time}
-        item = wifi[wifi.time == time]
-        data['total_devices_around'] = item.shape[0]
-        data['total_nearer'] = item[item.level >= -60].shape[0]
-        data['total_near'] = item[(item.level >= -80) & (item.level < -60)].shape[0]
-        data['total_far'] = item[(item.level >= -100) & (item.level < -80)].shape[0]
-        data['level_avg'] = round(item.level.mean())
-        data['level_std'] = item.level.std()
-        wifi_new = wifi_new.append(data, ignore_index=True)
+    # Values are calculated as float64 and stored as float32 (RSSI statistics, and counts because
+    # the merge below creates missing values).
+    wifi_new = aggregate_scans(wifi, WIFI_BANDS, max_level=WIFI_MAX_LEVEL)
+    wifi_new = apply_schema(wifi_new, missing=True)
 
     wifi_new.columns = ['wifi_' + i for i in wifi_new.columns]
     df = pd.merge(df, wifi_new, left_on='timestamp', right_on='wifi_timestamp', how='left')
     df.drop(columns=['wifi_timestamp'], inplace=True)
 
     # add dark
-    df['phone_in_dark'] = np.nan
-    for i in range(dark.shape[0]):
-        start = dark.iloc[i, 0]
-        end = dark.iloc[i, 1]
-        df.loc[(df['timestamp'] >= start) & (df['timestamp'] <= end), 'phone_in_dark'] = 1
+    df['phone_in_dark'] = paint_intervals(df['timestamp'], dark.iloc[:, 0], dark.iloc[:, 1])
 
     # phone charge
-    df['phone_charging'] = np.nan
-    for i in range(phone_charge.shape[0]):
-        start = phone_charge.iloc[i, 0]
-        end = phone_charge.iloc[i, 1]
-        df.loc[(df['timestamp'] >= start) & (df['timestamp'] <= end), 'phone_charging'] = 1
+    df['phone_charging'] = paint_intervals(df['timestamp'], phone_charge.iloc[:, 0], phone_charge.iloc[:, 1])
 
     # phone locked
-    df['phone_locked'] = np.nan
-    for i in range(phone_lock.shape[0]):
-        start = phone_lock.iloc[i, 0]
-        end = phone_lock.iloc[i, 1]
-        df.loc[(df['timestamp'] >= start) & (df['timestamp'] <= end), 'phone_locked'] = 1
+    df['phone_locked'] = paint_intervals(df['timestamp'], phone_lock.iloc[:, 0], phone_lock.iloc[:, 1])
 
     return df
 
 
-### EMA FUNCTIONS ###
-def ema(user, typ, cols, loc):
-    data = pd.read_json(loc + 'EMA/response/' + typ + '/' + typ + '_' + user + '.json')
-    if 'null' in data.columns:
-        data = data.drop(columns='null')
-    if 'location' in data.columns:
-        data = data.drop(columns='location')
-    dr = True
-    for j in cols:
-        if j not in data.columns:
-            dr = False
-    if dr == True:
-        data = data.dropna(subset=cols)
-    return data
-
-def label_generator(stress, mood2, resample_factor):
-    stress['level'] = stress['level'].replace([1,2,3], 1)
-    stress['level'] = stress['level'].replace([4,5], 0)
-    stress.columns = ['STRESSED', 'resp_time']
-    mood2 = mood2.replace([1, 3], 0)
-    mood2 = mood2.replace([2], 1)
-    mood2.columns = ['STRESSED', 'resp_time']
-    labels = stress.append(mood2)
-    labels = labels.sort_values(by='resp_time', ascending=True)
-    labels = labels.set_index('resp_time').resample(resample_factor).max()
-    labels = labels[labels.STRESSED.notnull()]
-    return labels
-
 def resample_aggregations(columns):
     agg_dict = {}
     for i in columns:
@@ -191,96 +165,108 @@ def resample_aggregations(columns):
     return agg_dict
 
 
-def main():
+def process_user(user, dir_loc, label_table, chunksize=None):
+    # Reads sensing data of the user, merges them, adds labels from label_table and saves the prepared data.
+    # If chunksize is given, activity and audio files are read in chunks of chunksize rows.
+    # Sensing
+    activity = get_activity(user, dir_loc, chunksize=chunksize)
+    audio = get_audio(user, dir_loc, chunksize=chunksize)
+    conversation = get_conversation(user, dir_loc)
+    bluetooth = get_bluetooth(user, dir_loc)
+    wifi = get_wifi(user, dir_loc)
+    wifi_loc = get_wifi_loc(user, dir_loc)
+    dark = get_dark(user, dir_loc)
+    phone_charge = get_phone_charge(user, dir_loc)
+    phone_lock = get_phone_lock(user, dir_loc)
+
+    print('Data read is completed.')
+
+    df = merge_sensing_data(activity, audio, conversation,
+                    bluetooth, wifi, wifi_loc, dark,
+                    phone_charge, phone_lock)
+    
+    print('Shape of df after merge:', str(df.shape))
+    print('Data merge is completed.')
+
+    # Labels of the user from the EMA label table.
+    labels = user_labels(label_table, user)
+
+    # Choose only valid timestamps
+    df = df[df.timestamp.notnull()]
+
+    # Fill empty values in dataset.
+    df.loc[:, ['activity_inference',
+               'audio_inference']] = df.loc[:, ['activity_inference',
+                                                 'audio_inference']].fillna(value=3)
+    
+    df.loc[:, ['conversation',
+                'phone_in_dark',
+                'phone_charging',
+                'phone_locked']] = df.loc[:, ['conversation',
+                                            'phone_in_dark',
+                                            'phone_charging',
+                                            'phone_locked']].fillna(value=0)
+    
+    # One Hot Encode
+    # Columns are replaced instead of set with loc, because a column without missing values keeps
+    # its int8 type from apply_schema and int values can not be set into it.
+    df['activity_inference'] = df['activity_inference'].astype(int).astype('category')
+    df['audio_inference'] = df['audio_inference'].astype(int).astype('category')
+    df = pd.get_dummies(df)
+    # Use compact types (flags as uint8, counts as small ints, RSSI statistics as float32).
+    df = apply_schema(df)
+    
+    # Resampling
+    df = df.set_index('timestamp')
+    df.index = pd.to_datetime(df.index, unit='s')
+    
+    res_aggs = resample_aggregations(list(df.columns))
+    df = df.resample('10min').agg(res_aggs)
+
+    # Merge df and labels, each bin gets the last label of the 10 minutes up to its start.
+    df = attach_labels(df.reset_index(), labels, tolerance=pd.Timedelta('10m')).set_index('timestamp')
+
+    df.to_csv('prepared_user_data/' + user + '_sensing_data.csv', index=True, header=True)
+    
+    print(user, 'is completed.')
+    print('Shape of df is:', str(df.shape))
+
+
+def main(workers=1, cache_dir=None, cache_size_gb=20, chunksize=None, labeled_only=True):
     # Set dataset directory
     dir_loc = '../../student-life-study-data/dataset/'
 
-    # Get user list
-    user_codes = get_user_list(dir_loc)
-
-    # Create empty dataset
-    dataset = pd.DataFrame()
-
-    for user in user_codes:
-        # Sensing
-        activity = get_activity(user, dir_loc)
-        audio = get_audio(user, dir_loc)
-        conversation = get_conversation(user, dir_loc)
-        bluetooth = get_bluetooth(user, dir_loc)
-        wifi = get_wifi(user, dir_loc)
-        wifi_loc = get_wifi_loc(user, dir_loc)
-        dark = get_dark(user, dir_loc)
-        phone_charge = get_phone_charge(user, dir_loc)
-        phone_lock = get_phone_lock(user, dir_loc)
-        # EMA
-        stress = ema(user, 'Stress', ['level'], dir_loc)
-        mood2 = ema(user, 'Mood 2', ['how'], dir_loc)
-
-        print('Data read is completed.')
-
-        df = merge_sensing_data(activity, audio, conversation,
-                        bluetooth, wifi, wifi_loc, dark,
-                        phone_charge, phone_lock)
-        
-        print('Shape of df after merge:', str(df.shape))
-        print('Data merge is completed.')
-
-        # Create labels
-        if stress.shape[1] == 2:
-            stress['level'] = stress['level'].replace([1,2,3], 1)
-            stress['level'] = stress['level'].replace([4,5], 0)
-            stress.columns = ['STRESSED', 'resp_time']
-
-        if mood2.shape[1] == 2:
-            mood2 = mood2.replace([1, 3], 0)
-            mood2 = mood2.replace([2], 1)
-            mood2.columns = ['STRESSED', 'resp_time']
-
-        labels = stress.append(mood2)
-        labels = labels.sort_values(by='resp_time', ascending=True)
-        labels = labels.set_index('resp_time')
-
-        
-        # Choose only valid timestamps
-        df = df[df.timestamp.notnull()]
-
-        # Fill empty values in dataset.
-        df.loc[:, ['activity_inference',
-                   'audio_inference']] = df.loc[:, ['activity_inference',
-                                                     'audio_inference']].fillna(value=3)
-        
-        df.loc[:, ['conversation',
-                    'phone_in_dark',
-                    'phone_charging',
-                    'phone_locked']] = df.loc[:, ['conversation',
-                                                'phone_in_dark',
-                                                'phone_charging',
-                                                'phone_locked']].fillna(value=0)
-        
-        df.loc[:, ['activity_inference', 
-                   'audio_inference']] = df.loc[:, ['activity_inference', 
-                                                    'audio_inference']].astype(int)
-        
-        # One Hot Encode
-        df['activity_inference'] = df['activity_inference'].astype('category')
-        df['audio_inference'] = df['audio_inference'].astype('category')
-        df = pd.get_dummies(df)
-        
-        # Resampling
-        df = df.set_index('timestamp')
-        df.index = pd.to_datetime(df.index, unit='s')
-        
-        res_aggs = resample_aggregations(list(df.columns))
-        df = df.resample('10min').agg(res_aggs)
-
-        # Merge df and labels
-        df = pd.merge_asof(df, labels, left_index=True, right_index=True, tolerance=pd.Timedelta('10m'))
-
-        df.to_csv('prepared_user_data/' + user + '_sensing_data.csv', index=True, header=True)
-        
-        print(user, 'is completed.')
-        print('Shape of df is:', str(df.shape))
-
-main()
-
-print("ALL COMPLETED.")
+    # Enable the cache of raw data readers.
+    configure_cache(cache_dir, max_bytes=cache_size_gb * 1024 ** 3)
+
+    # Get user list from the dataset manifest (see dataset_manifest.py), users without labels are skipped
+    # unless labeled_only is False and the largest users are processed first.
+    manifest = load_dataset_manifest(dir_loc, 'dataset_manifest')
+    user_codes = schedule_users(manifest, labeled_only=labeled_only)
+
+    # EMA files of all users are converted to a label table once (in parallel if workers > 1) and saved
+    # to ema_labels.parquet. It is built again only when an EMA file changes.
+    label_table = load_label_table(dir_loc, 'ema_labels', workers=workers)
+
+    # Each user is processed separately, if workers > 1 users are processed in parallel.
+    # Failure of a user is reported and does not stop the others.
+    run_users(process_user, user_codes, workers=workers, dir_loc=dir_loc, label_table=label_table,
+              chunksize=chunksize)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Prepares resampled sensing features of each user.')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of users processed at the same time in separate processes')
+    parser.add_argument('--cache-dir', default=None,
+                        help='directory to cache outputs of raw data readers, disabled if not given')
+    parser.add_argument('--cache-size-gb', type=float, default=20,
+                        help='size limit of the reader cache, least recently used files are deleted above it')
+    parser.add_argument('--chunksize', type=int, default=None,
+                        help='read activity and audio files in chunks of this many rows to limit memory usage')
+    parser.add_argument('--all-users', action='store_true',
+                        help='also process users without EMA labels')
+    args = parser.parse_args()
+    main(workers=args.workers, cache_dir=args.cache_dir, cache_size_gb=args.cache_size_gb,
+         chunksize=args.chunksize, labeled_only=not args.all_users)
+    print("ALL COMPLETED.")
\ No newline at end of file
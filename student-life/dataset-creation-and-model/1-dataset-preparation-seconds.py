@@ -1,8 +1,21 @@
 import pandas as pd
 import numpy as np
 import os
+import argparse
+import functools
 import scipy.stats as stats
 
+from timeline_utils import paint_intervals, aggregate_scans, mode_by_timestamp, read_mode_per_second
+from timeline_utils import daily_values, days_until_next, project_events, call_intervals
+from timeline_utils import BLUETOOTH_BANDS, BLUETOOTH_MAX_LEVEL, WIFI_BANDS, WIFI_MAX_LEVEL
+from user_runner import run_users
+from feature_schema import apply_schema, column_dtype
+from source_cache import cached_reader, configure_cache
+from feature_store import write_features, FEATURE_FORMATS
+from label_table import load_label_table, user_labels, attach_labels
+from stage_monitor import stage, configure_stage_log, write_summary
+from dataset_manifest import load_dataset_manifest, schedule_users
+
 
 def get_user_list(loc):
     # Collecting all student codes from activity folder (which represents all students)
@@ -18,7 +31,18 @@ def get_user_list(loc):
 
 # All functions starting with "get" takes the data according to function and 
 # prepare for dataset creation process.
-def get_activity(user, loc):
+# Their outputs are saved to an on-disk cache if it is enabled (see source_cache.py).
+# Time, rows and memory of each reader and merger call are recorded by @stage (see stage_monitor.py).
+@stage
+@cached_reader('sensing/activity/activity_{user}.csv')
+def get_activity(user, loc, chunksize=None):
+    if chunksize is not None:
+        # Reads the raw rows in chunks of chunksize rows, so the raw file is never in memory at once.
+        # The per-second result still covers the whole time span of the file (see read_mode_per_second).
+        # Result is same with the code below.
+        return read_mode_per_second(loc + 'sensing/activity/activity_' + user + '.csv',
+                                    ['timestamp', 'activity_inference'], chunksize=chunksize,
+                                    dtype=column_dtype('activity_inference')[0])
     # Reads the data.
     activity = pd.read_csv(loc + 'sensing/activity/activity_' + user + '.csv')
     # Change column names.
@@ -26,25 +50,36 @@ def get_activity(user, loc):
     # make timestamp unique and take the mode for different values of activity inference.
     # mode is taken because it eliminates multiple rows for a timestamp. therefore, we will
     # have one value for each timestamp.
-    activity = activity.groupby("timestamp")['activity_inference'].apply(lambda x: x.mode()[0]).reset_index()
+    activity = mode_by_timestamp(activity, 'timestamp', 'activity_inference')
     # convert timestamp time with seconds.
     activity.timestamp = pd.to_datetime(activity.timestamp, unit='s')
     # make timestamp index of rows.
     activity = activity.set_index('timestamp')
     # fill empty values with backward filling.
     activity = activity.asfreq('s', method='bfill')
-    return activity
-
-def get_audio(user, loc):
+    return apply_schema(activity)
+
+@stage
+@cached_reader('sensing/audio/audio_{user}.csv')
+def get_audio(user, loc, chunksize=None):
+    if chunksize is not None:
+        # Reads the raw rows in chunks of chunksize rows, so the raw file is never in memory at once.
+        # The per-second result still covers the whole time span of the file (see read_mode_per_second).
+        # Result is same with the code below.
+        return read_mode_per_second(loc + 'sensing/audio/audio_' + user + '.csv',
+                                    ['timestamp', 'audio_inference'], chunksize=chunksize,
+                                    dtype=column_dtype('audio_inference')[0])
     audio = pd.read_csv(loc + 'sensing/audio/audio_' + user + '.csv')
     audio.columns = ['timestamp', 'audio_inference']
     # make timestamp unique and take the mode for different values of audio inference
-    audio = audio.groupby("timestamp")['audio_inference'].apply(lambda x: x.mode()[0]).reset_index()
+    audio = mode_by_timestamp(audio, 'timestamp', 'audio_inference')
     audio.timestamp = pd.to_datetime(audio.timestamp, unit='s')
     audio = audio.set_index('timestamp')
     audio = audio.asfreq('s', method='bfill')
-    return audio
+    return apply_schema(audio)
 
+@stage
+@cached_reader('sensing/conversation/conversation_{user}.csv')
 def get_conversation(user, loc):
     conversation = pd.read_csv(loc + 'sensing/conversation/conversation_' + user + '.csv')
     conversation.columns = ['start_timestamp', 'end_timestamp']
@@ -52,28 +87,38 @@ def get_conversation(user, loc):
     conversation.end_timestamp = pd.to_datetime(conversation.end_timestamp, unit='s')
     return conversation
 
+@stage
+@cached_reader('sensing/bluetooth/bt_{user}.csv')
 def get_bluetooth(user, loc):
     bluetooth = pd.read_csv(loc + 'sensing/bluetooth/bt_' + user + '.csv', index_col=False)
     bluetooth.time = pd.to_datetime(bluetooth.time, unit='s')
-    return bluetooth
+    return apply_schema(bluetooth)
 
+@stage
+@cached_reader('sensing/wifi/wifi_{user}.csv')
 def get_wifi(user, loc):
     wifi = pd.read_csv(loc + 'sensing/wifi/wifi_' + user + '.csv', index_col=False)
     wifi.time = pd.to_datetime(wifi.time, unit='s')
-    return wifi
+    return apply_schema(wifi)
 
+@stage
+@cached_reader('sensing/dark/dark_{user}.csv')
 def get_dark(user, loc):
     dark = pd.read_csv(loc + 'sensing/dark/dark_' + user + '.csv', index_col=False)
     dark.start = pd.to_datetime(dark.start, unit='s')
     dark.end = pd.to_datetime(dark.end, unit='s')
     return dark
 
+@stage
+@cached_reader('sensing/phonecharge/phonecharge_{user}.csv')
 def get_phone_charge(user, loc):
     phonecharge = pd.read_csv(loc + 'sensing/phonecharge/phonecharge_' + user + '.csv', index_col=False)
     phonecharge.start = pd.to_datetime(phonecharge.start, unit='s')
     phonecharge.end = pd.to_datetime(phonecharge.end, unit='s')
     return phonecharge
 
+@stage
+@cached_reader('sensing/phonelock/phonelock_{user}.csv')
 def get_phone_lock(user, loc):
     phonelock = pd.read_csv(loc + 'sensing/phonelock/phonelock_' + user + '.csv', index_col=False)
     phonelock.start = pd.to_datetime(phonelock.start, unit='s')
@@ -82,6 +127,8 @@ def get_phone_lock(user, loc):
 
 ## Other than sensing ##
 
+@stage
+@cached_reader('sms/sms_{user}.csv')
 def get_sms(user, loc):
     sms = pd.read_csv(loc + 'sms/sms_' + user + '.csv', index_col=False)
     sms = sms[['timestamp']]
@@ -89,8 +136,10 @@ def get_sms(user, loc):
     sms['timestamp'] = pd.to_datetime(sms.timestamp, unit='s')
     sms['sms'] = 1
     sms = sms.set_index('timestamp')
-    return sms
+    return apply_schema(sms)
 
+@stage
+@cached_reader('call_log/call_log_{user}.csv')
 def get_call_log(user, loc):
     call_log = pd.read_csv(loc + 'call_log/call_log_' + user + '.csv', index_col=False)
     if 'CALLS_date' not in call_log.columns:
@@ -105,9 +154,11 @@ def get_call_log(user, loc):
         call_log = call_log[['timestamp', 'CALLS_date', 'CALLS_duration']]
         call_log = call_log.groupby(['timestamp', 'CALLS_date']).sum().reset_index()
         call_log['call_log'] = 1
-    return call_log
+    return apply_schema(call_log)
 
 # One time call this because it includes all of the users' deadlines.
+@stage
+@cached_reader('education/deadlines.csv')
 def get_deadlines(loc):
     deadlines = pd.read_csv(loc + 'education/deadlines.csv', index_col=False)
     deadlines = deadlines.T
@@ -116,6 +167,8 @@ def get_deadlines(loc):
     deadlines.index = pd.to_datetime(deadlines.index)
     return deadlines
 
+@stage
+@cached_reader('app_usage/running_app_{user}.csv')
 def get_app_usage(user, loc):
     app = pd.read_csv(loc + 'app_usage/running_app_' + user + '.csv', index_col=False)
     app = app[['timestamp', 'RUNNING_TASKS_numRunning']]
@@ -123,7 +176,7 @@ def get_app_usage(user, loc):
     app['timestamp'] = pd.to_datetime(app.timestamp, unit='s')
     app.columns = ['timestamp', 'running_apps']
     app = app.set_index('timestamp')
-    return app
+    return apply_schema(app)
 
 ### DATA READ FUNCTIONS END ###
 
@@ -135,181 +188,137 @@ def get_app_usage(user, loc):
 # All merge operation is done based on timestamp.
 # Activity is the main dataframe, all other data are merged on it.
 # In this case, df = activity.
+@stage
 def merge_audio(df, audio):
     df = pd.merge(df, audio, left_index=True, right_index=True, how='outer')
     return df.reset_index()
 
+@stage
 def merge_conversation(df, conversation):
     # add conversation
-    df['conversation'] = np.nan
-    for i in range(conversation.shape[0]):
-        start = conversation.iloc[i, 0]
-        end = conversation.iloc[i, 1]
-        df.loc[(df['timestamp'] >= start) & (df['timestamp'] <= end), 'conversation'] = 1
+    df['conversation'] = paint_intervals(df['timestamp'], conversation.iloc[:, 0], conversation.iloc[:, 1])
     return df
 
+@stage
 def merge_bluetooth(df, bluetooth):
     # add bluetooth
-    bluetooth_new = pd.DataFrame()
-    for time in bluetooth.time.unique():
-        data = {'timestamp': time}
-        item = bluetooth[bluetooth.time == time]
-        data['total_devices_around'] = item.shape[0]
-        data['total_nearer'] = item[(item.level >= -65) & (item.level <= 0)].shape[0]
-        data['total_near'] = item[(item.level >= -80) & (item.level < -65)].shape[0]
-        data['total_far'] = item[(item.level >= -90) & (item.level < -80)].shape[0]
-        data['total_farther'] = item[(item.level >= -125) & (item.level < -90)].shape[0] # Normally -100 is max but for one anomaly.
-        data['level_avg'] = round(item.level.mean())
-        data['level_std'] = item.level.std()
-        bluetooth_new = bluetooth_new.append(data, ignore_index=True)
+    # Values are calculated as float64 and stored as float32 (RSSI statistics, and counts because
+    # the merge below creates missing values).
+    bluetooth_new = aggregate_scans(bluetooth, BLUETOOTH_BANDS, max_level=BLUETOOTH_MAX_LEVEL)
+    bluetooth_new = apply_schema(bluetooth_new, missing=True)
     bluetooth_new.columns = ['bt_' + i for i in bluetooth_new.columns]
     df = pd.merge(df, bluetooth_new, left_on='timestamp', right_on='bt_timestamp', how='outer')
     df.drop(columns=['bt_timestamp'], inplace=True)
     return df
 
+@stage
 def merge_wifi(df, wifi):
     # add wifi
-    wifi_new = pd.DataFrame()
-    for time in wifi.time.unique():
-        data = {'timestamp': time}
-        item = wifi[wifi.time == time]
-        data['total_devices_around'] = item.shape[0]
-        data['total_nearer'] = item[item.level >= -60].shape[0]
-        data['total_near'] = item[(item.level >= -80) & (item.level < -60)].shape[0]
-        data['total_far'] = item[(item.level >= -100) & (item.level < -80)].shape[0]
-        data['level_avg'] = round(item.level.mean())
-        data['level_std'] = item.level.std()
-        wifi_new = wifi_new.append(data, ignore_index=True)
+    # Values are calculated as float64 and stored as float32 (RSSI statistics, and counts because
+    # the merge below creates missing values).
+    wifi_new = aggregate_scans(wifi, WIFI_BANDS, max_level=WIFI_MAX_LEVEL)
+    wifi_new = apply_schema(wifi_new, missing=True)
     wifi_new.columns = ['wifi_' + i for i in wifi_new.columns]
     df = pd.merge(df, wifi_new, left_on='timestamp', right_on='wifi_timestamp', how='left')
     df.drop(columns=['wifi_timestamp'], inplace=True)
     return df
 
+@stage
 def merge_dark(df, dark):
     # add dark
-    df['phone_in_dark'] = np.nan
-    for i in range(dark.shape[0]):
-        start = dark.iloc[i, 0]
-        end = dark.iloc[i, 1]
-        df.loc[(df['timestamp'] >= start) & (df['timestamp'] <= end), 'phone_in_dark'] = 1
+    df['phone_in_dark'] = paint_intervals(df['timestamp'], dark.iloc[:, 0], dark.iloc[:, 1])
     return df
 
+@stage
 def merge_phone_charge(df, phone_charge):
     # phone charge
-    df['phone_charging'] = np.nan
-    for i in range(phone_charge.shape[0]):
-        start = phone_charge.iloc[i, 0]
-        end = phone_charge.iloc[i, 1]
-        df.loc[(df['timestamp'] >= start) & (df['timestamp'] <= end), 'phone_charging'] = 1
+    df['phone_charging'] = paint_intervals(df['timestamp'], phone_charge.iloc[:, 0], phone_charge.iloc[:, 1])
     return df
 
+@stage
 def merge_phone_lock(df, phone_lock):
     # phone locked
-    df['phone_locked'] = np.nan
-    for i in range(phone_lock.shape[0]):
-        start = phone_lock.iloc[i, 0]
-        end = phone_lock.iloc[i, 1]
-        df.loc[(df['timestamp'] >= start) & (df['timestamp'] <= end), 'phone_locked'] = 1
+    df['phone_locked'] = paint_intervals(df['timestamp'], phone_lock.iloc[:, 0], phone_lock.iloc[:, 1])
     return df
 
 ## Other than sensing ##
 
+# sms, call_log and app_usage events are projected onto the timeline with project_events
+# (searchsorted over the timeline instead of merges), see timeline_utils.py.
+@stage
 def merge_sms(df, sms):
-    df = pd.merge(df, sms, left_on='timestamp', right_index=True, how='left')
+    df['sms'] = project_events(df['timestamp'], {'sms': (sms.index, None, 'flag')})['sms']
     return df
 
-def merge_call_log(df, call_log):
+@stage
+def merge_call_log(df, call_log, on_call=False):
+    # call_log is 1 at the seconds when the call log is saved. If the file has call dates, call_log
+    # is also 1 at the start second of each call and call_duration is the duration of the calls
+    # starting at that second. A call saved multiple times is counted once.
+    # If on_call is True, on_call is 1 at all seconds of the calls (start to start + duration).
     if 'CALLS_date' in call_log.columns:
-        only_time = call_log[['timestamp', 'call_log']]
-        only_time = only_time.set_index('timestamp')
-        df = pd.merge(df, only_time, left_on='timestamp', right_index=True, how='left')
-        call_dur = call_log[['CALLS_date', 'CALLS_duration']]
-        call_dur.columns = ['CALLS_date', 'call_duration']
-        call_dur = call_dur.set_index('CALLS_date')
-        df = pd.merge(df, call_dur, left_on='timestamp', right_index=True, how='left')
-        df.loc[df.call_duration.notnull(), 'call_log'] = 1
+        calls = call_log.drop_duplicates(subset=['CALLS_date'])
+        call_starts = calls['CALLS_date'].dt.floor('s')
+        events = project_events(df['timestamp'], {'saved': (call_log['timestamp'], None, 'count'),
+                                                  'started': (call_starts, None, 'count'),
+                                                  'call_duration': (call_starts, calls['CALLS_duration'], 'sum')})
+        df['call_log'] = np.where(events['saved'] + events['started'] > 0, 1, np.nan).astype(np.float32)
+        df['call_duration'] = events['call_duration']
+        if on_call:
+            starts, ends = call_intervals(call_starts, calls['CALLS_duration'])
+            df['on_call'] = paint_intervals(df['timestamp'], starts, ends)
     else:
-        df = pd.merge(df, call_log, left_on='timestamp', right_index=True, how='left')
+        df['call_log'] = project_events(df['timestamp'], {'call_log': (call_log.index, None, 'flag')})['call_log']
+        if on_call:
+            # Call durations are not known.
+            df['on_call'] = np.nan
     return df
 
-def merge_deadlines(df, deadlines, user):
+@stage
+def merge_deadlines(df, deadlines, user, days_to_deadline=False):
+    # Deadline count of the calendar day of each row. The date key of the rows is calculated once
+    # and joined to the user's deadlines, instead of a month/day mask for each deadline date.
+    # If days_to_deadline is True, days until the next deadline is added as a feature.
     df = df.set_index('timestamp')
     if user in deadlines.columns:
-        user_deadlines = deadlines[user]
-        for i in range(user_deadlines.shape[0]):
-            df.loc[(df.index.month==user_deadlines.index[i].month) &
-                   (df.index.day==user_deadlines.index[i].day), 
-                   'deadlines'] = deadlines[user][i]
+        user_deadlines = pd.to_numeric(deadlines[user])
+        df['deadlines'] = daily_values(df.index, user_deadlines)
+        if days_to_deadline:
+            df['days_to_deadline'] = days_until_next(df.index, user_deadlines.index[user_deadlines > 0])
     else:
         df['deadlines'] = 0
+        if days_to_deadline:
+            df['days_to_deadline'] = np.nan
     return df.reset_index()
 
-def merge_app_usage(df, app_usage): # This is same with merge_sms but for understanding.
-    df = pd.merge(df, app_usage, left_on='timestamp', right_index=True, how='left')
+@stage
+def merge_app_usage(df, app_usage):
+    # Number of running apps saved at each second.
+    df['running_apps'] = project_events(df['timestamp'], {'running_apps': (app_usage.index, app_usage['running_apps'],
+                                                                          'sum')})['running_apps']
     return df
 
 
 ## Merge combiner ##
 def merge_all(user_name, activity, audio, conversation, bluetooth, wifi, dark, 
-              phone_charge, phone_lock, sms, call_log, deadlines, app_usage):
+              phone_charge, phone_lock, sms, call_log, deadlines, app_usage, days_to_deadline=False,
+              on_call=False):
     # Firstly add hour of the day to the dataset.
     activity['hour_of_day'] = activity.index.hour
     df = merge_audio(activity, audio)
-    print('audio merge completed.')
     df = merge_conversation(df, conversation)
-    print('conversation merge completed.')
     df = merge_bluetooth(df, bluetooth)
-    print('bluetooth merge completed.')
     df = merge_wifi(df, wifi)
-    print('wifi merge completed.')
     df = merge_dark(df, dark)
-    print('dark merge completed.')
     df = merge_phone_charge(df, phone_charge)
-    print('phone_charge merge completed.')
     df = merge_phone_lock(df, phone_lock)
-    print('phone_lock merge completed.')
     df = merge_sms(df, sms)
-    print('sms merge completed.')
-    df = merge_call_log(df, call_log)
-    print('call_log merge completed')
-    df = merge_deadlines(df, deadlines, user_name)
-    print('deadlines merge completed')
+    df = merge_call_log(df, call_log, on_call=on_call)
+    df = merge_deadlines(df, deadlines, user_name, days_to_deadline=days_to_deadline)
     df = merge_app_usage(df, app_usage)
-    print('app_usage merge completed')
     return df
 
 
-### EMA Functions ###
-# EMA functions to create labels.
-
-def ema(user, typ, cols, loc):
-    data = pd.read_json(loc + 'EMA/response/' + typ + '/' + typ + '_' + user + '.json')
-    if 'null' in data.columns:
-        data = data.drop(columns='null')
-    if 'location' in data.columns:
-        data = data.drop(columns='location')
-    # Checks if the given columns exists in data, if exists drop them.
-    dr = True 
-    for j in cols:
-        if j not in data.columns:
-            dr = False
-    if dr == True:
-        data = data.dropna(subset=cols)
-    return data
-
-def label_generator(stress, mood2, resample_factor):
-    stress['level'] = stress['level'].replace([1,2,3], 1)
-    stress['level'] = stress['level'].replace([4,5], 0)
-    stress.columns = ['STRESSED', 'resp_time']
-    mood2 = mood2.replace([1, 3], 0)
-    mood2 = mood2.replace([2], 1)
-    mood2.columns = ['STRESSED', 'resp_time']
-    labels = stress.append(mood2)
-    labels = labels.sort_values(by='resp_time', ascending=True)
-    labels = labels.set_index('resp_time').resample(resample_factor).max()
-    labels = labels[labels.STRESSED.notnull()]
-    return labels
-
 def resample_aggregations(columns):
     # Function to assign aggregation method during resampling
     agg_dict = {}
@@ -322,126 +331,179 @@ def resample_aggregations(columns):
             agg_dict[i] = np.max
     return agg_dict
 
+@stage
+def fill_and_encode(df):
+    # Fills empty values of merged data and one hot encodes activity and audio inferences.
+    # Fill empty values in dataset.
+    df.loc[:, ['activity_inference',
+               'audio_inference']] = df.loc[:, ['activity_inference',
+                                                 'audio_inference']].fillna(value=3)
+
+    df.loc[:, ['conversation',
+        'phone_in_dark',
+        'phone_charging',
+        'phone_locked',
+        'sms',
+        'call_log']] = df.loc[:, ['conversation',
+                                    'phone_in_dark',
+                                    'phone_charging',
+                                    'phone_locked',
+                                    'sms',
+                                    'call_log']].fillna(value=0)
+    if 'on_call' in df.columns:
+        df['on_call'] = df['on_call'].fillna(value=0)
+
+    # One Hot Encode
+    # Columns are replaced instead of set with loc, because a column without missing values keeps
+    # its int8 type from apply_schema and int values can not be set into it.
+    df['activity_inference'] = df['activity_inference'].astype(int).astype('category')
+    df['audio_inference'] = df['audio_inference'].astype(int).astype('category')
+    df = pd.get_dummies(df)
+    # Use compact types (flags as uint8, counts as small ints, RSSI statistics as float32).
+    df = apply_schema(df)
+    return df
+
+
+def source_readers(user, dir_loc, chunksize=None, **kwargs):
+    # Readers of the raw data of the user as {name: function without arguments}, the names are the arguments
+    # of merge_all. They are used by process_user, or called on reader threads by run_users to read the next
+    # users while the current user is merged (see user_runner.py). Other arguments of process_user are ignored.
+    return {'activity': functools.partial(get_activity, user, dir_loc, chunksize=chunksize),
+            'audio': functools.partial(get_audio, user, dir_loc, chunksize=chunksize),
+            'conversation': functools.partial(get_conversation, user, dir_loc),
+            'bluetooth': functools.partial(get_bluetooth, user, dir_loc),
+            'wifi': functools.partial(get_wifi, user, dir_loc),
+            'dark': functools.partial(get_dark, user, dir_loc),
+            'phone_charge': functools.partial(get_phone_charge, user, dir_loc),
+            'phone_lock': functools.partial(get_phone_lock, user, dir_loc),
+            'sms': functools.partial(get_sms, user, dir_loc),
+            'call_log': functools.partial(get_call_log, user, dir_loc),
+            'app_usage': functools.partial(get_app_usage, user, dir_loc)}
+
+def process_user(user, dir_loc, deadlines, label_table, output_format='csv', chunksize=None, days_to_deadline=False,
+                 on_call=False, sources=None):
+    # Reads all data of the user, merges them, adds labels from label_table and saves the prepared data.
+    # output_format is 'csv', 'parquet' or 'feather' (see feature_store.py).
+    # If chunksize is given, activity and audio files are read in chunks of chunksize rows.
+    # If days_to_deadline is True, days until the next deadline is added as a feature.
+    # If on_call is True, seconds during calls are flagged as a feature.
+    # sources are the raw data of the user if they are already read (see source_readers), otherwise they are
+    # read here one after another.
+    if sources is None:
+        sources = {name: reader() for name, reader in source_readers(user, dir_loc, chunksize=chunksize).items()}
+    # Sensing
+    activity = sources['activity']
+    audio = sources['audio']
+    conversation = sources['conversation']
+    bluetooth = sources['bluetooth']
+    wifi = sources['wifi']
+    dark = sources['dark']
+    phone_charge = sources['phone_charge']
+    phone_lock = sources['phone_lock']
+
+    # Not Sensing
+    sms = sources['sms']
+    call_log = sources['call_log']
+    app_usage = sources['app_usage']
+
+    df = merge_all(user, activity, audio, conversation,
+                    bluetooth, wifi, dark,
+                    phone_charge, phone_lock,
+                    sms, call_log, deadlines, app_usage,
+                    days_to_deadline=days_to_deadline, on_call=on_call)
+    
+    # Labels of the user from the EMA label table.
+    labels = user_labels(label_table, user)
+    
+    # Choose only valid timestamps
+    df = df[df.timestamp.notnull()]
+    df = fill_and_encode(df)
+    
+    # Resampling is not done because all resampling can be done afterwards.
+#     # Resampling
+#     df = df.set_index('timestamp')
+#     df.index = pd.to_datetime(df.index, unit='s')
+    
+#     res_aggs = resample_aggregations(list(df.columns))
+#     df = df.resample('10min').agg(res_aggs)
+
+#     # Merge df and labels
+#     df = pd.merge_asof(df, labels, left_index=True, right_index=True, tolerance=pd.Timedelta('10m'))
+    
+    df = stage(attach_labels)(df, labels)
+    
+    write_features(df, 'prepared_user_data_seconds/' + user + '_data', fmt=output_format)
 
 
-def main():
+def main(workers=1, output_format='csv', cache_dir=None, cache_size_gb=20, chunksize=None,
+         stage_log='stage_log.jsonl', days_to_deadline=False, on_call=False, labeled_only=True, prefetch=0,
+         io_workers=4):
     # Set dataset directory
     dir_loc = '../../student-life-study-data/dataset/'
 
-    # Get user list
-    user_codes = get_user_list(dir_loc)
+    # Enable the cache of raw data readers.
+    configure_cache(cache_dir, max_bytes=cache_size_gb * 1024 ** 3)
 
-    # Create empty dataset
-    dataset = pd.DataFrame()
-    
+    # Record time, rows and memory of each stage of each user to stage_log.
+    configure_stage_log(stage_log)
+
+    # Get user list from the dataset manifest (sizes, time spans and label counts of the sources of each user,
+    # see dataset_manifest.py). Users without labels are skipped unless labeled_only is False and
+    # the largest users are processed first.
+    manifest = stage(load_dataset_manifest)(dir_loc, 'dataset_manifest')
+    user_codes = schedule_users(manifest, labeled_only=labeled_only)
+
+    # Deadlines are read once and shared with all users (and worker processes).
     deadlines = get_deadlines(dir_loc)
-    
-    for user in user_codes:
-        # Sensing
-        activity = get_activity(user, dir_loc)
-        print('activity data read for', user, 'is completed.')
-        audio = get_audio(user, dir_loc)
-        print('audio data read for', user, 'is completed.')
-        conversation = get_conversation(user, dir_loc)
-        print('conversation data read for', user, 'is completed.')
-        bluetooth = get_bluetooth(user, dir_loc)
-        print('bluetooth data read for', user, 'is completed.')
-        wifi = get_wifi(user, dir_loc)
-        print('wifi data read for', user, 'is completed.')
-        dark = get_dark(user, dir_loc)
-        print('dark data read for', user, 'is completed.')
-        phone_charge = get_phone_charge(user, dir_loc)
-        print('phone_charge data read for', user, 'is completed.')
-        phone_lock = get_phone_lock(user, dir_loc)
-        print('phone_lock data read for', user, 'is completed.')
-
-        # Not Sensing
-        sms = get_sms(user, dir_loc)
-        print('sms data read for', user, 'is completed.')
-        call_log = get_call_log(user, dir_loc)
-        print('call_log data read for', user, 'is completed.')
-        app_usage = get_app_usage(user, dir_loc)
-        print('app_usage data read for', user, 'is completed.')
-        
-        # EMA
-        stress = ema(user, 'Stress', ['level'], dir_loc)
-        print('stress data read for', user, 'is completed.')
-        mood2 = ema(user, 'Mood 2', ['how'], dir_loc)
-        print('mood2 data read for', user, 'is completed.')
-        
-        print('ALL DATA READ IS COMPLETED FOR', user)
-
-
-        df = merge_all(user, activity, audio, conversation,
-                        bluetooth, wifi, dark,
-                        phone_charge, phone_lock,
-                        sms, call_log, deadlines, app_usage)
-        
-        print('Shape of df after merge:', str(df.shape))
-        print('DATA MERGE IS COMPLETED FOR', user)
-        
-        # Create labels
-        if stress.shape[1] == 2:
-            stress['level'] = stress['level'].replace([1,2,3], 1)
-            stress['level'] = stress['level'].replace([4,5], 0)
-            stress.columns = ['STRESSED', 'resp_time']
-
-        if mood2.shape[1] == 2:
-            mood2 = mood2.replace([1, 3], 0)
-            mood2 = mood2.replace([2], 1)
-            mood2.columns = ['STRESSED', 'resp_time']
-
-        labels = stress.append(mood2)
-        labels = labels.sort_values(by='resp_time', ascending=True)
-        labels = labels.set_index('resp_time')
-        
-        # Choose only valid timestamps
-        df = df[df.timestamp.notnull()]
-        
-        # Fill empty values in dataset.
-        df.loc[:, ['activity_inference',
-                   'audio_inference']] = df.loc[:, ['activity_inference',
-                                                     'audio_inference']].fillna(value=3)
-        
-        df.loc[:, ['conversation',
-            'phone_in_dark',
-            'phone_charging',
-            'phone_locked',
-            'sms',
-            'call_log']] = df.loc[:, ['conversation',
-                                        'phone_in_dark',
-                                        'phone_charging',
-                                        'phone_locked',
-                                        'sms',
-                                        'call_log']].fillna(value=0)
-        
-        df.loc[:, ['activity_inference', 
-           'audio_inference']] = df.loc[:, ['activity_inference', 
-                                            'audio_inference']].astype(int)
-        
-        # One Hot Encode
-        df['activity_inference'] = df['activity_inference'].astype('category')
-        df['audio_inference'] = df['audio_inference'].astype('category')
-        df = pd.get_dummies(df)
-        
-        # Resampling is not done because all resampling can be done afterwards.
-#         # Resampling
-#         df = df.set_index('timestamp')
-#         df.index = pd.to_datetime(df.index, unit='s')
-        
-#         res_aggs = resample_aggregations(list(df.columns))
-#         df = df.resample('10min').agg(res_aggs)
-
-#         # Merge df and labels
-#         df = pd.merge_asof(df, labels, left_index=True, right_index=True, tolerance=pd.Timedelta('10m'))
-        
-        df = pd.merge(df, labels, left_on='timestamp', right_index=True, how='left')
-        
-        df.to_csv('prepared_user_data_seconds/' + user + '_data.csv', index=False, header=True)
-        
-        print(user, 'IS COMPLETED.')
-        print('Shape of df is:', str(df.shape))
-        
-
-main()
-print("ALL COMPLETED.")
\ No newline at end of file
+
+    # EMA files of all users are converted to a label table once (in parallel if workers > 1) and saved
+    # to ema_labels.parquet. It is built again only when an EMA file changes.
+    label_table = stage(load_label_table)(dir_loc, 'ema_labels', workers=workers)
+
+    # Each user is processed separately, if workers > 1 users are processed in parallel.
+    # Failure of a user is reported and does not stop the others.
+    # If users are processed one after another, raw files of the next prefetch users are read on io_workers
+    # threads while the current user is merged.
+    run_users(process_user, user_codes, workers=workers, source_readers=source_readers, prefetch=prefetch,
+              io_workers=io_workers, dir_loc=dir_loc, deadlines=deadlines, label_table=label_table,
+              output_format=output_format, chunksize=chunksize, days_to_deadline=days_to_deadline,
+              on_call=on_call)
+
+    # Summary of the slowest stages and users.
+    if stage_log is not None:
+        write_summary(stage_log)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Prepares per-second features of each user.')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of users processed at the same time in separate processes')
+    parser.add_argument('--output-format', default='csv', choices=sorted(FEATURE_FORMATS),
+                        help='file format of prepared user data, parquet and feather are compressed columnar files')
+    parser.add_argument('--cache-dir', default=None,
+                        help='directory to cache outputs of raw data readers, disabled if not given')
+    parser.add_argument('--cache-size-gb', type=float, default=20,
+                        help='size limit of the reader cache, least recently used files are deleted above it')
+    parser.add_argument('--chunksize', type=int, default=None,
+                        help='read activity and audio files in chunks of this many rows to limit memory usage')
+    parser.add_argument('--stage-log', default='stage_log.jsonl',
+                        help='json lines file of time, rows and memory of each stage of each user')
+    parser.add_argument('--days-to-deadline', action='store_true',
+                        help='add days until the next deadline of the user as a feature')
+    parser.add_argument('--on-call', action='store_true',
+                        help='add a flag of the seconds during calls (from call dates and durations) as a feature')
+    parser.add_argument('--all-users', action='store_true',
+                        help='also process users without EMA labels')
+    parser.add_argument('--prefetch', type=int, default=0,
+                        help='users whose raw files are read ahead while the current user is merged (if --workers 1), '
+                             '0 reads them one after another (peak memory of stages is shared with reader threads '
+                             'otherwise, see stage_monitor.py)')
+    parser.add_argument('--io-workers', type=int, default=4,
+                        help='threads reading raw files of the next users')
+    args = parser.parse_args()
+    main(workers=args.workers, output_format=args.output_format,
+         cache_dir=args.cache_dir, cache_size_gb=args.cache_size_gb, chunksize=args.chunksize,
+         stage_log=args.stage_log, days_to_deadline=args.days_to_deadline,
+         on_call=args.on_call, labeled_only=not args.all_users, prefetch=args.prefetch,
+         io_workers=args.io_workers)
+    print("ALL COMPLETED.")
\ No newline at end of file
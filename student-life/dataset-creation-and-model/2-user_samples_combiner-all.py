@@ -2,28 +2,42 @@ import pandas as pd
 import numpy as np
 import os
 
-def resample_aggregations(columns):
-    # Function to assign aggregation method during resampling.
-    agg_dict = {}
-    for i in columns:
-        if 'level' in i:
-            agg_dict[i] = np.mean
-        elif 'total' in i:
-            agg_dict[i] = np.max
+from feature_store import user_feature_files, feature_columns, union_columns, SampleWriter
+from feature_query import read_features_range
+from resample_utils import resample_data, multi_resample
+from stage_monitor import stage, configure_stage_log, set_stage_user, write_summary
+from dataset_manifest import manifest_labeled_users, file_user
+
+
+def extract_samples(df, res_range):
+    # Extract indexes of labeled rows.
+    label_indexes = list(df[df.STRESSED.notnull()].index)
+
+    # This loop checks the difference between two label indexes.
+    # If the difference is lower than treshold (12, two hours),
+    # It continues to next index until pass the treshold.
+    # Therefore, every instance's length become more than treshold.
+    
+    # Create different tresholds for each resample range to have minimum 2 hour period.
+    tresholds = {'10min': 12, '15min': 8, '20min': 6, '30min': 4, '45min': 2, '60min': 2}
+    
+    start = 0
+    new_index_ranges = []
+    for i in label_indexes:
+        if i - start >= tresholds[res_range]:
+            new_index_ranges.append([start, i+1])
+            start = i+1
         else:
-            agg_dict[i] = np.sum
-    return agg_dict
+            continue
 
+    # Extract each sample from the user data.
+    return [df.iloc[ranges[0]: ranges[1], :] for ranges in new_index_ranges]
 
-def resample_data(df, labels, res_range='10min'):
-    # Resamples data according to res_range and it chooses which calculation will be done
-    # for each features based on resample_aggregations fuction.
-    df = df.set_index('timestamp')
-    df.index = pd.to_datetime(df.index)
-    res_aggs = resample_aggregations(list(df.columns))
-    df = df.resample(res_range).agg(res_aggs)
-    df = pd.merge_asof(df, labels, left_index=True, right_index=True, tolerance=pd.Timedelta(res_range))
-    return df
+def sample_columns(columns):
+    # Column order of extracted samples of a user with given per-second columns.
+    # (hour_of_day is created again after resampling and labels are merged after features.)
+    features = [i for i in columns if i not in ['timestamp', 'hour_of_day', 'STRESSED']]
+    return ['timestamp'] + features + ['STRESSED', 'hour_of_day']
 
 
 # Set user data dir
@@ -32,61 +46,81 @@ datadir = 'prepared_user_data_seconds/'
 # Save dir
 savedir = 'combined_samples/'
 
-# Get files in dir
-files = sorted(os.listdir(datadir))
+# Save format of combined samples, 'csv', 'parquet' or 'feather' (see feature_store.py).
+output_format = 'csv'
 
-# Create empty dataframe to add new samples
-combined_data = pd.DataFrame()
+# Resample ranges, a dataset is created for each of them.
+res_ranges = ['10min', '15min', '20min', '30min', '45min', '60min']
 
-for res_range in ['10min', '15min', '20min', '30min', '45min', '60min']:
-    # For each user extract each sample and add to combined_data.
-    for user in files:
-        df = pd.read_csv(datadir + user)
+# If True, per-second data is resampled once to the finest bins (5 min) and all resample ranges
+# are calculated from these bins. If False, per-second data is resampled separately for each range.
+single_pass = True
 
-        # Checks if the labels exist.
-        if 'STRESSED' not in df.columns:
-            print(user, 'has no label data.')
-            continue
+# Time range of the combined samples, e.g. ('2013-04-01', '2013-05-01'), (None, None) uses all data.
+# Only the rows of the range are read from prepared files (see feature_query.py).
+time_range = (None, None)
+
+# Time, rows and memory of reading, resampling and sample extraction of each user are recorded to this file.
+stage_log = 'combiner_stage_log.jsonl'
+configure_stage_log(stage_log)
+
+# Get files in dir (csv, parquet or feather files of users)
+files = user_feature_files(datadir)
+
+# Users without EMA labels in the dataset manifest (saved by "1-dataset-preparation-seconds.py", see
+# dataset_manifest.py) are skipped before their files are read. All users are used if there is no manifest.
+labeled = manifest_labeled_users('dataset_manifest.csv')
+if labeled is not None:
+    for user in [i for i in files if file_user(i) not in labeled]:
+        print(user, 'has no label data.')
+        del files[user]
+
+# Only column names are read to find users with labels and columns of combined data.
+user_columns = {user: feature_columns(path) for user, path in files.items()}
+columns = union_columns([sample_columns(i) for i in user_columns.values() if 'STRESSED' in i])
+
+# Samples of each user are written directly to the file of each resample range.
+writers = {res_range: SampleWriter(savedir + 'combined_data_all_' + res_range, columns, fmt=output_format)
+           for res_range in res_ranges}
+
+# Each user is read once and samples of all resample ranges are extracted.
+for user, path in files.items():
+    # Checks if the labels exist.
+    user_cols = user_columns[user]
+    if 'STRESSED' not in user_cols:
+        print(user, 'has no label data.')
+        continue
+
+    set_stage_user(user)
+
+    # Only needed columns are read (hour_of_day is created again after resampling).
+    df = stage(read_features_range)(path, time_range[0], time_range[1],
+                                    columns=[i for i in user_cols if i != 'hour_of_day'])
+
+    labels = df.loc[df.STRESSED.notnull(), ['timestamp', 'STRESSED']]
+    labels = labels.set_index('timestamp')
+    labels.index = pd.to_datetime(labels.index)
+
+    df = df.drop(columns=['STRESSED'])
+
+    if single_pass:
+        resampled = stage(multi_resample)(df, labels, res_ranges)
+    else:
+        resampled = {res_range: stage(resample_data)(df, labels, res_range=res_range) for res_range in res_ranges}
+
+    for res_range in res_ranges:
+        res_df = resampled[res_range]
+
+        res_df['hour_of_day'] = res_df.index.hour
+
+        res_df = res_df.reset_index()
+
+        # Extract each sample from the user data and write to the file of the resample range.
+        writers[res_range].write(stage(extract_samples)(res_df, res_range))
+    print(user, 'is completed.')
 
-        labels = df.loc[df.STRESSED.notnull(), ['timestamp', 'STRESSED']]
-        labels = labels.set_index('timestamp')
-        labels.index = pd.to_datetime(labels.index)
-
-        df = df.drop(columns=['hour_of_day', 'STRESSED'])
-
-        df = resample_data(df, labels, res_range=res_range)
-
-        df['hour_of_day'] = df.index.hour
-
-        df = df.reset_index()
-
-        # Extract indexes of labeled rows.
-        label_indexes = list(df[df.STRESSED.notnull()].index)
-
-        # This loop checks the difference between two label indexes.
-        # If the difference is lower than treshold (12, two hours),
-        # It continues to next index until pass the treshold.
-        # Therefore, every instance's length become more than treshold.
-        
-        # Create different tresholds for each resample range to have minimum 2 hour period.
-        tresholds = {'10min': 12, '15min': 8, '20min': 6, '30min': 4, '45min': 2, '60min': 2}
-        
-        start = 0
-        new_index_ranges = []
-        for i in label_indexes:
-            if i - start >= tresholds[res_range]:
-                new_index_ranges.append([start, i+1])
-                start = i+1
-            else:
-                continue
-
-        # Extract each sample from the user data and append to combined_data.
-        for ranges in new_index_ranges:
-            sample = df.iloc[ranges[0]: ranges[1], :]
-            combined_data = combined_data.append(sample, ignore_index=True, sort=False)
-        print(user, 'is completed.')
-
-    combined_data.to_csv(savedir + 'combined_data_all_' + res_range + '.csv')
+for res_range in res_ranges:
+    writers[res_range].close()
     print('All Completed for', res_range)
-    combined_data = pd.DataFrame()
+write_summary(stage_log)
 print('ALL COMPLETED.')
\ No newline at end of file
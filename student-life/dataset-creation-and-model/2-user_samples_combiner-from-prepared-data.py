@@ -2,17 +2,34 @@ import pandas as pd
 import numpy as np
 import os
 
+from feature_store import feature_columns, union_columns, SampleWriter
+from dataset_manifest import manifest_labeled_users, file_user
+
 # Set user data dir
 datadir = 'prepared_user_data/'
 
 # Save dir
 savedir = 'combined_samples/'
 
+# Save format of combined samples, 'csv', 'parquet' or 'feather' (see feature_store.py).
+output_format = 'csv'
+
 # Get files in dir
 files = sorted(os.listdir(datadir))
 
-# Create empty dataframe to add new samples
-combined_data = pd.DataFrame()
+# Users without EMA labels in the dataset manifest (see dataset_manifest.py) are skipped before their files are read.
+labeled = manifest_labeled_users('dataset_manifest.csv')
+if labeled is not None:
+    for user in [i for i in files if file_user(i) not in labeled]:
+        print(user, 'has no label data.')
+    files = [i for i in files if file_user(i) in labeled]
+
+# Only column names are read to find columns of combined data (from users with labels).
+user_columns = [feature_columns(datadir + user) for user in files]
+columns = union_columns([i for i in user_columns if 'STRESSED' in i])
+
+# Samples of each user are written directly to the file.
+writer = SampleWriter(savedir + 'combined_data', columns, fmt=output_format)
 
 # For each user extract each sample and add to combined_data.
 for user in files:
@@ -39,11 +56,9 @@ for user in files:
         else:
             continue
 
-    # Extract each sample from the user data and append to combined_data.
-    for ranges in new_index_ranges:
-        sample = df.iloc[ranges[0]: ranges[1], :]
-        combined_data = combined_data.append(sample, ignore_index=True, sort=False)
+    # Extract each sample from the user data and write to the file.
+    writer.write([df.iloc[ranges[0]: ranges[1], :] for ranges in new_index_ranges])
     print(user, 'is completed.')
 
-combined_data.to_csv(savedir + 'combined_data.csv')
+writer.close()
 print('ALL COMPLETED.')
\ No newline at end of file
@@ -0,0 +1,150 @@
+import os
+import json
+import time
+import tempfile
+import argparse
+import importlib.util
+import pandas as pd
+
+from synthetic_data import generate_dataset
+from resample_utils import resample_data, multi_resample
+from sequence_builder import build_tensors, create_statistics_instances
+from label_table import build_label_table, user_labels, attach_labels
+
+# Benchmark of the dataset preparation pipeline on a synthetic dataset (see synthetic_data.py).
+# Each get_*, merge_*, resample and window building stage is timed separately for each user.
+# Throughput of a stage is reported as seconds of timeline (duration of the user data) processed
+# per wall-clock second, so results of datasets with different sizes can be compared.
+
+# Resample ranges of the combiner and sequence length of the final model.
+RES_RANGES = ['10min', '15min', '30min', '45min', '60min']
+SEQUENCE_LENGTH = 24
+
+
+def load_script(path):
+    # Imports a numbered script (e.g. 1-dataset-preparation-seconds.py) as a module.
+    spec = importlib.util.spec_from_file_location(os.path.basename(path).split('.')[0].replace('-', '_'), path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+class StageTimer(object):
+    # Collects wall-clock time of each stage over all users.
+
+    def __init__(self, repeat=1):
+        self.repeat = repeat
+        self.times = {}
+        self.timeline = 0
+
+    def run(self, stage, function, *args, **kwargs):
+        # Runs function repeat times and keeps the best time. Arguments are copied for each run,
+        # because some merge functions change their input.
+        best = None
+        for i in range(self.repeat):
+            run_args = [a.copy() if isinstance(a, (pd.DataFrame, pd.Series)) else a for a in args]
+            start = time.perf_counter()
+            result = function(*run_args, **kwargs)
+            duration = time.perf_counter() - start
+            best = duration if best is None else min(best, duration)
+        self.times[stage] = self.times.get(stage, 0) + best
+        return result
+
+    def report(self):
+        # Returns [{stage, seconds, timeline seconds, throughput}] in order of the stages.
+        rows = []
+        for stage, seconds in self.times.items():
+            rows.append({'stage': stage,
+                         'seconds': seconds,
+                         'timeline_seconds': self.timeline,
+                         'timeline_per_second': self.timeline / seconds if seconds > 0 else float('inf')})
+        return rows
+
+def benchmark_user(prep, timer, user, loc, deadlines, label_table, chunksize=None):
+    # Times all stages of a user, same order with process_user and the combiner.
+    activity = timer.run('get_activity', prep.get_activity, user, loc, chunksize=chunksize)
+    audio = timer.run('get_audio', prep.get_audio, user, loc, chunksize=chunksize)
+    conversation = timer.run('get_conversation', prep.get_conversation, user, loc)
+    bluetooth = timer.run('get_bluetooth', prep.get_bluetooth, user, loc)
+    wifi = timer.run('get_wifi', prep.get_wifi, user, loc)
+    dark = timer.run('get_dark', prep.get_dark, user, loc)
+    phone_charge = timer.run('get_phone_charge', prep.get_phone_charge, user, loc)
+    phone_lock = timer.run('get_phone_lock', prep.get_phone_lock, user, loc)
+    sms = timer.run('get_sms', prep.get_sms, user, loc)
+    call_log = timer.run('get_call_log', prep.get_call_log, user, loc)
+    app_usage = timer.run('get_app_usage', prep.get_app_usage, user, loc)
+    timer.timeline += (activity.index[-1] - activity.index[0]).total_seconds()
+
+    # Merges of merge_all.
+    activity['hour_of_day'] = activity.index.hour
+    df = timer.run('merge_audio', prep.merge_audio, activity, audio)
+    df = timer.run('merge_conversation', prep.merge_conversation, df, conversation)
+    df = timer.run('merge_bluetooth', prep.merge_bluetooth, df, bluetooth)
+    df = timer.run('merge_wifi', prep.merge_wifi, df, wifi)
+    df = timer.run('merge_dark', prep.merge_dark, df, dark)
+    df = timer.run('merge_phone_charge', prep.merge_phone_charge, df, phone_charge)
+    df = timer.run('merge_phone_lock', prep.merge_phone_lock, df, phone_lock)
+    df = timer.run('merge_sms', prep.merge_sms, df, sms)
+    df = timer.run('merge_call_log', prep.merge_call_log, df, call_log)
+    df = timer.run('merge_deadlines', prep.merge_deadlines, df, deadlines, user)
+    df = timer.run('merge_app_usage', prep.merge_app_usage, df, app_usage)
+
+    labels = timer.run('user_labels', user_labels, label_table, user)
+    df = timer.run('fill_and_encode', prep.fill_and_encode, df[df.timestamp.notnull()])
+    df = timer.run('attach_labels', attach_labels, df, labels)
+
+    # Resampling of the combiner, labels are taken from the data and hour_of_day is added after resampling.
+    labels = df.loc[df.STRESSED.notnull(), ['timestamp', 'STRESSED']].set_index('timestamp')
+    data = df.drop(columns=['hour_of_day', 'STRESSED'])
+    for res_range in RES_RANGES:
+        timer.run('resample_data', resample_data, data, labels, res_range)
+    resampled = timer.run('multi_resample', multi_resample, data, labels, RES_RANGES)
+
+    # Windows of the models.
+    samples = resampled['30min']
+    samples['hour_of_day'] = samples.index.hour
+    samples = samples.reset_index()
+    timer.run('build_tensors', build_tensors, samples, SEQUENCE_LENGTH)
+    timer.run('create_statistics_instances', create_statistics_instances,
+              samples.drop(columns=['timestamp']), SEQUENCE_LENGTH)
+
+def run_benchmark(loc=None, users=3, days=7, density=1.0, repeat=1, chunksize=None, seed=0):
+    # Runs the benchmark on the dataset in loc. If loc is None, a synthetic dataset is generated
+    # to a temporary directory and deleted at the end. Returns the report rows.
+    prep = load_script(os.path.join(os.path.dirname(os.path.abspath(__file__)), '1-dataset-preparation-seconds.py'))
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if loc is None:
+            loc = tmp_dir + '/'
+            generate_dataset(loc, users=users, days=days, density=density, seed=seed)
+        timer = StageTimer(repeat=repeat)
+        deadlines = timer.run('get_deadlines', prep.get_deadlines, loc)
+        label_table = timer.run('build_label_table', build_label_table, loc)
+        for user in prep.get_user_list(loc):
+            benchmark_user(prep, timer, user, loc, deadlines, label_table, chunksize=chunksize)
+        return timer.report()
+
+def print_report(rows):
+    print('{:<30}{:>12}{:>28}'.format('stage', 'seconds', 'timeline seconds / second'))
+    for row in rows:
+        print('{:<30}{:>12.3f}{:>28.0f}'.format(row['stage'], row['seconds'], row['timeline_per_second']))
+    total = sum(row['seconds'] for row in rows)
+    timeline = rows[0]['timeline_seconds'] if rows else 0
+    print('{:<30}{:>12.3f}{:>28.0f}'.format('total', total, timeline / total if total > 0 else 0))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks the dataset preparation stages on synthetic data.')
+    parser.add_argument('--loc', default=None,
+                        help='dataset directory to benchmark, a synthetic dataset is generated if not given')
+    parser.add_argument('--users', type=int, default=3, help='number of synthetic users')
+    parser.add_argument('--days', type=float, default=7, help='duration of synthetic data of each user in days')
+    parser.add_argument('--density', type=float, default=1.0, help='scale of the number of synthetic events')
+    parser.add_argument('--repeat', type=int, default=1, help='runs of each stage, the best time is reported')
+    parser.add_argument('--chunksize', type=int, default=None, help='read activity and audio files in chunks')
+    parser.add_argument('--output', default=None, help='json file to save the results')
+    args = parser.parse_args()
+    rows = run_benchmark(loc=args.loc, users=args.users, days=args.days, density=args.density,
+                         repeat=args.repeat, chunksize=args.chunksize)
+    print_report(rows)
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump({'settings': vars(args), 'stages': rows}, f, indent=1)
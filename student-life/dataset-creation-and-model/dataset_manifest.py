@@ -0,0 +1,166 @@
+import os
+import glob
+import numpy as np
+import pandas as pd
+
+from feature_store import write_features, read_features, FEATURE_FORMATS
+from label_table import EMA_SOURCES, read_ema_labels
+
+# Manifest of the raw dataset: one row for each (user, source) with the file size, an estimate of the number
+# of rows, the first and last timestamp and the number of EMA labels. It is built with a stat call and
+# a read of the first and last sample_bytes of each file, so large sensing files are not read.
+# The dataset preparation scripts use it to skip users without labels and to process the largest users
+# first, and the combiner uses it to skip unlabeled users before reading their prepared data.
+
+# Raw csv files of each user with the positions of the columns of the first and last timestamp of a row.
+CSV_SOURCES = {'activity': ('sensing/activity/activity_{user}.csv', 0, 0),
+               'audio': ('sensing/audio/audio_{user}.csv', 0, 0),
+               'conversation': ('sensing/conversation/conversation_{user}.csv', 0, 1),
+               'bluetooth': ('sensing/bluetooth/bt_{user}.csv', 0, 0),
+               'wifi': ('sensing/wifi/wifi_{user}.csv', 0, 0),
+               'dark': ('sensing/dark/dark_{user}.csv', 0, 1),
+               'phonecharge': ('sensing/phonecharge/phonecharge_{user}.csv', 0, 1),
+               'phonelock': ('sensing/phonelock/phonelock_{user}.csv', 0, 1),
+               'sms': ('sms/sms_{user}.csv', 2, 2),
+               'call_log': ('call_log/call_log_{user}.csv', 2, 2),
+               'app_usage': ('app_usage/running_app_{user}.csv', 2, 2)}
+
+# EMA responses are small json files, they are read to count the labels (see label_table.py).
+EMA_TEMPLATE = 'EMA/response/{source}/{source}_{user}.json'
+
+MANIFEST_COLUMNS = ['user', 'source', 'path', 'bytes', 'mtime_ns', 'rows_estimate', 'min_time', 'max_time',
+                    'label_count']
+
+# Bytes read from the start and from the end of each csv file.
+SAMPLE_BYTES = 256 * 1024
+
+
+def _users_of(loc, template):
+    # {user: path} of the files of a template.
+    prefix, suffix = template.split('{user}')
+    files = {}
+    for path in glob.glob(os.path.join(loc, prefix + '*' + suffix)):
+        files[os.path.basename(path)[len(os.path.basename(prefix)):-len(suffix)]] = path
+    return files
+
+def _parse_times(lines, column):
+    # Unix times in the column of csv lines (without the header), lines that can not be parsed are skipped.
+    # Time columns come before any quoted column in all sources, so lines are split without a csv parser.
+    times = []
+    for line in lines.split(b'\n'):
+        fields = line.split(b',', column + 1)
+        if len(fields) > column:
+            try:
+                times.append(float(fields[column]))
+            except ValueError:
+                continue
+    return np.array(times, dtype=np.float64)
+
+def sample_csv(path, start_col, end_col, sample_bytes=SAMPLE_BYTES):
+    # Returns (rows estimate, min time, max time) of a csv file from its first and last sample_bytes.
+    # The number of rows is exact for files smaller than 2 * sample_bytes, otherwise it is estimated
+    # from the average row size of the first block.
+    size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        header = f.readline()
+        if size <= 2 * sample_bytes:
+            body = f.read()
+            rows = body.count(b'\n') + (0 if body.endswith(b'\n') or not body else 1)
+            first = _parse_times(body, start_col)
+            last = _parse_times(body, end_col)
+            return rows, (first.min() if len(first) else None), (last.max() if len(last) else None)
+        head = f.read(sample_bytes)
+        head = head[:head.rfind(b'\n') + 1]
+        f.seek(size - sample_bytes)
+        tail = f.read()
+        # The first line of the tail block is probably not complete.
+        tail = tail[tail.find(b'\n') + 1:]
+    head_rows = max(head.count(b'\n'), 1)
+    rows = int(round((size - len(header)) / (len(head) / float(head_rows))))
+    first = _parse_times(head, start_col)
+    last = _parse_times(tail, end_col)
+    return rows, (first.min() if len(first) else None), (last.max() if len(last) else None)
+
+def build_dataset_manifest(loc, sample_bytes=SAMPLE_BYTES):
+    # Scans the dataset in loc and returns the manifest as a data frame.
+    records = []
+    for source, (template, start_col, end_col) in CSV_SOURCES.items():
+        for user, path in sorted(_users_of(loc, template).items()):
+            stat = os.stat(path)
+            rows, min_time, max_time = sample_csv(path, start_col, end_col, sample_bytes)
+            records.append([user, source, path, stat.st_size, stat.st_mtime_ns, rows, min_time, max_time, 0])
+    for source in EMA_SOURCES:
+        for user, path in sorted(_users_of(loc, EMA_TEMPLATE.replace('{source}', source)).items()):
+            stat = os.stat(path)
+            labels = read_ema_labels((user, source, path))
+            times = pd.to_datetime(labels['resp_time']).values.astype('datetime64[s]').astype(np.float64)
+            records.append([user, 'EMA ' + source, path, stat.st_size, stat.st_mtime_ns, len(labels),
+                            times.min() if len(times) else None, times.max() if len(times) else None, len(labels)])
+    manifest = pd.DataFrame(records, columns=MANIFEST_COLUMNS)
+    for column in ['min_time', 'max_time']:
+        manifest[column] = pd.to_datetime(manifest[column], unit='s')
+    return manifest.sort_values(by=['user', 'source']).reset_index(drop=True)
+
+def _is_current(manifest, loc):
+    # True if the files of the manifest are the files of the dataset and none of them changed.
+    paths = set()
+    for template, start_col, end_col in CSV_SOURCES.values():
+        paths.update(_users_of(loc, template).values())
+    for source in EMA_SOURCES:
+        paths.update(_users_of(loc, EMA_TEMPLATE.replace('{source}', source)).values())
+    if paths != set(manifest['path']):
+        return False
+    return all(os.stat(path).st_mtime_ns == mtime for path, mtime in zip(manifest['path'], manifest['mtime_ns']))
+
+def load_dataset_manifest(loc, path='dataset_manifest', fmt='csv'):
+    # Reads the manifest from path (without extension). It is built and saved first if it does not exist,
+    # or if a file of the dataset is added, removed or changed (checked with stat calls only).
+    full_path = path + FEATURE_FORMATS[fmt]
+    if os.path.exists(full_path):
+        manifest = read_features(full_path)
+        for column in ['min_time', 'max_time']:
+            manifest[column] = pd.to_datetime(manifest[column])
+        if _is_current(manifest, loc):
+            return manifest
+    manifest = build_dataset_manifest(loc)
+    write_features(manifest, path, fmt=fmt, time_col=None)
+    return manifest
+
+def user_summary(manifest):
+    # One row for each user: total bytes of the sources, label count, first and last time and the sources,
+    # the largest user first.
+    groups = manifest.groupby('user')
+    summary = groups.agg({'bytes': 'sum', 'label_count': 'sum', 'min_time': 'min', 'max_time': 'max'})
+    summary['sources'] = groups['source'].apply(sorted)
+    return summary.sort_values(by='bytes', ascending=False, kind='mergesort')
+
+def schedule_users(manifest, labeled_only=True, required=('activity',)):
+    # Users to process, the largest users first (so the longest users do not finish last in parallel runs).
+    # Users without labels (if labeled_only) or without the required sources are skipped and reported.
+    summary = user_summary(manifest)
+    users = []
+    for user, row in summary.iterrows():
+        missing = [i for i in required if i not in row['sources']]
+        if missing:
+            print(user, 'is skipped, it has no', ', '.join(missing), 'data.')
+        elif labeled_only and row['label_count'] == 0:
+            print(user, 'is skipped, it has no label data.')
+        else:
+            users.append(user)
+    return users
+
+def labeled_users(manifest):
+    # Users with at least one EMA label.
+    summary = user_summary(manifest)
+    return set(summary.index[summary['label_count'] > 0])
+
+def manifest_labeled_users(path='dataset_manifest.csv'):
+    # Labeled users of a saved manifest, None if the manifest does not exist (e.g. for the combiners, which
+    # do not read the raw dataset).
+    if not os.path.exists(path):
+        return None
+    return labeled_users(read_features(path))
+
+def file_user(name):
+    # User code of a prepared data file name, e.g. u00 of u00_data.csv.
+    return os.path.basename(name).split('_')[0].split('.')[0]
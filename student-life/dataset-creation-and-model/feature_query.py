@@ -0,0 +1,170 @@
+import io
+import json
+import os
+import numpy as np
+import pandas as pd
+
+from feature_store import feature_format, user_feature_files, feature_columns, read_features
+
+# Time range queries over prepared per-user feature files, e.g. one day or week of a user,
+# without reading the whole file.
+# - Parquet files are sorted by time and each row group keeps one day (see feature_store.py), the row
+#   groups outside the range are skipped with their min/max statistics.
+# - Csv files get a sparse timestamp index: byte offset and first timestamp of every SPARSE_INDEX_ROWS rows.
+#   It is built once with a scan of the file and saved next to it as <file>.index.json. Only the
+#   blocks of the range are read. Csv files should be sorted by time (files of
+#   "1-dataset-preparation-seconds.py" are), otherwise the whole file is read.
+# - Feather files have no statistics, they are read and filtered.
+# Ranges include start and exclude end.
+
+# Default directory of prepared per-user features.
+DATADIR = 'prepared_user_data_seconds/'
+
+# Rows between two entries of the sparse index of csv files (one day of per-second rows).
+SPARSE_INDEX_ROWS = 24 * 60 * 60
+
+
+def _to_timestamp(value):
+    return None if value is None else pd.Timestamp(value)
+
+def _in_range(df, time_col, start, end):
+    mask = np.ones(len(df), dtype=bool)
+    if start is not None:
+        mask &= (df[time_col] >= start).values
+    if end is not None:
+        mask &= (df[time_col] < end).values
+    return df[mask].reset_index(drop=True)
+
+def _file_state(path):
+    stat = os.stat(path)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+def build_sparse_index(path, time_col='timestamp', every=SPARSE_INDEX_ROWS, block_bytes=64 * 1024 ** 2):
+    # Scans a csv file and returns its sparse index. Line ends are found with numpy in large blocks,
+    # only the timestamps of the indexed rows are parsed.
+    columns = feature_columns(path)
+    time_position = columns.index(time_col)
+    offsets = []
+    times = []
+    with open(path, 'rb') as f:
+        header = f.readline()
+        row_start = len(header)
+        rows = 0
+        block_start = row_start
+        pending = b''
+        while True:
+            block = f.read(block_bytes)
+            if not block:
+                break
+            data = pending + block
+            data_start = block_start - len(pending)
+            line_ends = np.flatnonzero(np.frombuffer(data, dtype=np.uint8) == ord('\n'))
+            # Start of each complete line in this block.
+            starts = np.concatenate(([0], line_ends[:-1] + 1)) if len(line_ends) else np.array([], dtype=np.int64)
+            for i in np.flatnonzero((rows + np.arange(len(starts))) % every == 0):
+                line = data[starts[i]:line_ends[i]]
+                offsets.append(int(data_start + starts[i]))
+                times.append(line.split(b',')[time_position].decode().strip('"'))
+            rows += len(starts)
+            consumed = int(line_ends[-1]) + 1 if len(line_ends) else 0
+            pending = data[consumed:]
+            block_start += len(block)
+        if pending.strip():
+            # Last line without a line end.
+            if rows % every == 0:
+                offsets.append(int(block_start - len(pending)))
+                times.append(pending.split(b',')[time_position].decode().strip('"'))
+            rows += 1
+    parsed = pd.to_datetime(pd.Series(times, dtype=object))
+    index = {'columns': columns, 'time_col': time_col, 'every': every, 'rows': rows,
+             'offsets': offsets, 'times': [str(i) for i in parsed],
+             'sorted': bool(parsed.is_monotonic_increasing) and not parsed.isnull().any()}
+    index.update(_file_state(path))
+    return index
+
+def load_sparse_index(path, time_col='timestamp'):
+    # Returns the sparse index of a csv file, it is built and saved if it does not exist or the file changed.
+    index_path = path + '.index.json'
+    if os.path.exists(index_path):
+        with open(index_path) as f:
+            index = json.load(f)
+        state = _file_state(path)
+        if index['size'] == state['size'] and index['mtime_ns'] == state['mtime_ns'] and index['time_col'] == time_col:
+            return index
+    index = build_sparse_index(path, time_col=time_col)
+    tmp_path = index_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(index, f)
+    os.replace(tmp_path, index_path)
+    return index
+
+def read_csv_range(path, start=None, end=None, columns=None, time_col='timestamp'):
+    # Reads rows of a time-sorted csv file between start and end using its sparse index.
+    if start is None and end is None:
+        # The whole file is read, the index is not needed.
+        return pd.read_csv(path, usecols=columns, parse_dates=[time_col])
+    index = load_sparse_index(path, time_col=time_col)
+    usecols = None if columns is None else [i for i in index['columns'] if i in columns or i == time_col]
+    if not index['sorted'] or len(index['offsets']) == 0:
+        df = pd.read_csv(path, usecols=usecols, parse_dates=[time_col])
+        return _in_range(df, time_col, start, end)
+    times = pd.to_datetime(pd.Series(index['times'])).values
+    offsets = index['offsets']
+    # First block that can contain start and the first block that starts at or after end.
+    first = 0 if start is None else max(int(np.searchsorted(times, np.datetime64(start), side='right')) - 1, 0)
+    last = len(offsets) if end is None else int(np.searchsorted(times, np.datetime64(end), side='left'))
+    if last <= first:
+        return pd.read_csv(path, usecols=usecols, parse_dates=[time_col], nrows=0)
+    with open(path, 'rb') as f:
+        f.seek(offsets[first])
+        if last < len(offsets):
+            data = f.read(offsets[last] - offsets[first])
+        else:
+            data = f.read()
+    df = pd.read_csv(io.BytesIO(data), header=None, names=index['columns'], usecols=usecols, parse_dates=[time_col])
+    return _in_range(df, time_col, start, end)
+
+def read_features_range(path, start=None, end=None, columns=None, time_col='timestamp'):
+    # Reads rows of a feature file (csv, parquet or feather) between start and end.
+    # If columns is given only these columns (and the time column) are read.
+    start = _to_timestamp(start)
+    end = _to_timestamp(end)
+    if columns is not None and time_col not in columns:
+        columns = [time_col] + list(columns)
+    fmt = feature_format(path)
+    if fmt == 'csv':
+        return read_csv_range(path, start, end, columns, time_col)
+    if fmt == 'parquet':
+        filters = []
+        if start is not None:
+            filters.append((time_col, '>=', start))
+        if end is not None:
+            filters.append((time_col, '<', end))
+        df = pd.read_parquet(path, engine='pyarrow', columns=columns, filters=filters or None)
+        return df.reset_index(drop=True)
+    return _in_range(read_features(path, columns=columns), time_col, start, end)
+
+def user_feature_path(user, datadir=DATADIR):
+    # Path of the prepared features of a user, e.g. prepared_user_data_seconds/u00_data.parquet.
+    files = user_feature_files(datadir)
+    for name in [user, user + '_data']:
+        if name in files:
+            return files[name]
+    raise FileNotFoundError('No feature file of user ' + user + ' in ' + datadir)
+
+def load_user_features(user, start=None, end=None, columns=None, datadir=DATADIR):
+    # Reads the prepared features of a user between start and end (e.g. '2013-04-01', '2013-04-08').
+    return read_features_range(user_feature_path(user, datadir), start, end, columns)
+
+def load_label_windows(user, window='2h', columns=None, label='STRESSED', datadir=DATADIR):
+    # Returns [(label time, label, features of the window before the label)] of a user. Only the label
+    # column is read for the whole file, features are read for the windows of the labels.
+    path = user_feature_path(user, datadir)
+    labels = read_features_range(path, columns=[label])
+    labels = labels[labels[label].notnull()]
+    window = pd.Timedelta(window)
+    windows = []
+    for time, value in zip(pd.to_datetime(labels['timestamp']), labels[label]):
+        windows.append((time, value, read_features_range(path, time - window, time + pd.Timedelta(seconds=1),
+                                                         columns=columns)))
+    return windows
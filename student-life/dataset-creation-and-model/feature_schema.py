@@ -0,0 +1,64 @@
+import numpy as np
+
+# Compact column types of the per-second feature frame.
+# Default pandas types (float64/int64) use 8 bytes per value although most columns are 0/1 flags or
+# small counts. Types are chosen from column names in the same way as resample_aggregations.
+# Timestamps stay datetime64[ns], which is stored as int64 (epoch) and keeps all time functions working.
+
+
+def column_dtype(column):
+    # Returns (type without missing values, type with missing values) of the column.
+    # Returns None for the columns that are not in the schema (e.g. timestamps), they are not changed.
+    if column.endswith('_inference'):
+        # Activity and audio inference codes.
+        return np.int8, np.float32
+    elif ('inference' in column) | ('conversation' in column) | ('phone' in column) | \
+         (column in ['sms', 'call_log', 'on_call']):
+        # Flags and one hot encoded inferences.
+        return np.uint8, np.float32
+    elif 'level' in column:
+        # RSSI statistics and raw levels.
+        return np.float32, np.float32
+    elif ('total' in column) | (column in ['running_apps', 'deadlines', 'days_to_deadline', 'RUNNING_TASKS_numRunning']):
+        # Small counts.
+        return np.uint16, np.float32
+    elif 'duration' in column.lower():
+        # Call durations in seconds.
+        return np.int32, np.float32
+    elif column == 'hour_of_day':
+        return np.uint8, np.float32
+    elif column == 'STRESSED':
+        return np.float32, np.float32
+    return None
+
+def checked_dtype(values, dtype, missing_dtype):
+    # Returns dtype if all values can be stored in it. Integer types are narrow, so values are checked first:
+    # values with fractions get missing_dtype and values out of the range of dtype (e.g. a negative sentinel
+    # of an unsigned column or a count above 65535 of uint16) get the smallest wider integer type.
+    values = np.asarray(values)
+    if not np.issubdtype(dtype, np.integer) or values.dtype.kind not in 'biuf' or len(values) == 0:
+        return dtype
+    if values.dtype.kind == 'f' and (values != np.floor(values)).any():
+        return missing_dtype
+    low, high = int(values.min()), int(values.max())
+    info = np.iinfo(dtype)
+    if info.min <= low and high <= info.max:
+        return dtype
+    return np.promote_types(dtype, np.promote_types(np.min_scalar_type(low), np.min_scalar_type(high))).type
+
+def apply_schema(df, missing=False):
+    # Converts columns of df to their compact types.
+    # Columns with missing values (or all columns if missing=True, e.g. before an outer merge
+    # that creates missing values) get the type that can keep NaN.
+    # Integer types are used only if the values fit to them (see checked_dtype).
+    for column in df.columns:
+        dtypes = column_dtype(str(column))
+        if dtypes is None:
+            continue
+        if missing or df[column].isnull().any():
+            dtype = dtypes[1]
+        else:
+            dtype = checked_dtype(df[column].values, dtypes[0], dtypes[1])
+        if df[column].dtype != dtype:
+            df[column] = df[column].astype(dtype)
+    return df
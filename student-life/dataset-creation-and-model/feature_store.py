@@ -0,0 +1,160 @@
+import os
+import pandas as pd
+import numpy as np
+
+from feature_schema import apply_schema, column_dtype
+
+# Functions to write and read prepared feature files as csv or as typed columnar files (parquet/feather).
+# Columnar files keep the column types, they are compressed and only the requested columns are read.
+# Parquet and feather need the pyarrow package.
+
+# File extension of each output format. If a user has files in multiple formats, the newest one is used
+# (see user_feature_files).
+FEATURE_FORMATS = {'parquet': '.parquet', 'feather': '.feather', 'csv': '.csv'}
+
+# Compression of columnar files.
+COMPRESSION = 'zstd'
+
+# Rows of each parquet row group, one day of per-second rows. Rows are sorted by time before writing,
+# therefore each row group covers a separate time range.
+ROW_GROUP_SIZE = 24 * 60 * 60
+
+
+def feature_format(path):
+    # Finds the format of the file from its extension.
+    for fmt, ext in FEATURE_FORMATS.items():
+        if path.endswith(ext):
+            return fmt
+    raise ValueError('Unknown feature file format: ' + path)
+
+def write_features(df, path, fmt='csv', time_col='timestamp', index=False):
+    # Writes df to path + extension of fmt and returns the full path.
+    path = path + FEATURE_FORMATS[fmt]
+    if fmt == 'csv':
+        df.to_csv(path, index=index, header=True)
+        return path
+    if index:
+        df = df.reset_index()
+    if time_col in df.columns and not df[time_col].is_monotonic_increasing:
+        df = df.sort_values(by=time_col, kind='mergesort')
+    df = df.reset_index(drop=True)
+    if fmt == 'parquet':
+        df.to_parquet(path, engine='pyarrow', compression=COMPRESSION, index=False,
+                      row_group_size=ROW_GROUP_SIZE)
+    else:
+        df.to_feather(path, compression=COMPRESSION)
+    return path
+
+def read_features(path, columns=None):
+    # Reads a feature file, if columns is given only these columns are read.
+    fmt = feature_format(path)
+    if fmt == 'csv':
+        return pd.read_csv(path, usecols=columns)
+    elif fmt == 'parquet':
+        return pd.read_parquet(path, engine='pyarrow', columns=columns)
+    return pd.read_feather(path, columns=columns)
+
+def feature_columns(path):
+    # Returns the column names of a feature file without reading its data.
+    fmt = feature_format(path)
+    if fmt == 'csv':
+        return list(pd.read_csv(path, nrows=0).columns)
+    import pyarrow.parquet as pq
+    import pyarrow.feather as feather
+    if fmt == 'parquet':
+        return list(pq.read_schema(path).names)
+    return list(feather.read_table(path, memory_map=True).column_names)
+
+def user_feature_files(datadir):
+    # Returns {file name without extension: path} for feature files in datadir.
+    # If there are multiple formats of the same file (e.g. after a run with another --output-format),
+    # the most recently written one is chosen, the format coming first in FEATURE_FORMATS for equal times.
+    files = {}
+    for fmt, ext in FEATURE_FORMATS.items():
+        for name in sorted(os.listdir(datadir)):
+            if name.endswith(ext):
+                path = os.path.join(datadir, name)
+                mtime = os.stat(path).st_mtime_ns
+                if name[:-len(ext)] not in files or mtime > files[name[:-len(ext)]][0]:
+                    files[name[:-len(ext)]] = (mtime, path)
+    return {name: path for name, (mtime, path) in sorted(files.items())}
+
+def union_columns(column_lists):
+    # Combines column lists in order of first appearance (same order with appending the frames one by one).
+    columns = []
+    for column_list in column_lists:
+        columns += [i for i in column_list if i not in columns]
+    return columns
+
+
+class SampleWriter(object):
+    # Writes extracted samples to a single file user by user, instead of appending them to a growing frame.
+    # Columns are fixed when the writer is created, therefore users with missing one hot columns
+    # are written with NaN in these columns and the column order is same for all users.
+    # Rows are numbered continuously like DataFrame.append(..., ignore_index=True) and the row number
+    # is saved as the first column as before.
+    # csv and parquet files are written incrementally, so memory usage is bounded by one user.
+    # Feather files cannot be appended, their samples are collected and concatenated once at the end.
+
+    def __init__(self, path, columns, fmt='csv', time_col='timestamp'):
+        self.path = path + FEATURE_FORMATS[fmt]
+        self.columns = list(columns)
+        self.fmt = fmt
+        self.time_col = time_col
+        self.rows = 0
+        self.chunks = []
+        self.parquet_writer = None
+        if fmt == 'csv':
+            self.file = open(self.path, 'w', newline='')
+            pd.DataFrame(columns=self.columns).to_csv(self.file, header=True)
+
+    def _prepare(self, samples):
+        # Concatenates samples of a user, orders the columns and numbers the rows.
+        chunk = pd.concat(samples, ignore_index=True, sort=False).reindex(columns=self.columns)
+        chunk.index = pd.RangeIndex(self.rows, self.rows + chunk.shape[0])
+        self.rows += chunk.shape[0]
+        if self.fmt == 'csv':
+            return chunk
+        # Columnar files need the same type in every chunk: features get the compact types of the schema
+        # that keep missing values (see feature_schema.py), other columns (e.g. the row number) float64.
+        chunk = apply_schema(chunk, missing=True)
+        for column in chunk.columns:
+            if column == self.time_col:
+                chunk[column] = pd.to_datetime(chunk[column]).astype('datetime64[ns]')
+            elif column_dtype(str(column)) is None:
+                chunk[column] = chunk[column].astype(np.float64)
+        return chunk.reset_index()
+
+    def write(self, samples):
+        # Writes list of sample frames of a user.
+        if len(samples) == 0:
+            return
+        chunk = self._prepare(samples)
+        if self.fmt == 'csv':
+            chunk.to_csv(self.file, header=False)
+        elif self.fmt == 'parquet':
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            table = pa.Table.from_pandas(chunk, preserve_index=False)
+            if self.parquet_writer is None:
+                self.parquet_writer = pq.ParquetWriter(self.path, table.schema, compression=COMPRESSION)
+            self.parquet_writer.write_table(table.cast(self.parquet_writer.schema))
+        else:
+            self.chunks.append(chunk)
+
+    def close(self):
+        # Finishes the file and returns its path.
+        if self.fmt == 'csv':
+            self.file.close()
+        elif self.fmt == 'parquet':
+            if self.parquet_writer is None:
+                write_features(self._prepare([pd.DataFrame(columns=self.columns)]), self.path[:-len('.parquet')],
+                               fmt='parquet', time_col=self.time_col)
+            else:
+                self.parquet_writer.close()
+        else:
+            if len(self.chunks) == 0:
+                self.chunks.append(self._prepare([pd.DataFrame(columns=self.columns)]))
+            write_features(pd.concat(self.chunks, ignore_index=True), self.path[:-len('.feather')],
+                           fmt='feather', time_col=self.time_col)
+        return self.path
@@ -0,0 +1,272 @@
+import os
+import json
+import time
+import queue
+import socket
+import argparse
+import threading
+import http.client
+import socketserver
+from http.server import HTTPServer, BaseHTTPRequestHandler
+import numpy as np
+
+# Local inference service of the saved models (SAVED_FINAL_MODELS/*.h5). The models are loaded once
+# at startup and windows of students are posted as json to /predict over HTTP or a Unix socket:
+#   {"windows": [[[...features...] x sequence_length] x instances], "students": ["u00", ...]}
+# Requests that arrive together are coalesced into a micro-batch: the batcher waits at most max_latency
+# after the first request (or until max_batch_size windows) and runs a single forward pass of each model
+# for the whole batch. The response has the stressed probability of each window for each model and
+# their ensemble (weighted mean). Scoring all students at once is a single request, therefore a single
+# forward pass per model.
+# Windows should be prepared like the training data (resampled, normalized and filled),
+# e.g. by OnlineFeatureExtractor (see online_features.py).
+
+MODEL_DIR = 'SAVED_FINAL_MODELS/'
+
+# Name of each model in the responses and its file in MODEL_DIR.
+MODEL_FILES = {'lstm': 'LSTM_Model.h5',
+               'cnn': 'CNN_Model.h5',
+               'cnn_lstm': 'CNN-LSTM_Model.h5'}
+
+
+def load_models(model_dir=MODEL_DIR, names=None, backend='keras'):
+    # Loads the models in model_dir, returns {name: model}. With backend='numpy' the models exported by
+    # numpy_runtime.py are loaded instead, so Keras is not imported.
+    names = list(MODEL_FILES) if names is None else names
+    if backend == 'numpy':
+        from numpy_runtime import load_runtime_models
+        return load_runtime_models(model_dir, {name: MODEL_FILES[name] for name in names})
+    from keras.models import load_model
+    return {name: load_model(os.path.join(model_dir, MODEL_FILES[name])) for name in names}
+
+def model_input_shape(model):
+    # (sequence_length, features) of a model, None for unknown dimensions.
+    shape = getattr(model, 'input_shape', None)
+    return None if shape is None else tuple(shape[1:])
+
+def predict_probabilities(model, windows):
+    # Stressed probability of each window with one forward pass over all windows.
+    return np.asarray(model.predict(windows, batch_size=max(len(windows), 1)), dtype=np.float32).reshape(len(windows))
+
+class MicroBatcher(object):
+    # Collects windows of concurrent requests and predicts them in batches in a background thread.
+
+    def __init__(self, models, max_latency=0.01, max_batch_size=4096, weights=None):
+        # max_latency is in seconds. weights of the ensemble are {name: weight}, equal by default.
+        self.models = models
+        self.max_latency = max_latency
+        self.max_batch_size = max_batch_size
+        self.weights = {name: 1.0 for name in models} if weights is None else weights
+        self.input_shapes = {name: model_input_shape(model) for name, model in models.items()}
+        self.requests = queue.Queue()
+        self.stats = {'requests': 0, 'windows': 0, 'batches': 0, 'max_batch_windows': 0, 'predict_seconds': 0.0}
+        self.thread = threading.Thread(target=self._run, name='micro-batcher')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def check_windows(self, windows):
+        windows = np.asarray(windows, dtype=np.float32)
+        if windows.ndim == 2:
+            # A single window.
+            windows = windows[None, :, :]
+        if windows.ndim != 3:
+            raise ValueError('windows should have (instances, sequence_length, features) shape, not ' + str(windows.shape))
+        for name, shape in self.input_shapes.items():
+            if shape is not None and any(i is not None and i != j for i, j in zip(shape, windows.shape[1:])):
+                raise ValueError('Model ' + name + ' expects windows of shape ' + str(shape) + ', not ' +
+                                 str(windows.shape[1:]))
+        return windows
+
+    def predict(self, windows):
+        # Adds windows to the next batch and waits for the batch.
+        # Returns {'models': {name: probabilities}, 'ensemble': probabilities, 'batch_windows': size of the batch}.
+        request = {'windows': self.check_windows(windows), 'time': time.monotonic(), 'done': threading.Event()}
+        self.requests.put(request)
+        request['done'].wait()
+        if 'error' in request:
+            raise request['error']
+        return request['result']
+
+    def close(self):
+        self.requests.put(None)
+        self.thread.join()
+
+    def _run(self):
+        while True:
+            first = self.requests.get()
+            if first is None:
+                return
+            batch = [first]
+            size = len(first['windows'])
+            closing = False
+            # The batch waits for other requests until max_latency after the first one.
+            while size < self.max_batch_size:
+                timeout = first['time'] + self.max_latency - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    request = self.requests.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if request is None:
+                    closing = True
+                    break
+                batch.append(request)
+                size += len(request['windows'])
+            self._predict_batch(batch)
+            if closing:
+                return
+
+    def _predict_batch(self, batch):
+        try:
+            windows = np.concatenate([i['windows'] for i in batch])
+            start = time.perf_counter()
+            probabilities = {name: predict_probabilities(model, windows) for name, model in self.models.items()}
+            self.stats['predict_seconds'] += time.perf_counter() - start
+            total = sum(self.weights[name] for name in probabilities)
+            ensemble = sum(probabilities[name] * self.weights[name] for name in probabilities) / total
+            self.stats['requests'] += len(batch)
+            self.stats['windows'] += len(windows)
+            self.stats['batches'] += 1
+            self.stats['max_batch_windows'] = max(self.stats['max_batch_windows'], len(windows))
+            position = 0
+            for request in batch:
+                part = slice(position, position + len(request['windows']))
+                position = part.stop
+                request['result'] = {'models': {name: p[part] for name, p in probabilities.items()},
+                                     'ensemble': ensemble[part],
+                                     'batch_windows': len(windows)}
+        except Exception as e:
+            for request in batch:
+                request['error'] = e
+        for request in batch:
+            request['done'].set()
+
+class PredictionHandler(BaseHTTPRequestHandler):
+    # POST /predict with windows, GET /health for the models and GET /stats for the batch statistics.
+
+    def _send_json(self, status, data):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        batcher = self.server.batcher
+        if self.path == '/health':
+            self._send_json(200, {'models': list(batcher.models),
+                                  'input_shapes': {name: shape for name, shape in batcher.input_shapes.items()},
+                                  'max_latency': batcher.max_latency})
+        elif self.path == '/stats':
+            self._send_json(200, batcher.stats)
+        else:
+            self._send_json(404, {'error': 'Unknown path ' + self.path})
+
+    def do_POST(self):
+        if self.path != '/predict':
+            self._send_json(404, {'error': 'Unknown path ' + self.path})
+            return
+        try:
+            data = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))).decode())
+            result = self.server.batcher.predict(data['windows'])
+        except (ValueError, KeyError, TypeError) as e:
+            self._send_json(400, {'error': type(e).__name__ + ': ' + str(e)})
+            return
+        except Exception as e:
+            # Errors of the models (re-raised by the batcher) are returned, so the client is not left without
+            # a response.
+            self._send_json(500, {'error': type(e).__name__ + ': ' + str(e)})
+            return
+        response = {'models': {name: p.tolist() for name, p in result['models'].items()},
+                    'ensemble': result['ensemble'].tolist(),
+                    'batch_windows': result['batch_windows']}
+        if 'students' in data:
+            response['students'] = data['students']
+        self._send_json(200, response)
+
+    def address_string(self):
+        # Clients of a Unix socket have no address.
+        return self.client_address[0] if isinstance(self.client_address, tuple) else 'unix-socket'
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+def create_server(batcher, host='127.0.0.1', port=8500, unix_socket=None, verbose=False):
+    # HTTP server of the batcher on host:port, or on the Unix socket path if unix_socket is given.
+    # Each connection is handled in its own thread, so concurrent requests reach the batcher together.
+    if unix_socket is not None:
+        if os.path.exists(unix_socket):
+            os.remove(unix_socket)
+        server = ThreadingUnixHTTPServer(unix_socket, PredictionHandler)
+    else:
+        server = ThreadingHTTPServer((host, port), PredictionHandler)
+    server.batcher = batcher
+    server.verbose = verbose
+    return server
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+
+    def __init__(self, path, timeout=60):
+        http.client.HTTPConnection.__init__(self, 'localhost', timeout=timeout)
+        self.unix_socket = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.unix_socket)
+
+def request_predictions(windows, students=None, host='127.0.0.1', port=8500, unix_socket=None, timeout=60):
+    # Client of the server: posts windows (e.g. one per student) and returns the json response.
+    if unix_socket is not None:
+        connection = UnixHTTPConnection(unix_socket, timeout=timeout)
+    else:
+        connection = http.client.HTTPConnection(host, port, timeout=timeout)
+    data = {'windows': np.asarray(windows, dtype=np.float32).tolist()}
+    if students is not None:
+        data['students'] = list(students)
+    try:
+        connection.request('POST', '/predict', body=json.dumps(data), headers={'Content-Type': 'application/json'})
+        response = connection.getresponse()
+        result = json.loads(response.read().decode())
+    finally:
+        connection.close()
+    if response.status != 200:
+        raise ValueError(result.get('error', 'Prediction request failed with status ' + str(response.status)))
+    return result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serves predictions of the saved models with micro-batching.')
+    parser.add_argument('--model-dir', default=MODEL_DIR, help='directory of the saved .h5 models')
+    parser.add_argument('--models', nargs='+', default=list(MODEL_FILES), choices=list(MODEL_FILES),
+                        help='models to load')
+    parser.add_argument('--backend', default='keras', choices=['keras', 'numpy'],
+                        help='numpy uses the models exported by numpy_runtime.py instead of Keras')
+    parser.add_argument('--host', default='127.0.0.1', help='address of the HTTP server')
+    parser.add_argument('--port', type=int, default=8500, help='port of the HTTP server')
+    parser.add_argument('--unix-socket', default=None, help='serve on this Unix socket path instead of a port')
+    parser.add_argument('--max-latency-ms', type=float, default=10,
+                        help='longest wait after a request for other requests of the same batch')
+    parser.add_argument('--max-batch-size', type=int, default=4096, help='largest number of windows in a batch')
+    parser.add_argument('--verbose', action='store_true', help='log each request')
+    args = parser.parse_args()
+    batcher = MicroBatcher(load_models(args.model_dir, args.models, args.backend),
+                           max_latency=args.max_latency_ms / 1000.0, max_batch_size=args.max_batch_size)
+    server = create_server(batcher, args.host, args.port, args.unix_socket, verbose=args.verbose)
+    print('Serving', ', '.join(batcher.models), 'on', args.unix_socket or args.host + ':' + str(args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        batcher.close()
@@ -0,0 +1,99 @@
+import glob
+import multiprocessing
+import os
+import numpy as np
+import pandas as pd
+
+from feature_store import write_features, read_features, FEATURE_FORMATS
+
+# Builds the STRESSED labels of all users once from the EMA responses (EMA/response/Stress and
+# EMA/response/Mood 2) as a single table with user, resp_time, STRESSED and source columns.
+# The table is saved as a columnar file and the labels of a user are attached to the per-second
+# features with merge_asof, so EMA files are not parsed again for each user.
+
+# Answer column of each EMA source and its conversion to STRESSED
+# (same with the replace calls of the dataset preparation scripts).
+EMA_SOURCES = {'Stress': ('level', {1: 1, 2: 1, 3: 1, 4: 0, 5: 0}),
+               'Mood 2': ('how', {1: 0, 2: 1, 3: 0})}
+
+LABEL_COLUMNS = ['user', 'resp_time', 'STRESSED', 'source']
+
+
+def ema_files(loc):
+    # Returns [(user, source, path)] of EMA response files of all users.
+    files = []
+    for source in EMA_SOURCES:
+        for path in sorted(glob.glob(os.path.join(loc, 'EMA', 'response', source, source + '_*.json'))):
+            user = os.path.splitext(os.path.basename(path))[0].split('_')[-1]
+            files.append((user, source, path))
+    return files
+
+def read_ema_labels(args):
+    # Reads an EMA response file and converts the answers to labels.
+    # Responses without an answer (e.g. rows that only have a "null" key) are dropped.
+    user, source, path = args
+    column, mapping = EMA_SOURCES[source]
+    data = pd.read_json(path)
+    if column not in data.columns or 'resp_time' not in data.columns:
+        return pd.DataFrame(columns=LABEL_COLUMNS)
+    data = data.dropna(subset=[column])
+    return pd.DataFrame({'user': user,
+                         'resp_time': pd.to_datetime(data['resp_time']).values,
+                         'STRESSED': data[column].replace(mapping).values,
+                         'source': source}, columns=LABEL_COLUMNS)
+
+def build_label_table(loc, workers=1):
+    # Reads EMA files of all users (in parallel if workers > 1) and returns the label table
+    # sorted by user and response time.
+    files = ema_files(loc)
+    if workers > 1:
+        pool = multiprocessing.Pool(processes=workers)
+        try:
+            tables = pool.map(read_ema_labels, files)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        tables = [read_ema_labels(i) for i in files]
+    table = pd.concat(tables + [pd.DataFrame(columns=LABEL_COLUMNS)], ignore_index=True)
+    table['user'] = table['user'].astype('category')
+    table['resp_time'] = pd.to_datetime(table['resp_time']).astype('datetime64[ns]')
+    table['STRESSED'] = table['STRESSED'].astype(np.float32)
+    table['source'] = table['source'].astype('category')
+    # Labels at the same second are sorted by STRESSED, so the stressed one is attached (see attach_labels).
+    return table.sort_values(by=['user', 'resp_time', 'STRESSED'], kind='mergesort').reset_index(drop=True)
+
+def load_label_table(loc, path, workers=1, fmt='parquet'):
+    # Reads the label table from path (without extension), it is built and saved first if the file
+    # does not exist or an EMA file is newer than it.
+    full_path = path + FEATURE_FORMATS[fmt]
+    sources = [i[2] for i in ema_files(loc)]
+    if not os.path.exists(full_path) or \
+            any(os.path.getmtime(i) > os.path.getmtime(full_path) for i in sources):
+        table = build_label_table(loc, workers=workers)
+        write_features(table, path, fmt=fmt, time_col=None)
+        return table
+    table = read_features(full_path)
+    # Types of csv files are set again.
+    table['resp_time'] = pd.to_datetime(table['resp_time'])
+    table['user'] = table['user'].astype('category')
+    table['source'] = table['source'].astype('category')
+    return table
+
+def user_labels(table, user):
+    # Labels of a user as a frame indexed by resp_time (same shape as the old per-user labels).
+    labels = table.loc[table['user'] == user, ['resp_time', 'STRESSED']]
+    return labels.set_index('resp_time')
+
+def attach_labels(df, labels, time_col='timestamp', tolerance=pd.Timedelta(0)):
+    # Adds STRESSED of labels (indexed by response time) to df with merge_asof.
+    # With the default tolerance a label is attached only to the row of its exact second.
+    # If there are multiple labels at a second, the last one (stressed if any) is used and no row is duplicated.
+    # Rows of df are sorted by time.
+    if not df[time_col].is_monotonic_increasing:
+        df = df.sort_values(by=time_col, kind='mergesort')
+    labels = labels.reset_index()
+    labels.columns = [time_col, 'STRESSED']
+    labels[time_col] = labels[time_col].astype(df[time_col].dtype)
+    df = pd.merge_asof(df, labels, on=time_col, direction='backward', tolerance=tolerance)
+    return df
@@ -0,0 +1,198 @@
+import os
+import json
+import numpy as np
+import pandas as pd
+
+from feature_store import feature_format, read_features
+
+# Yeo-Johnson normalization of the features (same with PowerTransformer(method='yeo-johnson', standardize=True)
+# of the notebooks) that can be fitted without reading all samples to memory and saved next to the models,
+# so the same normalization is applied at training and at inference time.
+# - fit reads chunks of samples once and keeps a uniform random subsample of sample_rows rows, the lambda
+#   of each feature is estimated from the subsample with the same maximum likelihood method as scikit-learn.
+#   If all rows fit in the subsample, the result is same with PowerTransformer.
+# - fit_file reads a samples file in chunks twice: for the subsample and for the exact mean and standard
+#   deviation of the transformed features over all rows.
+# - transform works on float32 batches of rows (or windows), missing values stay missing.
+
+# Default file of the fitted parameters, next to the saved models.
+NORMALIZER_PATH = 'SAVED_FINAL_MODELS/normalizer.json'
+
+
+def yeo_johnson(x, lambdas):
+    # Yeo-Johnson transform of the columns of x with a lambda for each column (last axis).
+    x = np.asarray(x)
+    lambdas = np.broadcast_to(np.asarray(lambdas, dtype=x.dtype), x.shape)
+    out = np.full_like(x, np.nan)
+    with np.errstate(invalid='ignore', divide='ignore', over='ignore'):
+        positive = x >= 0
+        values, l = x[positive], lambdas[positive]
+        zero = np.abs(l) < np.spacing(1.0)
+        out[positive] = np.where(zero, np.log1p(values), (np.power(values + 1, l) - 1) / np.where(zero, 1, l))
+        negative = x < 0
+        values, l = x[negative], lambdas[negative]
+        two = np.abs(l - 2) < np.spacing(1.0)
+        out[negative] = np.where(two, -np.log1p(-values),
+                                 -(np.power(1 - values, 2 - l) - 1) / np.where(two, 1, 2 - l))
+    return out
+
+def estimate_lambda(x):
+    # Maximum likelihood lambda of a feature with scipy, same with scikit-learn. Missing values are ignored
+    # and constant features get lambda 1 (no change).
+    from scipy import stats
+    x = np.asarray(x, dtype=np.float64)
+    x = x[~np.isnan(x)]
+    if len(x) < 2 or np.ptp(x) == 0:
+        return 1.0
+    return float(stats.yeojohnson_normmax(x))
+
+def _chunk_values(chunk, feature_names):
+    if isinstance(chunk, pd.DataFrame):
+        return chunk[feature_names].values.astype(np.float64)
+    return np.asarray(chunk, dtype=np.float64)
+
+def _merge_moments(moments, values):
+    # Adds values to the per-feature (count, mean, sum of squared differences) of moments (Chan et al.).
+    valid = ~np.isnan(values)
+    count = valid.sum(axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.where(count > 0, np.nansum(values, axis=0) / count, 0)
+        squares = np.nansum((values - mean) ** 2, axis=0)
+    if moments is None:
+        return count, mean, squares
+    total_count, total_mean, total_squares = moments
+    merged = total_count + count
+    with np.errstate(invalid='ignore', divide='ignore'):
+        delta = mean - total_mean
+        merged_mean = np.where(merged > 0, total_mean + delta * count / np.maximum(merged, 1), 0)
+        merged_squares = total_squares + squares + delta ** 2 * total_count * count / np.maximum(merged, 1)
+    return merged, merged_mean, merged_squares
+
+def iter_feature_chunks(path, chunksize=100000, columns=None):
+    # Reads a samples file (csv, parquet or feather) as data frames of chunksize rows.
+    fmt = feature_format(path)
+    if fmt == 'csv':
+        for chunk in pd.read_csv(path, usecols=columns, chunksize=chunksize):
+            yield chunk
+    elif fmt == 'parquet':
+        import pyarrow.parquet as pq
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=chunksize, columns=columns):
+            yield batch.to_pandas()
+    else:
+        df = read_features(path, columns=columns)
+        for i in range(0, len(df), chunksize):
+            yield df.iloc[i:i + chunksize]
+
+class YeoJohnsonNormalizer(object):
+
+    def __init__(self, feature_names=None, lambdas=None, means=None, scales=None, standardize=True):
+        self.feature_names = None if feature_names is None else list(feature_names)
+        self.lambdas = None if lambdas is None else np.asarray(lambdas, dtype=np.float64)
+        self.means = None if means is None else np.asarray(means, dtype=np.float64)
+        self.scales = None if scales is None else np.asarray(scales, dtype=np.float64)
+        self.standardize = standardize
+        self.fitted_rows = None
+
+    def _sample(self, chunks, sample_rows, seed, exclude):
+        # Uniform sample without replacement of sample_rows rows of all chunks: each row gets a random key and
+        # the rows with the smallest keys are kept, so only the sample and one chunk are in memory.
+        rng = np.random.RandomState(seed)
+        sample = None
+        keys = None
+        rows = 0
+        for chunk in chunks:
+            if self.feature_names is None:
+                self.feature_names = [i for i in chunk.columns if i not in exclude]
+            values = _chunk_values(chunk, self.feature_names)
+            rows += len(values)
+            chunk_keys = rng.random_sample(len(values))
+            if sample is not None:
+                values = np.concatenate([sample, values])
+                chunk_keys = np.concatenate([keys, chunk_keys])
+            if len(values) > sample_rows:
+                keep = np.argpartition(chunk_keys, sample_rows)[:sample_rows]
+                values, chunk_keys = values[keep], chunk_keys[keep]
+            sample, keys = values, chunk_keys
+        if sample is None:
+            raise ValueError('There are no rows to fit the normalizer.')
+        self.fitted_rows = rows
+        return sample
+
+    def _set_moments(self, moments):
+        count, mean, squares = moments
+        with np.errstate(invalid='ignore', divide='ignore'):
+            scales = np.sqrt(squares / count)
+        # Constant features are not scaled (same with StandardScaler).
+        scales[~(scales > 10 * np.finfo(np.float64).eps)] = 1.0
+        self.means = mean
+        self.scales = scales
+
+    def fit(self, chunks, sample_rows=1000000, seed=0, exclude=('STRESSED', 'timestamp')):
+        # Fits lambdas, means and scales from chunks (data frames or arrays of the features) with one pass.
+        # Columns of data frames other than exclude are the features.
+        sample = self._sample(chunks, sample_rows, seed, exclude)
+        self.lambdas = np.array([estimate_lambda(sample[:, i]) for i in range(sample.shape[1])])
+        if self.standardize:
+            self._set_moments(_merge_moments(None, yeo_johnson(sample, self.lambdas)))
+        return self
+
+    def fit_file(self, path, chunksize=100000, sample_rows=1000000, seed=0, exclude=('STRESSED', 'timestamp')):
+        # Fits lambdas from a subsample of the file and the means and scales from all of its rows.
+        self.fit(iter_feature_chunks(path, chunksize), sample_rows=sample_rows, seed=seed, exclude=exclude)
+        if self.standardize and self.fitted_rows > sample_rows:
+            moments = None
+            for chunk in iter_feature_chunks(path, chunksize, columns=self.feature_names):
+                moments = _merge_moments(moments, yeo_johnson(_chunk_values(chunk, self.feature_names), self.lambdas))
+            self._set_moments(moments)
+        return self
+
+    def transform(self, X, batch_rows=100000):
+        # Normalized float32 values of X: a data frame with the features or an array with the features on the
+        # last axis (e.g. rows or (instances, sequence_length, features) windows). Rows are transformed in
+        # batches of batch_rows, so temporary arrays stay small.
+        if isinstance(X, pd.DataFrame):
+            missing = [i for i in self.feature_names if i not in X.columns]
+            if missing:
+                raise ValueError('Features are missing: ' + ', '.join(missing))
+            X = X[self.feature_names].values
+        X = np.asarray(X, dtype=np.float32)
+        if X.shape[-1] != len(self.feature_names):
+            raise ValueError('Expected ' + str(len(self.feature_names)) + ' features, not ' + str(X.shape[-1]))
+        rows = X.reshape(-1, X.shape[-1])
+        out = np.empty_like(rows)
+        lambdas = self.lambdas.astype(np.float32)
+        means = None if self.means is None else self.means.astype(np.float32)
+        scales = None if self.scales is None else self.scales.astype(np.float32)
+        for i in range(0, len(rows), batch_rows):
+            batch = yeo_johnson(rows[i:i + batch_rows], lambdas)
+            if self.standardize:
+                batch = (batch - means) / scales
+            out[i:i + batch_rows] = batch
+        return out.reshape(X.shape)
+
+    def transform_frame(self, df, label='STRESSED'):
+        # Normalized features of df as a data frame, the label column is kept as it is (same with the notebooks).
+        normalized = pd.DataFrame(self.transform(df), columns=self.feature_names, index=df.index)
+        if label in df.columns:
+            normalized[label] = df[label]
+        return normalized
+
+    def save(self, path=NORMALIZER_PATH):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        params = {'method': 'yeo-johnson', 'standardize': self.standardize, 'feature_names': self.feature_names,
+                  'lambdas': self.lambdas.tolist(), 'fitted_rows': self.fitted_rows,
+                  'means': None if self.means is None else self.means.tolist(),
+                  'scales': None if self.scales is None else self.scales.tolist()}
+        with open(path, 'w') as f:
+            json.dump(params, f, indent=1)
+        return path
+
+    @classmethod
+    def load(cls, path=NORMALIZER_PATH):
+        with open(path) as f:
+            params = json.load(f)
+        normalizer = cls(params['feature_names'], params['lambdas'], params['means'], params['scales'],
+                         standardize=params['standardize'])
+        normalizer.fitted_rows = params.get('fitted_rows')
+        return normalizer
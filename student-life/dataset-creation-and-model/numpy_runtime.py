@@ -0,0 +1,252 @@
+import os
+import json
+import argparse
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+# NumPy-only forward pass of the saved Sequential models (SAVED_FINAL_MODELS/*.h5), so windows can be
+# scored without importing Keras/TensorFlow (e.g. in the inference server or in small worker processes).
+# export_model reads the layer configs and weights of an .h5 file (needs h5py) and saves them as a
+# compact .npz file next to it. NumpyModel loads the .npz file and predicts batches in float32.
+# Supported layers are the ones of "LSTM-Keras-Tez.ipynb": LSTM, Conv1D, MaxPooling1D,
+# GlobalAveragePooling1D, Dense and Dropout (only used in training).
+# With quantize=True, kernels are saved as int8 with a float32 scale per output unit (about 4 times
+# smaller files). They are converted back to float32 when the model is loaded, calculations are float32.
+
+SUPPORTED_LAYERS = ['LSTM', 'Conv1D', 'MaxPooling1D', 'GlobalAveragePooling1D', 'Dense', 'Dropout']
+
+# Largest difference of probabilities to Keras accepted by verify_against_keras.
+TOLERANCE = 1e-4
+QUANTIZED_TOLERANCE = 2e-2
+
+
+def _hard_sigmoid(x):
+    # Same with Keras 2 hard_sigmoid.
+    return np.clip(0.2 * x + 0.5, 0.0, 1.0)
+
+def _sigmoid(x):
+    with np.errstate(over='ignore'):
+        return 1.0 / (1.0 + np.exp(-x))
+
+ACTIVATIONS = {'linear': lambda x: x,
+               'relu': lambda x: np.maximum(x, 0.0),
+               'tanh': np.tanh,
+               'sigmoid': _sigmoid,
+               'hard_sigmoid': _hard_sigmoid}
+
+def runtime_path(h5_path):
+    # Path of the exported model of an .h5 file, e.g. SAVED_FINAL_MODELS/LSTM_Model.npz.
+    return os.path.splitext(h5_path)[0] + '.npz'
+
+def quantize_int8(kernel):
+    # Symmetric int8 quantization with a scale for each output unit (last axis of the kernel).
+    scale = np.abs(kernel).reshape(-1, kernel.shape[-1]).max(axis=0) / 127.0
+    scale[scale == 0] = 1.0
+    return np.round(kernel / scale).astype(np.int8), scale.astype(np.float32)
+
+def read_h5_model(h5_path):
+    # Returns the layer configs, {layer name: [weights]} and the input shape of a Keras .h5 model.
+    import h5py
+    with h5py.File(h5_path, 'r') as f:
+        model_config = json.loads(f.attrs['model_config'])['config']
+        group = f['model_weights'] if 'model_weights' in f else f
+        # Sequential configs of older Keras versions are lists of layers.
+        layers = model_config['layers'] if isinstance(model_config, dict) else model_config
+        weights = {}
+        for layer in layers:
+            name = layer['config']['name']
+            if name in group:
+                names = [i.decode() if isinstance(i, bytes) else i for i in group[name].attrs['weight_names']]
+                weights[name] = [np.asarray(group[name][i], dtype=np.float32) for i in names]
+    input_shape = layers[0]['config'].get('batch_input_shape')
+    if input_shape is None and isinstance(model_config, dict):
+        input_shape = model_config.get('build_input_shape')
+    return layers, weights, input_shape
+
+def export_model(h5_path, path=None, quantize=False):
+    # Saves the layers and weights of the .h5 model to path (runtime_path by default) and returns the path.
+    layers, weights, input_shape = read_h5_model(h5_path)
+    path = runtime_path(h5_path) if path is None else path
+    specs = []
+    arrays = {}
+    for i, layer in enumerate(layers):
+        kind, config = layer['class_name'], layer['config']
+        if kind not in SUPPORTED_LAYERS:
+            raise ValueError('Layer ' + kind + ' of ' + h5_path + ' is not supported.')
+        spec = {'class_name': kind}
+        if kind == 'LSTM':
+            if config.get('go_backwards') or config.get('stateful'):
+                raise ValueError('Only forward, stateless LSTM layers are supported.')
+            spec.update({k: config[k] for k in ['units', 'activation', 'recurrent_activation', 'return_sequences',
+                                                'use_bias']})
+        elif kind == 'Conv1D':
+            spec.update({'activation': config['activation'], 'padding': config['padding'],
+                         'strides': config['strides'][0], 'dilation_rate': config['dilation_rate'][0],
+                         'use_bias': config['use_bias']})
+        elif kind == 'MaxPooling1D':
+            spec.update({'pool_size': config['pool_size'][0], 'strides': config['strides'][0],
+                         'padding': config['padding']})
+        elif kind == 'Dense':
+            spec.update({'activation': config['activation'], 'use_bias': config['use_bias']})
+        for j, w in enumerate(weights.get(config['name'], [])):
+            key = str(i) + '_' + str(j)
+            # Kernels (2 or 3 dimensional) are quantized, biases are kept.
+            if quantize and w.ndim > 1:
+                arrays[key + '_q'], arrays[key + '_scale'] = quantize_int8(w)
+            else:
+                arrays[key] = w
+        spec['weights'] = len(weights.get(config['name'], []))
+        specs.append(spec)
+    meta = {'layers': specs, 'input_shape': input_shape, 'source': os.path.basename(h5_path), 'quantized': quantize}
+    np.savez(path, config=np.array(json.dumps(meta)), **arrays)
+    return path
+
+def _conv1d(x, kernel, bias, activation, padding='valid', strides=1, dilation_rate=1):
+    # x is (instances, steps, features), kernel is (kernel_size, features, filters).
+    # All windows are taken with a strided view and multiplied with the kernel in one matrix product.
+    size = kernel.shape[0]
+    span = (size - 1) * dilation_rate + 1
+    if padding == 'same':
+        total = max((int(np.ceil(x.shape[1] / float(strides))) - 1) * strides + span - x.shape[1], 0)
+        x = np.pad(x, ((0, 0), (total // 2, total - total // 2), (0, 0)))
+    elif padding == 'causal':
+        x = np.pad(x, ((0, 0), (span - 1, 0), (0, 0)))
+    x = np.ascontiguousarray(x)
+    steps = (x.shape[1] - span) // strides + 1
+    windows = as_strided(x, shape=(x.shape[0], steps, size, x.shape[2]),
+                         strides=(x.strides[0], x.strides[1] * strides, x.strides[1] * dilation_rate, x.strides[2]),
+                         writeable=False)
+    y = windows.reshape(-1, size * x.shape[2]) @ kernel.reshape(size * x.shape[2], -1)
+    y = y.reshape(x.shape[0], steps, -1)
+    if bias is not None:
+        y += bias
+    return ACTIVATIONS[activation](y)
+
+def _max_pooling1d(x, pool_size, strides, padding='valid'):
+    if padding == 'same':
+        steps = int(np.ceil(x.shape[1] / float(strides)))
+        total = max((steps - 1) * strides + pool_size - x.shape[1], 0)
+        x = np.pad(x, ((0, 0), (total // 2, total - total // 2), (0, 0)), constant_values=-np.inf)
+    x = np.ascontiguousarray(x)
+    steps = (x.shape[1] - pool_size) // strides + 1
+    windows = as_strided(x, shape=(x.shape[0], steps, pool_size, x.shape[2]),
+                         strides=(x.strides[0], x.strides[1] * strides, x.strides[1], x.strides[2]), writeable=False)
+    return windows.max(axis=2)
+
+def _lstm(x, kernel, recurrent_kernel, bias, units, activation, recurrent_activation, return_sequences):
+    # Keras LSTM with gates in i, f, c, o order. Inputs of all steps are multiplied with the kernel at once,
+    # only the recurrent part is calculated step by step.
+    n, steps = x.shape[0], x.shape[1]
+    inputs = (x.reshape(n * steps, -1) @ kernel).reshape(n, steps, 4 * units)
+    if bias is not None:
+        inputs += bias
+    act, recurrent_act = ACTIVATIONS[activation], ACTIVATIONS[recurrent_activation]
+    h = np.zeros((n, units), dtype=np.float32)
+    c = np.zeros((n, units), dtype=np.float32)
+    outputs = []
+    for t in range(steps):
+        z = inputs[:, t] + h @ recurrent_kernel
+        i = recurrent_act(z[:, :units])
+        f = recurrent_act(z[:, units:2 * units])
+        c = f * c + i * act(z[:, 2 * units:3 * units])
+        o = recurrent_act(z[:, 3 * units:])
+        h = o * act(c)
+        if return_sequences:
+            outputs.append(h)
+    return np.stack(outputs, axis=1) if return_sequences else h
+
+class NumpyModel(object):
+    # Exported model with the predict method of Keras models.
+
+    def __init__(self, path):
+        with np.load(path, allow_pickle=False) as data:
+            meta = json.loads(str(data['config']))
+            arrays = {k: data[k] for k in data.files if k != 'config'}
+        self.path = path
+        self.layers = meta['layers']
+        self.quantized = meta['quantized']
+        self.weights = []
+        for i, layer in enumerate(self.layers):
+            weights = []
+            for j in range(layer['weights']):
+                key = str(i) + '_' + str(j)
+                if key + '_q' in arrays:
+                    weights.append(arrays[key + '_q'].astype(np.float32) * arrays[key + '_scale'])
+                else:
+                    weights.append(arrays[key].astype(np.float32))
+            self.weights.append(weights)
+        self.input_shape = self._input_shape(meta['input_shape'])
+
+    def _input_shape(self, input_shape):
+        # (None, sequence_length, features) like Keras models, features are taken from the first kernel
+        # if the model was saved without an input shape.
+        if input_shape is not None:
+            return tuple(input_shape)
+        for layer, weights in zip(self.layers, self.weights):
+            if weights:
+                return (None, None, weights[0].shape[-2])
+        return None
+
+    def predict(self, windows, batch_size=None):
+        # Probabilities of (instances, sequence_length, features) windows as an (instances, outputs) array.
+        # All windows are calculated together unless batch_size is given.
+        x = np.asarray(windows, dtype=np.float32)
+        if batch_size is None or batch_size >= len(x):
+            return self._forward(x)
+        return np.concatenate([self._forward(x[i:i + batch_size]) for i in range(0, len(x), batch_size)])
+
+    def _forward(self, x):
+        for layer, weights in zip(self.layers, self.weights):
+            kind = layer['class_name']
+            bias = weights[-1] if layer.get('use_bias') else None
+            if kind == 'Conv1D':
+                x = _conv1d(x, weights[0], bias, layer['activation'], layer['padding'], layer['strides'],
+                            layer['dilation_rate'])
+            elif kind == 'MaxPooling1D':
+                x = _max_pooling1d(x, layer['pool_size'], layer['strides'], layer['padding'])
+            elif kind == 'GlobalAveragePooling1D':
+                x = x.mean(axis=1)
+            elif kind == 'LSTM':
+                x = _lstm(x, weights[0], weights[1], bias, layer['units'], layer['activation'],
+                          layer['recurrent_activation'], layer['return_sequences'])
+            elif kind == 'Dense':
+                x = x @ weights[0]
+                if bias is not None:
+                    x += bias
+                x = ACTIVATIONS[layer['activation']](x)
+        return x.astype(np.float32)
+
+def load_runtime_models(model_dir, model_files):
+    # Loads exported models, model_files is {name: .h5 file name} (see inference_server.MODEL_FILES).
+    return {name: NumpyModel(runtime_path(os.path.join(model_dir, f))) for name, f in model_files.items()}
+
+def verify_against_keras(h5_path, path=None, windows=None, tolerance=None, seed=0):
+    # Compares predictions of the exported model with Keras on windows (random windows by default).
+    # Returns the largest difference, raises ValueError if it is higher than tolerance.
+    from keras.models import load_model
+    keras_model = load_model(h5_path)
+    model = NumpyModel(runtime_path(h5_path) if path is None else path)
+    if windows is None:
+        shape = [i or 24 for i in keras_model.input_shape[1:]]
+        windows = np.random.RandomState(seed).standard_normal([256] + shape).astype(np.float32)
+    if tolerance is None:
+        tolerance = QUANTIZED_TOLERANCE if model.quantized else TOLERANCE
+    difference = float(np.abs(keras_model.predict(windows) - model.predict(windows)).max())
+    if difference > tolerance:
+        raise ValueError('Exported model of ' + h5_path + ' differs from Keras by ' + str(difference))
+    return difference
+
+
+if __name__ == '__main__':
+    from inference_server import MODEL_DIR, MODEL_FILES
+    parser = argparse.ArgumentParser(description='Exports the saved .h5 models to the NumPy runtime.')
+    parser.add_argument('--model-dir', default=MODEL_DIR, help='directory of the saved .h5 models')
+    parser.add_argument('--quantize', action='store_true', help='save kernels as int8')
+    parser.add_argument('--verify', action='store_true', help='compare the exported models with Keras')
+    args = parser.parse_args()
+    for name, file_name in MODEL_FILES.items():
+        h5_path = os.path.join(args.model_dir, file_name)
+        path = export_model(h5_path, quantize=args.quantize)
+        print(name, 'is exported to', path, '(' + str(os.path.getsize(path) // 1024) + ' KB)')
+        if args.verify:
+            print(name, 'largest difference to Keras:', verify_against_keras(h5_path, path))
@@ -0,0 +1,282 @@
+import numpy as np
+import pandas as pd
+
+from resample_utils import resample_aggregations
+from timeline_utils import BLUETOOTH_BANDS, BLUETOOTH_MAX_LEVEL, WIFI_BANDS, WIFI_MAX_LEVEL
+
+# Online version of the feature pipeline: sensing events of a user are consumed one by one as they
+# arrive (instead of reading whole files) and model-ready windows are emitted when a resample bin closes.
+# Each event updates running aggregates of its bin in O(1): sums, non-missing counts (for mean columns),
+# minimums and maximums, with the same rules as resample_aggregations. The last sequence_length closed
+# bins are kept in a ring buffer, so a window is copied out of it without any resampling.
+#
+# Events follow the per-second data of "1-dataset-preparation-seconds.py":
+# - add_inference: activity/audio inferences, each second until the next inference gets its value
+#   (backward filling). Seconds with activity or audio are the timeline, a missing inference is 3.
+# - add_interval: conversation, phone_in_dark, phone_charging, phone_locked and on_call intervals,
+#   both ends inclusive. Overlapping intervals of a column are counted once if they arrive in start order.
+# - add_scan: all bluetooth/wifi records of a scan second, aggregated with the bands of timeline_utils.
+# - add_event: sms/call_log flags (once per second) and running_apps/call_duration values.
+# - deadlines and hour_of_day are added when a bin closes.
+# Scans that are not on the timeline are counted too (the batch pipeline drops wifi scans outside it).
+# Times are unix seconds as in the sensing files. Bins are aligned to midnight (UTC), same as
+# df.resample for resample ranges that divide a day (all ranges of the combiner).
+# A bin is closed when the latest event time passes its end by lateness. Events of already closed bins
+# are dropped and counted in dropped_events, so sources that are reported late (e.g. conversations at
+# their end) need a lateness as long as their delay.
+
+SCAN_BANDS = {'bt': (BLUETOOTH_BANDS, BLUETOOTH_MAX_LEVEL),
+              'wifi': (WIFI_BANDS, WIFI_MAX_LEVEL)}
+
+# Inference value of timeline seconds without activity or audio (same with fill_and_encode).
+MISSING_INFERENCE = 3
+
+
+class OnlineFeatureExtractor(object):
+
+    def __init__(self, feature_names, res_range='30min', sequence_length=24, deadlines=None, lateness='0s',
+                 transform=None, fill_value=0.0, emit_partial=False):
+        # feature_names are the model input columns in order (e.g. feature_names of the tensor store manifest).
+        # deadlines is the deadline count of each date of the user (a column of get_deadlines).
+        # transform (e.g. a fitted normalizer) is applied to each closed bin, then missing values are
+        # filled with fill_value (None keeps them), same order with the notebooks.
+        # Windows are emitted after sequence_length bins are closed, or from the first bin
+        # (pre-padded with fill_value) if emit_partial is True.
+        self.feature_names = list(feature_names)
+        self.columns = {name: i for i, name in enumerate(self.feature_names)}
+        self.bin_seconds = int(pd.Timedelta(res_range).total_seconds())
+        self.sequence_length = sequence_length
+        self.lateness = int(pd.Timedelta(lateness).total_seconds())
+        self.transform = transform
+        self.fill_value = fill_value
+        self.emit_partial = emit_partial
+
+        aggregations = resample_aggregations(self.feature_names)
+        self.mean_mask = np.array([aggregations[i] is np.mean for i in self.feature_names])
+        self.min_mask = np.array([aggregations[i] is np.min for i in self.feature_names])
+        self.max_mask = np.array([aggregations[i] is np.max for i in self.feature_names])
+
+        self.deadlines = None
+        self.deadline_days = np.array([], dtype=np.int64)
+        if deadlines is not None:
+            deadlines = pd.to_numeric(pd.Series(deadlines)).fillna(0)
+            days = pd.DatetimeIndex(pd.to_datetime(deadlines.index)).normalize()
+            daily = deadlines.groupby(days).sum()
+            self.deadlines = dict(zip(daily.index.values.astype('datetime64[D]').astype(np.int64), daily.values))
+            self.deadline_days = np.unique(daily.index[daily.values > 0].values.astype('datetime64[D]').astype(np.int64))
+
+        # Accumulators of open bins by bin number.
+        self.bins = {}
+        # First bin that is not closed, None before the first event.
+        self.next_bin = None
+        self.latest = None
+        self.last_inference = {}
+        self.covered_until = {}
+        self.last_event_second = {}
+        self.scan_buffer = {}
+        self.dropped_events = 0
+
+        # Ring buffer of the last sequence_length closed bins.
+        self.ring = np.full((sequence_length, len(self.feature_names)), np.nan, dtype=np.float32)
+        self.position = 0
+        self.closed_bins = 0
+
+    def _new_bin(self):
+        # Accumulators of a bin: sums, non-missing counts, minimums, maximums, activity and audio seconds.
+        n = len(self.feature_names)
+        return {'sum': np.zeros(n), 'count': np.zeros(n, dtype=np.int64),
+                'min': np.full(n, np.nan), 'max': np.full(n, np.nan), 'activity': 0, 'audio': 0}
+
+    def _bin(self, number):
+        if number not in self.bins:
+            self.bins[number] = self._new_bin()
+        return self.bins[number]
+
+    def _add(self, column, second, value, seconds=1):
+        # Adds the value of a second of column to its bin (value * seconds for a run of equal seconds).
+        i = self.columns.get(column)
+        if i is None:
+            return
+        number = second // self.bin_seconds
+        if self.next_bin is not None and number < self.next_bin:
+            self.dropped_events += 1
+            return
+        b = self._bin(number)
+        if self.max_mask[i]:
+            b['max'][i] = value if np.isnan(b['max'][i]) else max(b['max'][i], value)
+        elif self.min_mask[i]:
+            b['min'][i] = value if np.isnan(b['min'][i]) else min(b['min'][i], value)
+        else:
+            b['sum'][i] += value * seconds
+            b['count'][i] += seconds
+
+    def _add_seconds(self, column, first, last, counter=None):
+        # Adds 1 to column for each second of [first, last], split over the bins of the range.
+        # counter ('activity' or 'audio') also counts the seconds in the bin.
+        while first <= last:
+            number = first // self.bin_seconds
+            end = min(last, (number + 1) * self.bin_seconds - 1)
+            if self.next_bin is None or number >= self.next_bin:
+                if column is not None:
+                    self._add(column, first, 1, seconds=end - first + 1)
+                if counter is not None:
+                    self._bin(number)[counter] += end - first + 1
+            else:
+                self.dropped_events += 1
+            first = end + 1
+
+    def add_inference(self, source, time, value):
+        # Activity or audio inference of a second, e.g. add_inference('activity', 1364342405, 0).
+        # Multiple inferences of a second keep the first one.
+        second = int(time)
+        previous = self.last_inference.get(source)
+        if previous is not None and second <= previous:
+            return self._advance(second)
+        first = second if previous is None else previous + 1
+        self.last_inference[source] = second
+        counter = source if source in ['activity', 'audio'] else None
+        self._add_seconds(source + '_inference_' + str(int(value)), first, second, counter)
+        return self._advance(second)
+
+    def add_interval(self, column, start, end):
+        # Interval of a flag column, e.g. add_interval('conversation', start, end) when a conversation ends.
+        start = max(int(start), self.covered_until.get(column, -1) + 1)
+        end = int(end)
+        if start <= end:
+            self.covered_until[column] = end
+            self._add_seconds(column, start, end)
+        return self._advance(end)
+
+    def add_scan(self, source, time, levels):
+        # Levels of all devices seen in a bluetooth ('bt') or wifi ('wifi') scan at time.
+        # Records of the same second are merged before aggregation, same with aggregate_scans.
+        second = int(time)
+        buffered = self.scan_buffer.get(source)
+        if buffered is not None and buffered[0] != second:
+            self._flush_scan(source)
+            buffered = None
+        if buffered is None:
+            self.scan_buffer[source] = buffered = (second, [])
+        buffered[1].extend(np.atleast_1d(np.asarray(levels, dtype=np.float64)))
+        return self._advance(second)
+
+    def _flush_scan(self, source):
+        second, levels = self.scan_buffer.pop(source)
+        bands, max_level = SCAN_BANDS[source]
+        levels = np.asarray(levels, dtype=np.float64)
+        prefix = source + '_'
+        self._add(prefix + 'total_devices_around', second, float(len(levels)))
+        codes = np.digitize(levels, np.array([low for name, low in bands], dtype=np.float64))
+        codes[np.isnan(levels)] = 0
+        if max_level is not None:
+            codes[levels > max_level] = 0
+        counts = np.bincount(codes, minlength=len(bands) + 1)
+        for i, (name, low) in enumerate(bands):
+            self._add(prefix + name, second, float(counts[i + 1]))
+        valid = levels[~np.isnan(levels)]
+        if len(valid):
+            self._add(prefix + 'level_avg', second, float(np.round(valid.mean())))
+        if len(valid) > 1:
+            self._add(prefix + 'level_std', second, float(valid.std(ddof=1)))
+
+    def add_event(self, column, time, value=None):
+        # Point event, e.g. add_event('sms', time) or add_event('running_apps', time, 12).
+        # Without a value the column is a flag that is counted once per second.
+        second = int(time)
+        if value is None:
+            if self.last_event_second.get(column) != second:
+                self.last_event_second[column] = second
+                self._add(column, second, 1)
+        else:
+            self._add(column, second, float(value))
+        return self._advance(second)
+
+    def _advance(self, second):
+        # Moves the latest time to second and closes the bins that end before it by lateness.
+        # Returns [(bin start, window)] of the closed bins.
+        if self.next_bin is None:
+            self.next_bin = second // self.bin_seconds
+        if self.latest is None or second > self.latest:
+            self.latest = second
+        for source in list(self.scan_buffer):
+            if self.scan_buffer[source][0] < self.latest:
+                self._flush_scan(source)
+        windows = []
+        while (self.next_bin + 1) * self.bin_seconds <= self.latest - self.lateness:
+            window = self._close(self.next_bin)
+            if window is not None:
+                windows.append(window)
+            self.next_bin += 1
+        return windows
+
+    def flush(self):
+        # Closes all open bins (e.g. at the end of a stream) and returns their windows.
+        for source in list(self.scan_buffer):
+            self._flush_scan(source)
+        windows = []
+        if self.next_bin is None:
+            return windows
+        last = max(list(self.bins) + [self.next_bin - 1])
+        while self.next_bin <= last:
+            window = self._close(self.next_bin)
+            if window is not None:
+                windows.append(window)
+            self.next_bin += 1
+        return windows
+
+    def _close(self, number):
+        # Converts the accumulators of a bin to its row (same with df.resample().agg(resample_aggregations)),
+        # stores it in the ring buffer and returns (bin start, window) if a window is ready.
+        b = self.bins.pop(number) if number in self.bins else self._new_bin()
+        start_second = number * self.bin_seconds
+        self._add_missing_inferences(b)
+        row = b['sum'].copy()
+        with np.errstate(invalid='ignore', divide='ignore'):
+            row[self.mean_mask] = b['sum'][self.mean_mask] / np.where(b['count'][self.mean_mask] > 0,
+                                                                      b['count'][self.mean_mask], np.nan)
+        row[self.min_mask] = b['min'][self.min_mask]
+        row[self.max_mask] = b['max'][self.max_mask]
+        self._add_daily(row, b, start_second)
+        if 'hour_of_day' in self.columns:
+            row[self.columns['hour_of_day']] = (start_second // 3600) % 24
+        if self.transform is not None:
+            row = np.asarray(self.transform(row[None, :]), dtype=np.float64)[0]
+        if self.fill_value is not None:
+            row = np.where(np.isnan(row), self.fill_value, row)
+        self.ring[self.position] = row
+        self.position = (self.position + 1) % self.sequence_length
+        self.closed_bins += 1
+        if self.closed_bins < self.sequence_length and not self.emit_partial:
+            return None
+        return pd.Timestamp(start_second, unit='s'), self.window()
+
+    def _add_missing_inferences(self, b):
+        # Timeline seconds are the seconds with activity or audio (outer merge of the two). As each stream
+        # covers a continuous range, the timeline of a bin is taken as the longer of the two and its
+        # seconds without an inference get inference 3.
+        b['timeline'] = max(b['activity'], b['audio'])
+        for source in ['activity', 'audio']:
+            i = self.columns.get(source + '_inference_' + str(MISSING_INFERENCE))
+            missing = b['timeline'] - b[source]
+            if i is not None and missing > 0:
+                b['sum'][i] += missing
+                b['count'][i] += missing
+
+    def _add_daily(self, row, b, start_second):
+        # Deadline count of the day for each timeline second and days until the next deadline.
+        day = start_second // (24 * 60 * 60)
+        if 'deadlines' in self.columns:
+            count = 0 if self.deadlines is None else self.deadlines.get(day, 0)
+            row[self.columns['deadlines']] = count * b['timeline']
+        if 'days_to_deadline' in self.columns:
+            position = np.searchsorted(self.deadline_days, day, side='left')
+            valid = b['timeline'] > 0 and position < len(self.deadline_days)
+            row[self.columns['days_to_deadline']] = self.deadline_days[position] - day if valid else np.nan
+
+    def window(self):
+        # The last sequence_length closed bins as a (1, sequence_length, features) array, oldest bin first.
+        # Before sequence_length bins are closed, missing bins are filled with fill_value.
+        window = np.concatenate((self.ring[self.position:], self.ring[:self.position]))
+        if self.closed_bins < self.sequence_length:
+            window[:self.sequence_length - self.closed_bins] = np.nan if self.fill_value is None else self.fill_value
+        return window[None, :, :]
@@ -0,0 +1,81 @@
+import math
+import pandas as pd
+import numpy as np
+
+# Resampling functions of the sample combiners.
+# multi_resample resamples per-second data to multiple resolutions with a single pass over the data:
+# the finest bins are calculated once and coarser resolutions are derived from their partial
+# aggregates (sum, min, max and count + sum for mean).
+
+
+def resample_aggregations(columns):
+    # Function to assign aggregation method during resampling.
+    agg_dict = {}
+    for i in columns:
+        if 'level' in i:
+            agg_dict[i] = np.mean
+        elif 'days_to' in i:
+            # Days until an event, the nearest one in the bin.
+            agg_dict[i] = np.min
+        elif 'total' in i:
+            agg_dict[i] = np.max
+        else:
+            agg_dict[i] = np.sum
+    return agg_dict
+
+def resample_data(df, labels, res_range='10min'):
+    # Resamples data according to res_range and it chooses which calculation will be done
+    # for each features based on resample_aggregations fuction.
+    df = df.set_index('timestamp')
+    df.index = pd.to_datetime(df.index)
+    res_aggs = resample_aggregations(list(df.columns))
+    df = df.resample(res_range).agg(res_aggs)
+    df = pd.merge_asof(df, labels, left_index=True, right_index=True, tolerance=pd.Timedelta(res_range))
+    return df
+
+def finest_resolution(res_ranges):
+    # Finds the largest bin size that divides all resolutions, e.g. '300s' for '10min', '15min' and '45min'.
+    seconds = [int(pd.Timedelta(i).total_seconds()) for i in res_ranges]
+    finest = seconds[0]
+    for i in seconds[1:]:
+        finest = math.gcd(finest, i)
+    return str(finest) + 's'
+
+def partial_aggregates(df, agg_dict, freq):
+    # Calculates mergeable aggregates of each bin: sums (for sum and mean columns),
+    # non-missing value counts (for mean columns), minimums (for min columns) and maximums (for max columns).
+    sum_cols = [i for i in agg_dict if agg_dict[i] is np.sum]
+    mean_cols = [i for i in agg_dict if agg_dict[i] is np.mean]
+    min_cols = [i for i in agg_dict if agg_dict[i] is np.min]
+    max_cols = [i for i in agg_dict if agg_dict[i] is np.max]
+    resampler = df.resample(freq)
+    return {'sum': resampler[sum_cols + mean_cols].sum(),
+            'count': resampler[mean_cols].count(),
+            'min': resampler[min_cols].min(),
+            'max': resampler[max_cols].max()}
+
+def combine_partial_aggregates(partials, agg_dict, freq):
+    # Merges partial aggregates of fine bins to bins of freq, the result is same with df.resample(freq).agg(agg_dict).
+    sums = partials['sum'].resample(freq).sum()
+    counts = partials['count'].resample(freq).sum()
+    mins = partials['min'].resample(freq).min()
+    maxes = partials['max'].resample(freq).max()
+    result = pd.concat([sums, mins, maxes], axis=1)
+    # Bins without any value have zero count and zero sum, therefore their mean becomes NaN.
+    for i in counts.columns:
+        result[i] = sums[i] / counts[i].replace(0, np.nan)
+    return result[list(agg_dict)]
+
+def multi_resample(df, labels, res_ranges):
+    # Resamples df for all res_ranges and returns {res_range: resampled df}, each result is same with
+    # resample_data(df, labels, res_range). Per-second data is resampled only once to the finest bins.
+    df = df.set_index('timestamp')
+    df.index = pd.to_datetime(df.index)
+    res_aggs = resample_aggregations(list(df.columns))
+    partials = partial_aggregates(df, res_aggs, finest_resolution(res_ranges))
+    resampled = {}
+    for res_range in res_ranges:
+        res_df = combine_partial_aggregates(partials, res_aggs, res_range)
+        resampled[res_range] = pd.merge_asof(res_df, labels, left_index=True, right_index=True,
+                                             tolerance=pd.Timedelta(res_range))
+    return resampled
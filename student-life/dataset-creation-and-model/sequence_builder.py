@@ -0,0 +1,143 @@
+import warnings
+import numpy as np
+import pandas as pd
+from numpy.lib.stride_tricks import as_strided
+
+# Functions to convert combined samples (combined_samples/combined_data_all_*.csv) to
+# (instances, sequence_length, features) tensors for LSTM/CNN models.
+# Windows are taken from a strided sliding-window view of the data and selected with label indexes,
+# therefore no DataFrame is created or appended per instance.
+
+
+def sliding_windows(values, length):
+    # Returns a read-only view where windows[i] = rows i-length+1 .. i of values.
+    # Rows before the first row are NaN (values are padded with length - 1 NaN rows at the top).
+    values = np.asarray(values, dtype=np.float64)
+    padded = np.full((values.shape[0] + length - 1, values.shape[1]), np.nan)
+    padded[length - 1:] = values
+    return as_strided(padded, shape=(values.shape[0], length, values.shape[1]),
+                      strides=(padded.strides[0], padded.strides[0], padded.strides[1]), writeable=False)
+
+def window_tensor(values, end_indexes, length, first_indexes=None):
+    # Returns windows of length rows ending at end_indexes as an (instances, length, features) array.
+    # If first_indexes is given, rows before first_indexes of each window are NaN (pre-padding of short histories).
+    end_indexes = np.asarray(end_indexes, dtype=np.int64)
+    tensor = sliding_windows(values, length)[end_indexes]
+    if first_indexes is not None:
+        rows = end_indexes[:, None] - length + 1 + np.arange(length)[None, :]
+        tensor[rows < np.asarray(first_indexes)[:, None]] = np.nan
+    return tensor
+
+def label_indexes(df, label='STRESSED'):
+    # Positions of labeled rows.
+    return np.flatnonzero(df[label].notnull().values)
+
+def same_length_windows(df, length=72, label='STRESSED'):
+    # Windows ending at each label, each window starts after the previous label (after the first row for
+    # the first label) and has at most length rows, shorter windows are pre-padded with NaN.
+    # Returns the windows (including the label column), label indexes and column names.
+    df = df.drop(columns=['timestamp'])
+    indexes = label_indexes(df, label)
+    starts = np.concatenate(([0], indexes[:-1]))
+    windows = window_tensor(df.values, indexes, length, first_indexes=starts + 1)
+    return windows, indexes, list(df.columns)
+
+def create_same_length_instances(df, length=72, label='STRESSED'):
+    # Vectorized version of create_same_length_instances of the notebooks, gives the same data frame:
+    # length rows for each label, label is at the last row of each instance.
+    windows, indexes, columns = same_length_windows(df, length, label)
+    return pd.DataFrame(windows.reshape(-1, len(columns)), columns=columns)
+
+def create_instances(df, length=72, label='STRESSED'):
+    # Vectorized version of create_instances of the LSTM notebook, gives the same tensor:
+    # the last length rows (without the label column) up to each label.
+    indexes = label_indexes(df, label)
+    data = df.drop(columns=[label])
+    return window_tensor(data.values, indexes, length)
+
+def build_tensors(df, length=72, label='STRESSED', fill_value=np.nan):
+    # Creates X (instances, length, features), y (instances,) and feature names directly from combined samples.
+    # Missing values (and padding of short histories) are filled with fill_value, e.g. 0 or NaN.
+    windows, indexes, columns = same_length_windows(df, length, label)
+    features = [i for i in columns if i != label]
+    y = windows[:, -1, columns.index(label)]
+    # A label at the first row has no window (same with the notebooks), it is dropped.
+    valid = ~np.isnan(y)
+    X = windows[valid][:, :, [columns.index(i) for i in features]]
+    if not np.isnan(fill_value):
+        X[np.isnan(X)] = fill_value
+    return X, y[valid], features
+
+
+### WINDOW STATISTICS BEGIN ###
+# Statistics of windows for classical models (LightGBM notebook).
+
+# Statistics of each column, in order of the output columns.
+WINDOW_STATISTICS = ['mean', 'median', 'min', 'max', 'std', 'skew']
+
+def window_sums(values, first_rows, last_rows):
+    # Sums of values, their squares and cubes and number of non-missing values in rows first_rows .. last_rows.
+    # Cumulative sums are calculated once for all rows and the sum of each window is the difference of two rows.
+    # Columns are centered with their means before, so that the differences keep their precision.
+    valid = ~np.isnan(values)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        centered = np.where(valid, values - np.nanmean(values, axis=0), 0)
+    sums = []
+    for power in [valid.astype(np.float64), centered, centered ** 2, centered ** 3]:
+        cumulative = np.zeros((values.shape[0] + 1, values.shape[1]))
+        np.cumsum(power, axis=0, out=cumulative[1:])
+        sums.append(cumulative[last_rows + 1] - cumulative[first_rows])
+    return sums
+
+def window_statistics(values, end_indexes, length):
+    # Calculates mean, median, min, max, std and skew of each column for windows of rows
+    # end_indexes-length+1 .. end_indexes-1 (the label row is not included, same with the LightGBM notebook).
+    # Missing values are skipped like pandas. Returns an (instances, features, statistics) array.
+    values = np.asarray(values, dtype=np.float64)
+    end_indexes = np.asarray(end_indexes, dtype=np.int64)
+    last_rows = end_indexes - 1
+    first_rows = np.clip(end_indexes - length + 1, 0, None)
+    n, s1, s2, s3 = window_sums(values, first_rows, np.maximum(last_rows, first_rows - 1))
+
+    # Order statistics from the window array (nanmedian partitions each window).
+    windows = sliding_windows(values, length - 1)[np.clip(last_rows, 0, None)]
+    windows[last_rows < 0] = np.nan
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        medians = np.nanmedian(windows, axis=1)
+        mins = np.nanmin(windows, axis=1)
+        maxs = np.nanmax(windows, axis=1)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = s1 / n
+        # Central moments from the sums of powers.
+        m2 = np.clip(s2 - s1 * means, 0, None)
+        m3 = s3 - 3 * means * s2 + 2 * n * means ** 3
+        # Windows with a single value have no variance (without floating point errors of the differences).
+        m2[mins == maxs] = 0
+        m3[mins == maxs] = 0
+        stds = np.sqrt(m2 / (n - 1))
+        skews = (n * (n - 1) ** 0.5 / (n - 2)) * (m3 / m2 ** 1.5)
+    stds[n < 2] = np.nan
+    skews[m2 == 0] = 0
+    skews[n < 3] = np.nan
+    # Means are calculated from centered values.
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        means = means + np.nanmean(values, axis=0)
+    means[n == 0] = np.nan
+    return np.stack([means, medians, mins, maxs, stds, skews], axis=2)
+
+def create_statistics_instances(df, length=72, label='STRESSED'):
+    # Vectorized version of create_instances of the LightGBM notebook, gives the same data frame:
+    # <col>_<stat> columns for each column and statistic and the label of each instance.
+    indexes = label_indexes(df, label)
+    data = df.drop(columns=[label])
+    stats = window_statistics(data.values, indexes, length)
+    columns = [i + '_' + j for i in data.columns for j in WINDOW_STATISTICS]
+    all_data = pd.DataFrame(stats.reshape(len(indexes), -1), columns=columns)
+    all_data[label] = df[label].values[indexes]
+    return all_data
+
+### WINDOW STATISTICS END ###
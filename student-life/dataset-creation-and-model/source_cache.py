@@ -0,0 +1,174 @@
+import functools
+import hashlib
+import inspect
+import os
+import pickle
+import tempfile
+
+# On-disk cache of the raw source readers (get_activity, get_audio, ..., ema).
+# Output of a reader is saved as a pickle file. The key of the file is created from the reader name,
+# reader version, reader code (bytecode, constants and names), the content of the helper modules it calls
+# (e.g. feature_schema.py for apply_schema) and the path, size and modification time (or content hash)
+# of its source files. Therefore, the cache is used until the raw file, the reader or its helpers change.
+# The least recently used files are deleted when the cache is larger than its size limit.
+# Caching is disabled until configure_cache is called. Settings are kept in environment variables,
+# so worker processes use the same cache.
+
+CACHE_DIR_ENV = 'READER_CACHE_DIR'
+CACHE_SIZE_ENV = 'READER_CACHE_MAX_BYTES'
+CACHE_KEY_ENV = 'READER_CACHE_KEY'
+
+# Default size limit of the cache.
+MAX_CACHE_BYTES = 20 * 1024 ** 3
+
+
+def configure_cache(cache_dir, max_bytes=MAX_CACHE_BYTES, key='stat'):
+    # Enables the cache in cache_dir (None disables it).
+    # key='stat' identifies source files with size and modification time, key='hash' with their content.
+    if cache_dir is None:
+        os.environ.pop(CACHE_DIR_ENV, None)
+        return
+    if key not in ['stat', 'hash']:
+        raise ValueError("key should be 'stat' or 'hash', not " + str(key))
+    os.makedirs(cache_dir, exist_ok=True)
+    os.environ[CACHE_DIR_ENV] = cache_dir
+    os.environ[CACHE_SIZE_ENV] = str(int(max_bytes))
+    os.environ[CACHE_KEY_ENV] = key
+
+def file_fingerprint(path, key='stat'):
+    # Identifies the state of a source file.
+    if key == 'hash':
+        sha = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                sha.update(block)
+        return sha.hexdigest()
+    stat = os.stat(path)
+    return str(stat.st_size) + '-' + str(stat.st_mtime_ns)
+
+def code_fingerprint(code):
+    # Bytecode, names and constants of a code object, nested code objects (e.g. lambdas) included,
+    # so editing a literal (a column name, a threshold, a fill value) changes the fingerprint.
+    parts = [code.co_code, repr(code.co_names).encode()]
+    for const in code.co_consts:
+        if inspect.iscode(const):
+            parts.append(code_fingerprint(const))
+        elif isinstance(const, frozenset):
+            # Order of a frozenset changes between processes.
+            parts.append(repr(sorted(const, key=repr)).encode())
+        else:
+            parts.append(repr(const).encode())
+    return b'|'.join(parts)
+
+def helper_files(function):
+    # Source files of the modules next to the reader's file whose functions the reader uses,
+    # e.g. feature_schema.py for apply_schema and timeline_utils.py for mode_by_timestamp.
+    # Helpers of the helpers in other modules are not followed, increase version of the reader for them.
+    reader_file = os.path.abspath(function.__code__.co_filename)
+    directory = os.path.dirname(reader_file)
+    names = set()
+    codes = [function.__code__]
+    while codes:
+        code = codes.pop()
+        names.update(code.co_names)
+        codes += [i for i in code.co_consts if inspect.iscode(i)]
+    files = set()
+    for name in names:
+        module = inspect.getmodule(function.__globals__.get(name)) if name in function.__globals__ else None
+        path = getattr(module, '__file__', None)
+        if path is None:
+            continue
+        path = os.path.abspath(path)
+        if os.path.dirname(path) == directory and path != reader_file and path.endswith('.py'):
+            files.add(path)
+    return sorted(files)
+
+def reader_fingerprint(function):
+    # Fingerprint of the reader code and the content of its helper modules.
+    sha = hashlib.sha1()
+    sha.update(code_fingerprint(function.__code__))
+    for path in helper_files(function):
+        with open(path, 'rb') as f:
+            sha.update(('|' + os.path.basename(path) + '|').encode())
+            sha.update(f.read())
+    return sha.digest()
+
+def cache_key(name, version, code, paths, key='stat'):
+    sha = hashlib.sha1()
+    sha.update((name + '|' + str(version) + '|').encode())
+    sha.update(code)
+    for path in paths:
+        sha.update(('|' + os.path.abspath(path) + '|' + file_fingerprint(path, key)).encode())
+    return sha.hexdigest()
+
+def evict(cache_dir, max_bytes):
+    # Deletes the least recently used files until the cache fits to max_bytes.
+    files = []
+    for root, dirs, names in os.walk(cache_dir):
+        for name in names:
+            if name.endswith('.pkl'):
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    # Deleted by another process or reader thread.
+                    continue
+                files.append((stat.st_mtime, stat.st_size, path))
+    total = sum(i[1] for i in files)
+    for mtime, size, path in sorted(files):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+            total -= size
+        except OSError:
+            pass
+
+def cached_reader(source, version=1):
+    # Decorator for readers. source is the path of the raw file relative to the dataset directory
+    # and it is formatted with the arguments of the reader, e.g. 'sensing/activity/activity_{user}.csv'.
+    # The dataset directory is the "loc" argument of the reader.
+    # Increase version when the output of the reader changes without a change of its own code or of the
+    # modules next to it that it calls (e.g. a change of pandas or of a helper of a helper).
+    def decorator(reader):
+        signature = inspect.signature(reader)
+        # Helpers are found from the globals of the reader's module, so the fingerprint is created at the
+        # first call, after the module is imported completely.
+        fingerprint = []
+
+        @functools.wraps(reader)
+        def wrapper(*args, **kwargs):
+            cache_dir = os.environ.get(CACHE_DIR_ENV)
+            if cache_dir is None:
+                return reader(*args, **kwargs)
+            arguments = signature.bind(*args, **kwargs).arguments
+            path = arguments['loc'] + source.format(**arguments)
+            if not fingerprint:
+                fingerprint.append(reader_fingerprint(reader))
+            try:
+                key = cache_key(reader.__name__, version, fingerprint[0], [path],
+                                os.environ.get(CACHE_KEY_ENV, 'stat'))
+            except OSError:
+                # Source file cannot be read, the reader raises the error.
+                return reader(*args, **kwargs)
+            cache_file = os.path.join(cache_dir, reader.__name__, key + '.pkl')
+            if os.path.exists(cache_file):
+                try:
+                    with open(cache_file, 'rb') as f:
+                        data = pickle.load(f)
+                    # Update the modification time for the least recently used eviction.
+                    os.utime(cache_file, None)
+                    return data
+                except (OSError, EOFError, pickle.UnpicklingError):
+                    pass
+            data = reader(*args, **kwargs)
+            # Saved to a temporary file first, so other processes never read a half written file.
+            os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(cache_file), suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, cache_file)
+            evict(cache_dir, int(os.environ.get(CACHE_SIZE_ENV, MAX_CACHE_BYTES)))
+            return data
+        return wrapper
+    return decorator
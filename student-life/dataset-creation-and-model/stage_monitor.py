@@ -0,0 +1,184 @@
+import functools
+import json
+import os
+import time
+import threading
+
+try:
+    import resource
+except ImportError:
+    # resource is not available on Windows, peak memory is not recorded there.
+    resource = None
+
+# Records wall time, CPU time, rows in/out and peak memory (RSS) increase of each pipeline stage
+# (readers, merges, resampling). Each call of a stage is written as a json line to the stage log
+# with the user that is processed, so slow sources and users can be found in the log.
+# summarize_stage_log creates a summary of the log at the end of a run.
+# Recording is disabled until configure_stage_log is called. The log path is kept in an environment
+# variable, so worker processes write to the same file.
+# CPU time is measured for the thread of the stage, so reads of prefetch threads (see user_runner.py) are not
+# added to the merges. Peak memory can only be measured for the whole process: if stages of other threads
+# run at the same time, the record has rss_shared=True and its peak memory increase includes theirs.
+
+STAGE_LOG_ENV = 'STAGE_LOG_PATH'
+
+# User of the stages of the current thread, set by set_stage_user (see user_runner.py).
+# It is kept for each thread, because the sources of the next user can be read by prefetch threads
+# while the current user is processed.
+_local = threading.local()
+
+# Records of the running stages of all threads as (thread id, record), to find stages that overlap.
+_running = []
+_running_lock = threading.Lock()
+
+# CPU time of the current thread (time.thread_time is new in Python 3.7).
+_thread_time = getattr(time, 'thread_time', time.process_time)
+
+
+def configure_stage_log(path, append=False):
+    # Enables recording of stages to path (None disables it). The file is emptied unless append is True.
+    if path is None:
+        os.environ.pop(STAGE_LOG_ENV, None)
+        return
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    if not append:
+        open(path, 'w').close()
+    os.environ[STAGE_LOG_ENV] = path
+
+def set_stage_user(user):
+    _local.user = user
+
+def peak_rss_mb():
+    # Peak resident memory of the process in megabytes (ru_maxrss is in kilobytes on Linux, bytes on macOS).
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if os.uname().sysname == 'Darwin':
+        return peak / 1024 ** 2
+    return peak / 1024
+
+def count_rows(values):
+    # Total rows of data frames and series in values, None if there are none.
+    rows = [len(i) for i in values if hasattr(i, 'shape') and hasattr(i, 'index')]
+    return sum(rows) if rows else None
+
+def write_record(record):
+    path = os.environ.get(STAGE_LOG_ENV)
+    if path is None:
+        return
+    # A single write of a line in append mode, so lines of worker processes are not mixed.
+    with open(path, 'a') as f:
+        f.write(json.dumps(record) + '\n')
+
+def stage(function=None, name=None):
+    # Decorator that records each call of function as a stage, named after the function by default.
+    # Can be used as @stage or @stage(name='...').
+    if function is None:
+        return functools.partial(stage, name=name)
+    stage_name = name or function.__name__
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        if STAGE_LOG_ENV not in os.environ:
+            return function(*args, **kwargs)
+        record = {'user': getattr(_local, 'user', None), 'stage': stage_name, 'pid': os.getpid(),
+                  'rows_in': count_rows(list(args) + list(kwargs.values()))}
+        record['rss_shared'] = False
+        thread = threading.get_ident()
+        with _running_lock:
+            others = [r for t, r in _running if t != thread]
+            if others:
+                record['rss_shared'] = True
+                for r in others:
+                    r['rss_shared'] = True
+            _running.append((thread, record))
+        peak_before = peak_rss_mb()
+        wall_start = time.perf_counter()
+        cpu_start = _thread_time()
+        result = None
+        try:
+            result = function(*args, **kwargs)
+            return result
+        except Exception as e:
+            record['error'] = type(e).__name__ + ': ' + str(e)
+            raise
+        finally:
+            record['wall_seconds'] = round(time.perf_counter() - wall_start, 6)
+            record['cpu_seconds'] = round(_thread_time() - cpu_start, 6)
+            record['rows_out'] = count_rows(result.values() if isinstance(result, dict) else [result])
+            record['peak_rss_delta_mb'] = None if peak_before is None else round(peak_rss_mb() - peak_before, 3)
+            with _running_lock:
+                _running[:] = [i for i in _running if i[1] is not record]
+            write_record(record)
+    return wrapper
+
+def read_stage_log(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def summarize_stage_log(path, top=5):
+    # Aggregates records of the log per stage (calls, total/max wall time, total CPU time, rows,
+    # largest peak memory increase) and per user, and lists the slowest users.
+    # Largest peak memory increase is taken from the records without other threads running at the same time,
+    # records with rss_shared are counted in rss_shared_calls.
+    records = read_stage_log(path)
+    stages = {}
+    users = {}
+    for r in records:
+        s = stages.setdefault(r['stage'], {'calls': 0, 'errors': 0, 'wall_seconds': 0.0, 'cpu_seconds': 0.0,
+                                           'max_wall_seconds': 0.0, 'slowest_user': None, 'rows_out': 0,
+                                           'max_peak_rss_delta_mb': 0.0, 'rss_shared_calls': 0})
+        s['calls'] += 1
+        s['errors'] += 'error' in r
+        s['wall_seconds'] += r['wall_seconds']
+        s['cpu_seconds'] += r['cpu_seconds']
+        s['rows_out'] += r['rows_out'] or 0
+        if r['wall_seconds'] >= s['max_wall_seconds']:
+            s['max_wall_seconds'] = r['wall_seconds']
+            s['slowest_user'] = r['user']
+        if r.get('rss_shared'):
+            s['rss_shared_calls'] += 1
+        elif r['peak_rss_delta_mb'] is not None:
+            s['max_peak_rss_delta_mb'] = max(s['max_peak_rss_delta_mb'], r['peak_rss_delta_mb'])
+        if r['user'] is not None:
+            u = users.setdefault(r['user'], {'wall_seconds': None, 'stage_seconds': 0.0, 'slowest_stage': None,
+                                             'slowest_stage_seconds': 0.0, 'errors': 0})
+            u['errors'] += 'error' in r
+            if r['stage'] == 'process_user':
+                u['wall_seconds'] = r['wall_seconds']
+                continue
+            u['stage_seconds'] += r['wall_seconds']
+            if r['wall_seconds'] >= u['slowest_stage_seconds']:
+                u['slowest_stage'] = r['stage']
+                u['slowest_stage_seconds'] = r['wall_seconds']
+    # Users without a process_user record (e.g. in the combiner) take the total time of their stages.
+    for u in users.values():
+        if u['wall_seconds'] is None:
+            u['wall_seconds'] = u['stage_seconds']
+    slowest = sorted(users, key=lambda i: users[i]['wall_seconds'], reverse=True)[:top]
+    return {'records': len(records), 'stages': stages, 'users': users, 'slowest_users': slowest}
+
+def print_summary(summary):
+    # Peak memory of the calls that ran with stages of other threads is process-wide, they are only counted.
+    print('{:<28}{:>7}{:>12}{:>12}{:>12}{:>10}{:>14}{:>12}'.format('stage', 'calls', 'wall (s)', 'cpu (s)',
+                                                                'max (s)', 'user', 'max RSS+ (MB)',
+                                                                'shared RSS'))
+    stages = summary['stages']
+    for name in sorted(stages, key=lambda i: stages[i]['wall_seconds'], reverse=True):
+        s = stages[name]
+        print('{:<28}{:>7}{:>12.2f}{:>12.2f}{:>12.2f}{:>10}{:>14.1f}{:>12}'.format(
+            name, s['calls'], s['wall_seconds'], s['cpu_seconds'], s['max_wall_seconds'],
+            str(s['slowest_user']), s['max_peak_rss_delta_mb'], s['rss_shared_calls']))
+    for user in summary['slowest_users']:
+        u = summary['users'][user]
+        print('Slow user', user, 'took', round(u['wall_seconds'], 1), 'seconds, slowest stage:',
+              u['slowest_stage'], '(' + str(round(u['slowest_stage_seconds'], 1)) + ' seconds)')
+
+def write_summary(path):
+    # Summarizes the stage log in path, prints it and saves it next to the log as <log name>_summary.json.
+    summary = summarize_stage_log(path)
+    print_summary(summary)
+    with open(os.path.splitext(path)[0] + '_summary.json', 'w') as f:
+        json.dump(summary, f, indent=1)
+    return summary
@@ -0,0 +1,187 @@
+import os
+import json
+import argparse
+import numpy as np
+import pandas as pd
+
+# Generates a fake StudentLife dataset directory with the same files, columns and value ranges as the
+# raw dataset (sensing/*, sms, call_log, app_usage, EMA/response and education/deadlines.csv).
+# The real dataset is not in the repository, this data is used to run and benchmark the scripts.
+# Values are random, only the structure, sampling rates and sizes are realistic.
+
+# First timestamp of the generated data (2013-03-27 00:00:00), same with the start of the study.
+START_TIMESTAMP = 1364342400
+
+# Average number of events of each source per day (for density=1).
+# Activity and audio inferences are written in duty cycles like the phone sensors.
+EVENTS_PER_DAY = {'activity': 8000,
+                  'audio': 8000,
+                  'conversation': 15,
+                  'bluetooth_scans': 144,
+                  'wifi_scans': 144,
+                  'dark': 2,
+                  'phonecharge': 2,
+                  'phonelock': 20,
+                  'sms': 10,
+                  'call_log': 4,
+                  'app_usage': 150,
+                  'ema': 3}
+
+
+def user_codes(users):
+    # u00, u01, ...
+    return ['u' + str(i).zfill(2) for i in range(users)]
+
+def _event_times(rng, start, end, count):
+    # Sorted random integer timestamps between start and end.
+    return np.sort(rng.randint(start, end, size=max(int(count), 1)))
+
+def _intervals(rng, start, end, count, min_duration, max_duration):
+    # Sorted non-overlapping (start, end) intervals.
+    starts = _event_times(rng, start, end, count)
+    ends = starts + rng.randint(min_duration, max_duration, size=starts.shape[0])
+    # An interval ends before the next one starts.
+    ends[:-1] = np.minimum(ends[:-1], starts[1:] - 1)
+    keep = ends > starts
+    return starts[keep], ends[keep]
+
+def _duty_cycle_times(rng, start, end, count):
+    # Timestamps of inferences. Sensors run for a few minutes and sleep for a few minutes,
+    # an inference is written every 2-3 seconds while running (with several rows at some seconds).
+    cycles = max(int((end - start) / 360), 1)
+    per_cycle = max(int(count / cycles), 1)
+    cycle_starts = start + np.arange(cycles) * 360 + rng.randint(0, 60, size=cycles)
+    offsets = np.cumsum(rng.randint(1, 4, size=(cycles, per_cycle)), axis=1) - 1
+    times = (cycle_starts[:, None] + offsets).ravel()
+    return np.sort(times[times < end])
+
+def _write_csv(df, path, header=True):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    df.to_csv(path, index=False, header=header)
+
+def _write_records(records, path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump(records, f)
+
+def write_user(loc, user, days, density, rng):
+    # Writes all files of a user.
+    start = START_TIMESTAMP
+    end = start + int(days * 24 * 60 * 60)
+
+    def count(source):
+        return max(int(EVENTS_PER_DAY[source] * days * density), 1)
+
+    # Activity and audio inferences ("activity inference" 0-3, "audio inference" 0-2).
+    # Column names have a space at the beginning in the raw files.
+    times = _duty_cycle_times(rng, start, end, count('activity'))
+    _write_csv(pd.DataFrame({'timestamp': times, ' activity inference': rng.randint(0, 4, size=times.shape[0])}),
+               loc + 'sensing/activity/activity_' + user + '.csv')
+    times = _duty_cycle_times(rng, start, end, count('audio'))
+    _write_csv(pd.DataFrame({'timestamp': times, ' audio inference': rng.randint(0, 3, size=times.shape[0])}),
+               loc + 'sensing/audio/audio_' + user + '.csv')
+
+    # Conversations of 1-30 minutes.
+    starts, ends = _intervals(rng, start, end, count('conversation'), 60, 1800)
+    _write_csv(pd.DataFrame({'start_timestamp': starts, ' end_timestamp': ends}),
+               loc + 'sensing/conversation/conversation_' + user + '.csv')
+
+    # Bluetooth and wifi scans every 10 minutes, each scan sees several devices.
+    scans = _event_times(rng, start, end, count('bluetooth_scans'))
+    devices = rng.randint(1, 12, size=scans.shape[0])
+    times = np.repeat(scans, devices)
+    _write_csv(pd.DataFrame({'time': times,
+                             'MAC': ['00:00:00:00:' + str(i % 100).zfill(2) for i in rng.randint(0, 300, size=times.shape[0])],
+                             'class_id': rng.choice([0, 524, 1028, 5898764, 7936], size=times.shape[0]),
+                             'level': rng.randint(-110, -40, size=times.shape[0])}),
+               loc + 'sensing/bluetooth/bt_' + user + '.csv')
+    scans = _event_times(rng, start, end, count('wifi_scans'))
+    devices = rng.randint(1, 25, size=scans.shape[0])
+    times = np.repeat(scans, devices)
+    _write_csv(pd.DataFrame({'time': times,
+                             'BSSID': ['00:1f:45:00:00:' + str(i).zfill(2) for i in rng.randint(0, 100, size=times.shape[0])],
+                             'freq': rng.choice([2412, 2437, 2462, 5180, 5745], size=times.shape[0]),
+                             'level': rng.randint(-95, -30, size=times.shape[0])}),
+               loc + 'sensing/wifi/wifi_' + user + '.csv')
+    _write_csv(pd.DataFrame({'time': scans,
+                             'location': rng.choice(['in[sudikoff]', 'in[baker-berry]', 'near[the-green]'],
+                                                    size=scans.shape[0])}),
+               loc + 'sensing/wifi_location/wifi_location_' + user + '.csv')
+
+    # Dark (nights), phone charge and phone lock intervals.
+    for source, path, min_duration, max_duration in [('dark', 'dark/dark_', 1800, 36000),
+                                                     ('phonecharge', 'phonecharge/phonecharge_', 1800, 14400),
+                                                     ('phonelock', 'phonelock/phonelock_', 60, 7200)]:
+        starts, ends = _intervals(rng, start, end, count(source), min_duration, max_duration)
+        _write_csv(pd.DataFrame({'start': starts, 'end': ends}), loc + 'sensing/' + path + user + '.csv')
+
+    # SMS (only timestamps are used).
+    times = _event_times(rng, start, end, count('sms'))
+    _write_csv(pd.DataFrame({'id': [user + '-' + str(i) for i in range(times.shape[0])],
+                             'device': user,
+                             'timestamp': times,
+                             'MESSAGES_address': '{"ONE_WAY_HASH":"0"}',
+                             'MESSAGES_type': rng.randint(1, 3, size=times.shape[0])}),
+               loc + 'sms/sms_' + user + '.csv')
+
+    # Call log. Calls are saved when the log is synced, CALLS_date (milliseconds) is the start of the call.
+    syncs = _event_times(rng, start, end, count('call_log'))
+    dates = syncs - rng.randint(0, 3600, size=syncs.shape[0])
+    _write_csv(pd.DataFrame({'id': [user + '-' + str(i) for i in range(syncs.shape[0])],
+                             'device': user,
+                             'timestamp': syncs,
+                             'CALLS__id': np.arange(syncs.shape[0]),
+                             'CALLS_date': dates * 1000,
+                             'CALLS_duration': rng.randint(0, 900, size=syncs.shape[0]),
+                             'CALLS_type': rng.randint(1, 4, size=syncs.shape[0])}),
+               loc + 'call_log/call_log_' + user + '.csv')
+
+    # Running apps.
+    times = _event_times(rng, start, end, count('app_usage'))
+    _write_csv(pd.DataFrame({'id': [user + '-' + str(i) for i in range(times.shape[0])],
+                             'device': user,
+                             'timestamp': times,
+                             'RUNNING_TASKS_baseActivity_mClass': 'com.android.launcher2.Launcher',
+                             'RUNNING_TASKS_numRunning': rng.randint(1, 5, size=times.shape[0])}),
+               loc + 'app_usage/running_app_' + user + '.csv')
+
+    # EMA responses. Some responses only have a "null" key like the raw files.
+    # The first record has all answer keys, so the columns are read in the same order with the raw files.
+    for typ, column, levels in [('Stress', 'level', 5), ('Mood 2', 'how', 3)]:
+        times = _event_times(rng, start, end, count('ema'))
+        records = [{column: int(rng.randint(1, levels + 1)), 'location': 'Unknown', 'resp_time': int(i)}
+                   for i in times]
+        records[5::10] = [{'null': 'Unknown', 'resp_time': int(i)} for i in times[5::10]]
+        _write_records(records, loc + 'EMA/response/' + typ + '/' + typ + '_' + user + '.json')
+
+def write_deadlines(loc, users, days, rng):
+    # Number of deadlines of each user for each day of the study.
+    dates = pd.date_range(pd.to_datetime(START_TIMESTAMP, unit='s'), periods=int(np.ceil(days)), freq='D')
+    deadlines = pd.DataFrame(rng.poisson(0.5, size=(len(users), len(dates))),
+                             columns=[str(i.date()) for i in dates])
+    deadlines.insert(0, 'uid', users)
+    _write_csv(deadlines, loc + 'education/deadlines.csv')
+
+def generate_dataset(loc, users=3, days=7, density=1.0, seed=0):
+    # Writes a fake dataset of users for days (can be fractional) to loc and returns the user codes.
+    # density scales the number of events of all sources.
+    if not loc.endswith('/'):
+        loc = loc + '/'
+    rng = np.random.RandomState(seed)
+    codes = user_codes(users)
+    for user in codes:
+        write_user(loc, user, days, density, rng)
+    write_deadlines(loc, codes, days, rng)
+    return codes
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generates a fake StudentLife dataset for tests and benchmarks.')
+    parser.add_argument('loc', help='output directory of the dataset')
+    parser.add_argument('--users', type=int, default=3, help='number of users')
+    parser.add_argument('--days', type=float, default=7, help='duration of the data of each user in days')
+    parser.add_argument('--density', type=float, default=1.0, help='scale of the number of events of all sources')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the random generator')
+    args = parser.parse_args()
+    codes = generate_dataset(args.loc, users=args.users, days=args.days, density=args.density, seed=args.seed)
+    print(len(codes), 'users are written to', args.loc)
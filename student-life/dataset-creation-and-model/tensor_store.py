@@ -0,0 +1,60 @@
+import json
+import os
+import shutil
+import tempfile
+import time
+import numpy as np
+
+# Saves prepared training tensors (X, y) as .npy files with a small json manifest
+# (feature names, sequence_length, res_range, shapes). Tensors are opened with np.load(mmap_mode='r'),
+# so loading is instant, only used parts are read from disk and all training processes that open
+# the same store share the page cache instead of keeping their own copy.
+
+MANIFEST = 'manifest.json'
+
+
+def tensor_store_path(root, res_range, sequence_length):
+    # Directory of the store of a resample range and sequence length, e.g. tensors/30min_seq24/.
+    return os.path.join(root, res_range + '_seq' + str(sequence_length))
+
+def save_tensors(path, X, y, feature_names, sequence_length, res_range, **info):
+    # Saves X, y and the manifest to directory path. Extra info (e.g. source file, normalization) is added
+    # to the manifest. Files are written to a temporary directory first and moved to path at the end,
+    # so a store is never seen half written.
+    X = np.ascontiguousarray(X, dtype=np.float32)
+    y = np.ascontiguousarray(y, dtype=np.float32)
+    if X.shape[0] != y.shape[0]:
+        raise ValueError('X and y should have the same number of instances: ' + str(X.shape[0]) + ' != ' + str(y.shape[0]))
+    manifest = {'feature_names': [str(i) for i in feature_names],
+                'sequence_length': int(sequence_length),
+                'res_range': res_range,
+                'X_shape': list(X.shape),
+                'y_shape': list(y.shape),
+                'dtype': str(X.dtype),
+                'created': time.strftime('%Y-%m-%d %H:%M:%S')}
+    manifest.update(info)
+    parent = os.path.dirname(os.path.abspath(path))
+    os.makedirs(parent, exist_ok=True)
+    tmp_path = tempfile.mkdtemp(dir=parent)
+    np.save(os.path.join(tmp_path, 'X.npy'), X)
+    np.save(os.path.join(tmp_path, 'y.npy'), y)
+    with open(os.path.join(tmp_path, MANIFEST), 'w') as f:
+        json.dump(manifest, f, indent=1)
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.rename(tmp_path, path)
+    return manifest
+
+def load_manifest(path):
+    with open(os.path.join(path, MANIFEST)) as f:
+        return json.load(f)
+
+def load_tensors(path, mmap_mode='r'):
+    # Opens X and y of the store as memory-mapped arrays (mmap_mode=None reads them to memory).
+    # Returns X, y and the manifest.
+    manifest = load_manifest(path)
+    X = np.load(os.path.join(path, 'X.npy'), mmap_mode=mmap_mode)
+    y = np.load(os.path.join(path, 'y.npy'), mmap_mode=mmap_mode)
+    if list(X.shape) != manifest['X_shape'] or list(y.shape) != manifest['y_shape']:
+        raise ValueError('Tensor store ' + path + ' does not match its manifest.')
+    return X, y, manifest
@@ -0,0 +1,24 @@
+import numpy as np
+import pandas as pd
+
+from feature_schema import apply_schema
+
+
+def test_apply_schema_narrows_values_that_fit():
+    df = apply_schema(pd.DataFrame({'phone_locked': [0.0, 1.0], 'bt_total_near': [0, 300], 'activity_inference': [0, 3]}))
+    assert df.dtypes.to_dict() == {'phone_locked': np.uint8, 'bt_total_near': np.uint16,
+                                   'activity_inference': np.int8}
+
+def test_apply_schema_keeps_values_out_of_range():
+    df = pd.DataFrame({'bt_total_near': [1, 70000], 'conversation': [-1, 1], 'sms': [0.5, 1.0],
+                       'call_duration': [1, 3000000000]})
+    expected = df.astype(np.float64).values
+    df = apply_schema(df)
+    # Wider types instead of wrapping around, float32 for fractions.
+    assert df.dtypes.to_dict() == {'bt_total_near': np.uint32, 'conversation': np.int16, 'sms': np.float32,
+                                   'call_duration': np.int64}
+    np.testing.assert_array_equal(df.astype(np.float64).values, expected)
+
+def test_apply_schema_missing_values():
+    df = apply_schema(pd.DataFrame({'bt_total_near': [1, np.nan], 'phone_locked': [0, 1]}), missing=True)
+    assert df.dtypes.to_dict() == {'bt_total_near': np.float32, 'phone_locked': np.float32}
@@ -0,0 +1,47 @@
+import importlib
+import sys
+
+from source_cache import configure_cache, code_fingerprint
+
+READER = '''
+from source_cache import cached_reader
+from cache_helper import scale
+
+@cached_reader('raw_{user}.txt')
+def get_value(user, loc):
+    with open(loc + 'raw_' + user + '.txt') as f:
+        return scale(int(f.read())) + OFFSET
+'''
+
+
+def _load(tmp_path, offset, factor):
+    (tmp_path / 'cache_reader.py').write_text(READER.replace('OFFSET', str(offset)))
+    (tmp_path / 'cache_helper.py').write_text('def scale(x):\n    return x * ' + str(factor) + '\n')
+    for name in ['cache_reader', 'cache_helper']:
+        sys.modules.pop(name, None)
+    importlib.invalidate_caches()
+    return importlib.import_module('cache_reader').get_value
+
+def test_constants_change_fingerprint():
+    def a(df):
+        return df.fillna(3)
+    def b(df):
+        return df.fillna(0)
+    assert code_fingerprint(a.__code__) != code_fingerprint(b.__code__)
+
+def test_cache_follows_reader_and_helper_changes(tmp_path, monkeypatch):
+    monkeypatch.syspath_prepend(str(tmp_path))
+    (tmp_path / 'raw_u00.txt').write_text('2')
+    loc = str(tmp_path) + '/'
+    configure_cache(str(tmp_path / 'cache'))
+    try:
+        assert _load(tmp_path, 1, 10)('u00', loc) == 21
+        assert _load(tmp_path, 1, 10)('u00', loc) == 21
+        # A literal of the reader and the code of its helper module are parts of the key.
+        assert _load(tmp_path, 5, 10)('u00', loc) == 25
+        assert _load(tmp_path, 5, 100)('u00', loc) == 205
+        assert len(list((tmp_path / 'cache' / 'get_value').glob('*.pkl'))) == 3
+    finally:
+        configure_cache(None)
+        for name in ['cache_reader', 'cache_helper']:
+            sys.modules.pop(name, None)
@@ -0,0 +1,36 @@
+import threading
+import time
+
+from stage_monitor import stage, configure_stage_log, read_stage_log, summarize_stage_log
+
+
+@stage
+def busy(seconds):
+    start = time.perf_counter()
+    while time.perf_counter() - start < seconds:
+        pass
+
+@stage
+def wait(seconds):
+    time.sleep(seconds)
+
+def test_cpu_time_of_thread_and_shared_rss(tmp_path):
+    path = str(tmp_path / 'stage_log.jsonl')
+    configure_stage_log(path)
+    try:
+        busy(0.05)
+        # A reader thread keeps the CPU busy while the main thread waits.
+        thread = threading.Thread(target=busy, args=(0.3,))
+        thread.start()
+        wait(0.2)
+        thread.join()
+    finally:
+        configure_stage_log(None)
+    alone, waited, reader = read_stage_log(path)
+    assert alone['stage'] == 'busy' and not alone['rss_shared']
+    assert waited['stage'] == 'wait' and waited['cpu_seconds'] < 0.1
+    assert reader['stage'] == 'busy' and reader['cpu_seconds'] > 0.2
+    assert waited['rss_shared'] and reader['rss_shared']
+    summary = summarize_stage_log(path)
+    assert summary['stages']['busy']['rss_shared_calls'] == 1
+    assert summary['stages']['wait']['rss_shared_calls'] == 1
@@ -0,0 +1,88 @@
+import numpy as np
+import pandas as pd
+
+from timeline_utils import aggregate_scans, BLUETOOTH_BANDS, BLUETOOTH_MAX_LEVEL, WIFI_BANDS, WIFI_MAX_LEVEL
+from timeline_utils import mode_by_timestamp, read_mode_per_second
+from feature_schema import apply_schema
+
+
+def _scans(seed, n=5000):
+    rng = np.random.RandomState(seed)
+    scans = pd.DataFrame({'time': rng.randint(0, 800, n), 'level': rng.randint(-110, 5, n).astype(np.float64)})
+    scans.loc[rng.rand(n) < 0.05, 'level'] = np.nan
+    return scans
+
+def _loop(scans, bands, max_level):
+    # The old per timestamp loop of merge_bluetooth and merge_wifi (with pd.concat instead of DataFrame.append).
+    rows = []
+    for time in scans.time.unique():
+        item = scans[scans.time == time]
+        data = {'timestamp': time, 'total_devices_around': item.shape[0]}
+        highs = [low for name, low in bands[1:]] + [np.inf]
+        for (name, low), high in zip(bands, highs):
+            in_band = (item.level >= low) & (item.level < high)
+            if max_level is not None:
+                in_band &= item.level <= max_level
+            data[name] = item[in_band].shape[0]
+        mean = item.level.mean()
+        data['level_avg'] = np.nan if np.isnan(mean) else round(mean)
+        data['level_std'] = item.level.std()
+        rows.append(pd.DataFrame([data]))
+    old = pd.concat(rows, ignore_index=True)
+    return old[sorted(old.columns)].astype(np.float64)
+
+def test_aggregate_scans_matches_loop():
+    for seed, bands, max_level in [(0, BLUETOOTH_BANDS, BLUETOOTH_MAX_LEVEL), (1, WIFI_BANDS, WIFI_MAX_LEVEL)]:
+        scans = _scans(seed)
+        old = _loop(scans, bands, max_level)
+        new = aggregate_scans(scans, bands, max_level=max_level)
+        assert list(new.columns) == list(old.columns)
+        for column in old.columns:
+            assert new[column].dtype == np.float64 or column == 'timestamp'
+            if column == 'level_std':
+                # Sums of the groups are added in another order than Series.std, the last digits can differ.
+                np.testing.assert_allclose(new[column].values, old[column].values, rtol=1e-12)
+            else:
+                np.testing.assert_array_equal(new[column].values.astype(np.float64), old[column].values)
+
+def test_aggregate_scans_schema():
+    # The merged features are stored as float32 (see feature_schema.py): counts stay exact,
+    # level statistics keep float32 precision.
+    scans = _scans(2)
+    old = _loop(scans, BLUETOOTH_BANDS, BLUETOOTH_MAX_LEVEL)
+    new = apply_schema(aggregate_scans(scans, BLUETOOTH_BANDS, max_level=BLUETOOTH_MAX_LEVEL), missing=True)
+    for column in old.columns:
+        if column.startswith('total') or column.startswith('level'):
+            assert new[column].dtype == np.float32
+            np.testing.assert_allclose(new[column].values, old[column].values, rtol=1e-6)
+
+def test_mode_by_timestamp_without_values():
+    for values in [[], [np.nan, np.nan]]:
+        df = pd.DataFrame({'timestamp': np.arange(len(values), dtype=np.int64), 'activity_inference': values})
+        modes = mode_by_timestamp(df)
+        assert modes.shape == (0, 2)
+        assert list(modes.columns) == ['timestamp', 'activity_inference']
+
+def _asfreq(path, names):
+    # Per-second series of the whole file (the path of the readers without chunks).
+    df = pd.read_csv(path)
+    df.columns = names
+    df = mode_by_timestamp(df, *names)
+    df[names[0]] = pd.to_datetime(df[names[0]], unit='s')
+    return df.set_index(names[0]).asfreq('s', method='bfill')
+
+def test_read_mode_per_second_with_missing_chunks(tmp_path):
+    names = ['timestamp', 'activity_inference']
+    path = str(tmp_path / 'activity_u00.csv')
+    # The second chunk (rows 4-7) has no values.
+    values = [0, 1, 1, 2, np.nan, np.nan, np.nan, np.nan, 3, 0, 2, 2]
+    pd.DataFrame({'timestamp': 1364342400 + np.arange(0, 36, 3), ' activity inference': values}).to_csv(path, index=False)
+    chunked = read_mode_per_second(path, names, chunksize=4, dtype=np.int8)
+    expected = _asfreq(path, names)
+    np.testing.assert_array_equal(chunked.index.values, expected.index.values)
+    np.testing.assert_array_equal(chunked['activity_inference'].values, expected['activity_inference'].values)
+
+def test_read_mode_per_second_of_empty_file(tmp_path):
+    path = str(tmp_path / 'activity_u00.csv')
+    pd.DataFrame({'timestamp': [], ' activity inference': []}).to_csv(path, index=False)
+    assert read_mode_per_second(path, ['timestamp', 'activity_inference'], chunksize=4).shape == (0, 1)
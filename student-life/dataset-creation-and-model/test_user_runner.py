@@ -0,0 +1,48 @@
+import threading
+import time
+
+from user_runner import run_users
+
+# Users whose sources are read or kept in memory (from the first read until process_user returns).
+_lock = threading.Lock()
+_state = {'alive': set(), 'max_alive': 0, 'processed': []}
+
+
+def _source_readers(user, **kwargs):
+    def read(name):
+        with _lock:
+            _state['alive'].add(user)
+            _state['max_alive'] = max(_state['max_alive'], len(_state['alive']))
+        time.sleep(0.001)
+        if user == 'bad' and name == 'b':
+            raise IOError('missing file')
+        return user + '_' + name
+    return {name: (lambda name=name: read(name)) for name in ['a', 'b', 'c']}
+
+def _process_user(user, sources=None):
+    assert sources == {name: user + '_' + name for name in ['a', 'b', 'c']}
+    # Merging is slow, so reads of the next users finish during it.
+    time.sleep(0.02)
+    with _lock:
+        _state['alive'].discard(user)
+        _state['processed'].append(user)
+
+def _run(users, prefetch):
+    _state.update({'alive': set(), 'max_alive': 0, 'processed': []})
+    return run_users(_process_user, users, workers=1, source_readers=_source_readers, prefetch=prefetch,
+                     io_workers=4)
+
+def test_prefetch_depth():
+    users = ['u' + str(i).zfill(2) for i in range(8)]
+    for prefetch in [1, 2, 3]:
+        failed = _run(users, prefetch)
+        assert failed == {}
+        assert _state['processed'] == users
+        # The current user and prefetch users ahead of it.
+        assert _state['max_alive'] == prefetch + 1
+
+def test_failed_read_is_failure_of_the_user():
+    failed = _run(['u00', 'bad', 'u01'], 1)
+    assert list(failed) == ['bad']
+    assert 'missing file' in failed['bad']
+    assert _state['processed'] == ['u00', 'u01']
@@ -0,0 +1,307 @@
+import pandas as pd
+import numpy as np
+
+# Shared functions that project raw sensing sources onto the per-second timeline.
+# They are used by "1-dataset-preparation-seconds.py" and "1-dataset-preparation-only-sensing.py".
+
+
+def to_int64_time(values, unit='ns'):
+    # Converts datetime-like values to int64 numbers (NaT becomes the smallest int64,
+    # therefore it is never covered by any interval).
+    values = pd.to_datetime(pd.Series(np.asarray(values)))
+    return values.values.astype('datetime64[' + unit + ']').astype(np.int64)
+
+
+### INTERVAL FUNCTIONS BEGIN ###
+
+def clean_intervals(starts, ends):
+    # Drops intervals with missing bounds or with end before start, they never cover anything.
+    valid = (starts != np.iinfo(np.int64).min) & (ends != np.iinfo(np.int64).min) & (starts <= ends)
+    return starts[valid], ends[valid]
+
+def interval_coverage(timestamps, starts, ends):
+    # Returns how many [start, end] intervals (both ends inclusive) cover each timestamp.
+    # Timestamps are sorted once, every interval is converted to a [first, last] position range
+    # with searchsorted and the ranges are added to a difference array. One cumulative sum gives
+    # the coverage of the whole timeline, so the cost is O(n log n + m log n) instead of
+    # O(n * m) boolean masks. Timestamps do not need to be sorted or unique and may contain NaT.
+    times = to_int64_time(timestamps)
+    starts, ends = clean_intervals(to_int64_time(starts), to_int64_time(ends))
+    order = np.argsort(times, kind='mergesort')
+    sorted_times = times[order]
+    first = np.searchsorted(sorted_times, starts, side='left')
+    last = np.searchsorted(sorted_times, ends, side='right')
+    diff = np.bincount(first, minlength=len(times) + 1) - np.bincount(last, minlength=len(times) + 1)
+    coverage = np.empty(len(times), dtype=np.int64)
+    coverage[order] = np.cumsum(diff[:-1])
+    return coverage
+
+def paint_intervals(timestamps, starts, ends, how='flag'):
+    # Paints intervals on timestamps.
+    # how='flag' gives 1 for covered timestamps and NaN otherwise (same as the old mask loops,
+    # missing values are filled with 0 afterwards), how='count' gives the number of covering intervals.
+    coverage = interval_coverage(timestamps, starts, ends)
+    if how == 'count':
+        return coverage
+    elif how == 'flag':
+        return np.where(coverage > 0, 1, np.nan).astype(np.float32)
+    raise ValueError("how should be 'flag' or 'count', not " + str(how))
+
+def interval_seconds_per_bin(starts, ends, freq='10min'):
+    # Returns the number of seconds covered by at least one interval for each bin of freq.
+    # Coverage is computed with a difference array over the seconds between the first start
+    # and the last end, therefore overlapping intervals are counted once.
+    starts, ends = clean_intervals(to_int64_time(starts, unit='s'), to_int64_time(ends, unit='s'))
+    if len(starts) == 0:
+        return pd.Series([], dtype=np.int64, index=pd.DatetimeIndex([]), name='seconds_covered')
+    origin = starts.min()
+    length = ends.max() - origin + 1
+    diff = np.bincount(starts - origin, minlength=length + 1) - np.bincount(ends - origin + 1, minlength=length + 1)
+    covered = (np.cumsum(diff[:-1]) > 0).astype(np.int64)
+    index = pd.to_datetime(origin + np.arange(length), unit='s')
+    covered = pd.Series(covered, index=index, name='seconds_covered')
+    return covered.resample(freq).sum()
+
+### INTERVAL FUNCTIONS END ###
+
+### SCAN FUNCTIONS BEGIN ###
+
+# RSSI distance bands as (column name, lowest level of band), from the farthest band to the nearest one.
+# A level belongs to the band of the highest lower bound it reaches.
+BLUETOOTH_BANDS = [('total_farther', -125), # Normally -100 is max but for one anomaly.
+                   ('total_far', -90),
+                   ('total_near', -80),
+                   ('total_nearer', -65)]
+BLUETOOTH_MAX_LEVEL = 0
+
+WIFI_BANDS = [('total_far', -100),
+              ('total_near', -80),
+              ('total_nearer', -60)]
+WIFI_MAX_LEVEL = None
+
+def aggregate_scans(scans, bands, max_level=None, time_col='time', level_col='level'):
+    # Aggregates bluetooth/wifi scan rows of each scan timestamp in one pass.
+    # Timestamps are factorized to group numbers, levels are binned to band numbers and
+    # all counts and sums are calculated with bincount instead of filtering the frame per timestamp.
+    # Columns are same with the old per timestamp loop: timestamp, total_devices_around,
+    # one count per band, level_avg (rounded mean) and level_std (sample std), in sorted order.
+    # All values are calculated as float64 like the old loop. Counts and level_avg are identical,
+    # level_std can differ in the last digits (about 1e-15) because the sums are added in another order.
+    # The merges store them as float32 afterwards (see feature_schema.py).
+    groups, times = pd.factorize(scans[time_col], sort=False)
+    n_groups = len(times)
+    levels = scans[level_col].values.astype(np.float64)
+
+    data = {'timestamp': times}
+    data['total_devices_around'] = np.bincount(groups, minlength=n_groups).astype(np.float64)
+
+    # Band 0 is below the farthest band, band i is the i'th band of bands.
+    edges = np.array([low for name, low in bands], dtype=np.float64)
+    band_codes = np.digitize(levels, edges)
+    band_codes[np.isnan(levels)] = 0
+    if max_level is not None:
+        band_codes[levels > max_level] = 0
+    band_counts = np.bincount(groups * (len(bands) + 1) + band_codes,
+                              minlength=n_groups * (len(bands) + 1)).reshape(n_groups, len(bands) + 1)
+    for i, (name, low) in enumerate(bands):
+        data[name] = band_counts[:, i + 1].astype(np.float64)
+
+    # Mean and sample std of the non-missing levels.
+    valid = ~np.isnan(levels)
+    counts = np.bincount(groups[valid], minlength=n_groups)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = np.bincount(groups[valid], weights=levels[valid], minlength=n_groups) / counts
+        squares = np.bincount(groups[valid], weights=(levels[valid] - means[groups[valid]]) ** 2, minlength=n_groups)
+        stds = np.sqrt(squares / (counts - 1))
+    stds[counts < 2] = np.nan
+    data['level_avg'] = np.round(means)
+    data['level_std'] = stds
+
+    aggregated = pd.DataFrame(data)
+    return aggregated[sorted(aggregated.columns)]
+
+### SCAN FUNCTIONS END ###
+
+### CATEGORICAL FUNCTIONS BEGIN ###
+
+def mode_by_timestamp(df, time_col='timestamp', value_col='activity_inference'):
+    # Takes the mode of value_col for each timestamp, same with
+    # df.groupby(time_col)[value_col].apply(lambda x: x.mode()[0]).reset_index()
+    # (if there are multiple modes, the smallest value is chosen) but without a python call per timestamp.
+    # Rows are sorted by (timestamp, value) once, equal neighbours are counted as runs and
+    # the run with the highest count (and the smallest value for ties) is chosen for each timestamp.
+    # It works for any categorical stream with sortable values, e.g. inference codes.
+    df = df[df[value_col].notnull()]
+    times = df[time_col].values
+    values = df[value_col].values
+    if len(times) == 0:
+        # Empty or all missing (e.g. an empty file or chunk), same with the groupby version.
+        return pd.DataFrame({time_col: times, value_col: values})
+    order = np.lexsort((values, times))
+    times = times[order]
+    values = values[order]
+
+    # Start of each (timestamp, value) run and its length.
+    run_starts = np.flatnonzero(np.concatenate(([True], (times[1:] != times[:-1]) | (values[1:] != values[:-1]))))
+    run_counts = np.diff(np.append(run_starts, len(times)))
+    run_times = times[run_starts]
+    run_values = values[run_starts]
+
+    # For each timestamp, highest count first and smallest value first among equal counts.
+    order = np.lexsort((run_values, -run_counts, run_times))
+    run_times = run_times[order]
+    run_values = run_values[order]
+    first = np.concatenate(([True], run_times[1:] != run_times[:-1]))
+    return pd.DataFrame({time_col: run_times[first], value_col: run_values[first]})
+
+### CATEGORICAL FUNCTIONS END ###
+
+### CHUNKED READ FUNCTIONS BEGIN ###
+
+def _mode_per_second(rows, time_col, value_col, last_time):
+    # Takes the mode of each timestamp and fills seconds after last_time (up to the last timestamp of rows)
+    # with backward filling, same with asfreq('s', method='bfill').
+    modes = mode_by_timestamp(rows, time_col, value_col)
+    if modes.shape[0] == 0:
+        # Rows without values fill nothing, their seconds are filled by the next rows.
+        return None, last_time
+    times = modes[time_col].values.astype(np.int64)
+    start = times[0] if last_time is None else last_time + 1
+    seconds = np.arange(start, times[-1] + 1)
+    # Value of each second is the value of the first timestamp at or after it.
+    values = modes[value_col].values[np.searchsorted(times, seconds, side='left')]
+    piece = pd.DataFrame({value_col: values}, index=pd.DatetimeIndex(pd.to_datetime(seconds, unit='s'), name=time_col))
+    return piece, times[-1]
+
+def iter_mode_per_second(path, names, chunksize=1000000):
+    # Reads a timestamped categorical sensing file (e.g. activity or audio) in chunks of chunksize rows and
+    # yields its per-second series piece by piece, same with mode_by_timestamp + asfreq('s', method='bfill').
+    # Rows of the last timestamp of a chunk are kept for the next chunk, because the same timestamp
+    # can continue in the next chunk. Files should be sorted by timestamp (raw sensing files are).
+    time_col, value_col = names
+    last_time = None
+    carry = None
+    for chunk in pd.read_csv(path, chunksize=chunksize):
+        chunk.columns = names
+        if carry is not None:
+            chunk = pd.concat([carry, chunk], ignore_index=True)
+        if last_time is not None and chunk[time_col].min() <= last_time:
+            raise ValueError(path + ' is not sorted by timestamp, it should be read without chunks.')
+        last = chunk[time_col].max()
+        carry = chunk[chunk[time_col] == last]
+        chunk = chunk[chunk[time_col] != last]
+        if chunk.shape[0] > 0:
+            piece, last_time = _mode_per_second(chunk, time_col, value_col, last_time)
+            if piece is not None:
+                yield piece
+    if carry is not None and carry.shape[0] > 0:
+        piece, last_time = _mode_per_second(carry, time_col, value_col, last_time)
+        if piece is not None:
+            yield piece
+
+def read_mode_per_second(path, names, chunksize=1000000, dtype=None):
+    # Per-second series of iter_mode_per_second as a single frame, same with pd.concat of the pieces.
+    # Only the raw rows are read in chunks: the result has a row for each second of the time span of the file,
+    # so it grows with the time span and not with chunksize. To keep the peak memory close to the size of
+    # the result, only the values of each piece are kept (as dtype, e.g. int8) and the index, which is
+    # a continuous range of seconds, is created once at the end.
+    time_col, value_col = names
+    start = None
+    values = []
+    for piece in iter_mode_per_second(path, names, chunksize=chunksize):
+        if start is None:
+            start = piece.index[0]
+        values.append(piece[value_col].values if dtype is None else piece[value_col].values.astype(dtype))
+    if start is None:
+        return pd.DataFrame({value_col: np.array([], dtype=dtype)},
+                            index=pd.DatetimeIndex([], name=time_col))
+    values = np.concatenate(values)
+    index = pd.date_range(start, periods=len(values), freq='s', name=time_col)
+    return pd.DataFrame({value_col: values}, index=index)
+
+### CHUNKED READ FUNCTIONS END ###
+
+
+### DAILY FUNCTIONS BEGIN ###
+# Functions that join values of calendar days (e.g. deadlines of education/deadlines.csv) to the timeline.
+
+NS_PER_DAY = 24 * 60 * 60 * 10 ** 9
+
+def daily_values(timestamps, daily):
+    # Returns the value of the calendar day of each timestamp from daily (a series indexed by dates).
+    # The date key of all timestamps is calculated once with normalize and joined to daily,
+    # days that are not in daily (and NaT) get NaN.
+    dates = pd.DatetimeIndex(pd.to_datetime(np.asarray(timestamps))).normalize()
+    daily = daily.groupby(pd.DatetimeIndex(daily.index).normalize()).sum()
+    return daily.reindex(dates).values
+
+def days_until_next(timestamps, event_dates):
+    # Returns the number of days from the calendar day of each timestamp to the next event date
+    # (0 on the day of an event). Timestamps after the last event and NaT get NaN.
+    # Events are found with searchsorted over the sorted event days, there is no scan per date.
+    times = to_int64_time(timestamps)
+    days = times // NS_PER_DAY
+    events = np.unique(to_int64_time(event_dates) // NS_PER_DAY)
+    position = np.searchsorted(events, days, side='left')
+    valid = (position < len(events)) & (times != np.iinfo(np.int64).min)
+    result = np.full(len(times), np.nan, dtype=np.float32)
+    result[valid] = events[position[valid]] - days[valid]
+    return result
+
+### DAILY FUNCTIONS END ###
+
+
+### EVENT FUNCTIONS BEGIN ###
+# Functions that project point events (sms, calls, app usage records) onto the timeline.
+
+def project_events(timestamps, events):
+    # Projects multiple event sources onto timestamps with a single sort of the timeline.
+    # events is {column: (event_times, values, how)}, values can be None for how='flag' and 'count'.
+    # how='flag' gives 1 for timestamps with an event and NaN otherwise (same as merging a flag column
+    # with how='left'), how='count' gives the number of events and how='sum' gives the sum of values
+    # of the events at each timestamp (NaN without an event).
+    # Each event is converted to the [first, last] position range of equal timestamps with searchsorted
+    # and the ranges are added to difference arrays, so duplicate or unsorted timestamps are handled
+    # and there is no merge or row loop. Events that are not on the timeline are ignored.
+    times = to_int64_time(timestamps)
+    if len(times) > 0 and np.all(times[1:] >= times[:-1]):
+        # The timeline is usually sorted already, the sort is not needed then.
+        order = None
+        sorted_times = times
+    else:
+        order = np.argsort(times, kind='mergesort')
+        sorted_times = times[order]
+    n = len(times)
+    projected = {}
+    for column, (event_times, values, how) in events.items():
+        event_times = to_int64_time(event_times)
+        valid = event_times != np.iinfo(np.int64).min
+        first = np.searchsorted(sorted_times, event_times[valid], side='left')
+        last = np.searchsorted(sorted_times, event_times[valid], side='right')
+        counts = np.cumsum(np.bincount(first, minlength=n + 1) - np.bincount(last, minlength=n + 1))[:-1]
+        if how == 'count':
+            result = counts
+        elif how == 'flag':
+            result = np.where(counts > 0, 1, np.nan).astype(np.float32)
+        elif how == 'sum':
+            weights = np.asarray(values, dtype=np.float64)[valid]
+            sums = np.cumsum(np.bincount(first, weights=weights, minlength=n + 1) -
+                             np.bincount(last, weights=weights, minlength=n + 1))[:-1]
+            result = np.where(counts > 0, sums, np.nan)
+        else:
+            raise ValueError("how should be 'flag', 'count' or 'sum', not " + str(how))
+        if order is not None:
+            unsorted = np.empty_like(result)
+            unsorted[order] = result
+            result = unsorted
+        projected[column] = result
+    return projected
+
+def call_intervals(call_starts, durations):
+    # Returns (start, end) of calls that last durations seconds, both ends inclusive, so a call
+    # covers durations seconds of the per-second timeline. Calls without duration are dropped.
+    call_starts = pd.to_datetime(pd.Series(np.asarray(call_starts))).dt.floor('s')
+    durations = pd.to_timedelta(np.asarray(durations, dtype=np.float64), unit='s')
+    return call_starts.values, (call_starts + durations - pd.Timedelta(seconds=1)).values
+
+### EVENT FUNCTIONS END ###
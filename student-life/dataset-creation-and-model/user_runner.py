@@ -0,0 +1,126 @@
+import collections
+import multiprocessing
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+from stage_monitor import stage, set_stage_user
+
+# Runs the per-user pipeline of the dataset preparation scripts for all users,
+# one after another or in worker processes.
+# When users are processed one after another, raw files of the next users can be read on a thread pool
+# while the current user is merged, so reading and merging overlap without the memory of worker processes.
+
+# Data shared by all users (e.g. deadlines). It is sent to each worker once when the worker starts
+# instead of sending it with every user.
+_shared = {}
+
+
+def _init_worker(shared):
+    _shared.clear()
+    _shared.update(shared)
+
+def _run_user(args):
+    # Runs the pipeline for one user and catches the error, so one user's failure does not stop others.
+    process_user, user = args
+    start = time.time()
+    # Stages of the user are recorded with the user code, the whole user is recorded as process_user.
+    set_stage_user(user)
+    try:
+        stage(process_user, name='process_user')(user, **_shared)
+        return user, time.time() - start, None
+    except Exception:
+        return user, time.time() - start, traceback.format_exc()
+
+def _read_source(user, reader):
+    # Stages of reader threads are recorded with the user they read.
+    set_stage_user(user)
+    return reader()
+
+def _run_prefetched(process_user, user, futures):
+    # Waits for the sources of the user and runs the pipeline with them, a failed read is the user's failure.
+    start = time.time()
+    set_stage_user(user)
+    try:
+        sources = {name: future.result() for name, future in futures.items()}
+        stage(process_user, name='process_user')(user, sources=sources, **_shared)
+        return user, time.time() - start, None
+    except Exception:
+        return user, time.time() - start, traceback.format_exc()
+
+def _pipelined(process_user, users, source_readers, prefetch, io_workers):
+    # Yields results of users one after another like map(_run_user, ...), but the sources of the next prefetch
+    # users are read on io_workers threads while the current user is processed. At most prefetch + 1 users
+    # are read or kept in memory at the same time.
+    users = iter(users)
+    pending = collections.deque()
+    executor = ThreadPoolExecutor(max_workers=io_workers)
+
+    def submit_next():
+        for user in users:
+            readers = source_readers(user, **_shared)
+            pending.append((user, {name: executor.submit(_read_source, user, reader)
+                                   for name, reader in readers.items()}))
+            return
+
+    try:
+        for i in range(prefetch):
+            submit_next()
+        while pending:
+            user, futures = pending.popleft()
+            # Reads of the next user start before the current one is merged, so prefetch users are read
+            # while the current user is processed.
+            submit_next()
+            result = _run_prefetched(process_user, user, futures)
+            # Sources of the user are freed before the next user.
+            futures = None
+            yield result
+    finally:
+        # Reads of users that are not processed (e.g. after an interrupt) are cancelled.
+        for user, futures in pending:
+            for future in futures.values():
+                future.cancel()
+        executor.shutdown(wait=True)
+
+def _report(done, total, user, duration, error):
+    if error is None:
+        print('[' + str(done) + '/' + str(total) + ']', user, 'IS COMPLETED in', round(duration, 1), 'seconds.')
+    else:
+        print('[' + str(done) + '/' + str(total) + ']', user, 'FAILED after', round(duration, 1), 'seconds:')
+        print(error)
+
+def run_users(process_user, users, workers=1, source_readers=None, prefetch=0, io_workers=4, **shared):
+    # Calls process_user(user, **shared) for each user.
+    # If workers is higher than 1, users are processed in that many worker processes.
+    # Each worker handles a single user and is replaced afterwards, so the memory of a user is freed.
+    # If workers is 1 and source_readers is given, source_readers(user, **shared) returns the readers of the raw
+    # data of a user as {name: function}. They are called on io_workers threads for the next prefetch users
+    # and process_user(user, sources={name: data}, **shared) is called with the results.
+    # Returns a dictionary of failed users and their error messages.
+    failed = {}
+    total = len(users)
+    if workers <= 1:
+        _init_worker(shared)
+        if source_readers is not None and prefetch > 0:
+            results = _pipelined(process_user, users, source_readers, prefetch, io_workers)
+        else:
+            results = map(_run_user, [(process_user, user) for user in users])
+        for done, (user, duration, error) in enumerate(results, 1):
+            _report(done, total, user, duration, error)
+            if error is not None:
+                failed[user] = error
+    else:
+        pool = multiprocessing.Pool(processes=workers, initializer=_init_worker,
+                                    initargs=(shared,), maxtasksperchild=1)
+        try:
+            results = pool.imap_unordered(_run_user, [(process_user, user) for user in users])
+            for done, (user, duration, error) in enumerate(results, 1):
+                _report(done, total, user, duration, error)
+                if error is not None:
+                    failed[user] = error
+        finally:
+            pool.close()
+            pool.join()
+    if failed:
+        print(len(failed), 'of', total, 'users failed:', ', '.join(sorted(failed)))
+    return failed